@@ -1,7 +1,22 @@
-from flask import Flask, session, render_template, request, redirect, url_for, flash, send_file, Response, stream_with_context, jsonify
-from flask_socketio import SocketIO, emit
+# 以 eventlet / gevent 方式运行（config.yaml 中 server.async_mode）时，必须在导入 socket、threading
+# 等模块之前打补丁；由 gunicorn 加载时则由它的 worker 负责。
+if __name__ == '__main__':
+    import yaml as _yaml
+    with open('config.yaml', 'r', encoding='utf-8') as _f:
+        _async_mode = ((_yaml.safe_load(_f) or {}).get('server') or {}).get('async_mode', 'threading')
+    if _async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif _async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+from flask import Flask, session, render_template, request, redirect, url_for, flash, Response, jsonify
+from flask_socketio import SocketIO, emit, join_room
+import socketio as python_socketio
 import yaml
 import sqlite3
+import json
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import shutil
@@ -13,6 +28,24 @@ import uuid
 import threading
 import time
 import hashlib
+import mimetypes
+import unicodedata
+import struct
+import tempfile
+import zlib
+import queue
+from collections import OrderedDict, deque
+import heapq
+import itertools
+import atexit
+import ctypes
+import errno
+import select
+import socket
+import concurrent.futures
+import subprocess
+from urllib.parse import quote as url_quote
+from werkzeug.http import http_date
 
 def safe_filename(filename):
     """
@@ -96,11 +129,13 @@ app = Flask(__name__)
 # 在生产环境中，这应该是一个更复杂、更随机的字符串，并且不应该硬编码在代码里
 app.secret_key = 'your_very_secret_key_change_it_later'
 
-# 初始化 SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 初始化 SocketIO（并发模型取决于配置，读取配置后再绑定到 app，见 init_server）
+socketio = SocketIO()
 
-# 全局变量存储上传会话
-upload_sessions = {}
+# 流式上传每次从请求体读取的块大小，单个上传的内存占用以此为上限
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 上传过程中每隔多少秒检查一次是否已被取消（并记录已上传字节数）
+UPLOAD_STATE_CHECK_INTERVAL = 0.5
 
 # 注册一个辅助函数，使其可以在所有模板中使用
 app.jinja_env.filters['format_datetime'] = format_datetime_for_display
@@ -167,6 +202,134 @@ def load_config():
     with open('config.yaml', 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
+# --- 数据库访问层 ---
+# 每个线程复用一个长连接，避免每次查询都重新打开数据库文件、重新解析语句。
+# 数据库使用 WAL 模式：读操作不会阻塞写操作，写操作之间通过 busy_timeout 排队等待，
+# 并发登录、上传时不再出现 "database is locked"。
+DB_BUSY_TIMEOUT = 5.0
+DB_STATEMENT_CACHE_SIZE = 256
+_db_local = threading.local()
+
+def get_db():
+    """返回当前线程的数据库连接（首次调用时创建）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
+        conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT,
+                               cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        _db_local.conn = conn
+    return conn
+
+@app.teardown_request
+def rollback_unfinished_transaction(exc):
+    """请求结束时回滚未提交的事务，防止异常路径把写锁留在复用的连接上"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# --- 审计日志异步写入 ---
+# 登录日志、文件操作记录等审计数据不需要立即可见，由后台线程批量写入：
+# 请求线程只把语句放入队列，写线程每攒够一批或等待超过 AUDIT_MAX_DELAY 秒就在一个事务中提交，
+# 一次 fsync 代替每条记录一次。队列满时调用方最多阻塞 AUDIT_PUT_TIMEOUT 秒（背压），
+# 仍然放不进去就直接同步写入，保证审计记录不会丢失。
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+AUDIT_MAX_DELAY = 0.5
+AUDIT_PUT_TIMEOUT = 1.0
+
+class AuditWriter:
+    """审计记录的后台批量写入器"""
+
+    def __init__(self, maxsize=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE, max_delay=AUDIT_MAX_DELAY):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # 延迟到第一次写入时启动，fork 出的子进程（如 gunicorn worker）也会各自启动写线程
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='audit-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def write(self, sql, params=()):
+        """提交一条写语句，通常立即返回"""
+        self._ensure_started()
+        try:
+            self.queue.put((sql, params), timeout=AUDIT_PUT_TIMEOUT)
+        except queue.Full:
+            print('Audit queue full, writing synchronously')
+            self._write_batch([(sql, params)])
+
+    def flush(self, timeout=None):
+        """等待此前提交的记录全部写入数据库"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """进程退出前写入所有剩余记录"""
+        self.flush(timeout=10)
+
+    def _run(self):
+        while True:
+            batch = []
+            waiters = []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if isinstance(item, threading.Event):
+                    # flush 请求：立即提交当前批次
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_batch(batch)
+            for waiter in waiters:
+                waiter.set()
+
+    def _write_batch(self, batch):
+        conn = get_db()
+        try:
+            for sql, params in batch:
+                conn.execute(sql, params)
+            conn.commit()
+            return
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f'Audit batch write failed, retrying one by one: {e}')
+        # 批量提交失败时逐条重试，跳过有问题的记录
+        for sql, params in batch:
+            try:
+                conn.execute(sql, params)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f'Dropped audit record ({sql.split()[0]}): {e}')
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.close)
+
 # 递归计算文件夹大小的辅助函数
 def get_folder_size(path):
     total_size = 0
@@ -178,19 +341,158 @@ def get_folder_size(path):
                 total_size += os.path.getsize(fp)
     return total_size
 
-def log_login(user_id, username, login_type, ip_address, user_agent):
-    """记录用户登录日志"""
+def get_path_size(path):
+    """返回单个文件或整个文件夹占用的字节数（用于删除前计算需要从账本中扣除的大小）"""
     try:
-        config = app.config['GRACEDISK_CONFIG']
-        db_path = config.get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
+        if os.path.isdir(path):
+            return get_folder_size(path)
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# --- 用户空间使用量账本 ---
+# 普通用户的已用空间持久化在 user_usage 表中，由上传/删除等操作增量维护，
+# 配额检查和存储条只需读取一行记录，不再每次都 os.walk 整个用户目录。
+# 后台对账任务会定期重新扫描目录，修正因外部修改等原因产生的偏差。
+
+def get_user_used_bytes(user_id, username):
+    """获取用户已用空间（字节），账本中没有记录时扫描一次目录作为初始值"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT used_bytes FROM user_usage WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        used_bytes = scan_user_usage(username)
+        cursor.execute("""
+            INSERT OR IGNORE INTO user_usage (user_id, used_bytes, reconciled_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        """, (user_id, used_bytes))
+        conn.commit()
+    else:
+        used_bytes = row[0]
+    return used_bytes
+
+def adjust_user_usage(user_id, delta_bytes):
+    """在单条 UPDATE 语句中增减用户已用空间，保证并发操作下的原子性"""
+    if not delta_bytes:
+        return
+    try:
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("""
+            UPDATE user_usage SET used_bytes = MAX(used_bytes + ?, 0) WHERE user_id = ?
+        """, (delta_bytes, user_id))
+        conn.commit()
+    except Exception as e:
+        # 账本更新失败不影响文件操作本身，偏差由后台对账任务修正
+        print(f'Failed to update usage ledger for user {user_id}: {e}')
+
+def reserve_user_usage(user_id, username, delta_bytes, quota_bytes):
+    """在同一条 UPDATE 语句中检查配额并预占空间，空间不足时不做修改并返回 False"""
+    get_user_used_bytes(user_id, username)  # 确保账本中已有记录
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE user_usage SET used_bytes = used_bytes + ? WHERE user_id = ? AND used_bytes + ? <= ?
+    """, (delta_bytes, user_id, delta_bytes, quota_bytes))
+    conn.commit()
+    return cursor.rowcount == 1
+
+def session_usage_user_id():
+    """返回当前会话需要记账的用户ID，管理员和访客不受配额限制，返回 None"""
+    if session.get('is_admin') or session.get('is_visitor'):
+        return None
+    return session.get('user_id')
+
+def scan_user_usage(username):
+    """扫描用户目录的已用空间，不含上传暂存目录（断点续传的 .part 按完整大小预分配，配额已在初始化时预占）"""
+    root = os.path.join('userfiles', username)
+    return get_folder_size(root) - get_folder_size(os.path.join(root, upload_spool.dir_name))
+
+def _usage_reconcile_state(cursor, user_id):
+    """返回 (账本中的已用空间, 未提交的预占)；用户有进行中的后台任务或回收站清理时返回 None，本轮跳过
+
+    后台任务和回收站清理在删除或复制文件之后才提交账本变化，此时的扫描结果与账本必然不一致。
+    """
+    cursor.execute("""
+        SELECT 1 FROM jobs WHERE user_id = ? AND status NOT IN ('completed', 'failed', 'cancelled') LIMIT 1
+    """, (user_id,))
+    if cursor.fetchone():
+        return None
+    cursor.execute("""
+        SELECT 1 FROM trash_items WHERE usage_user_id = ? AND purge_started_at > ? LIMIT 1
+    """, (user_id, time.time() - TRASH_PURGE_STALE))
+    if cursor.fetchone():
+        return None
+    cursor.execute("""
+        SELECT COALESCE(SUM(file_size), 0) FROM resumable_uploads WHERE usage_user_id = ? AND status = 'uploading'
+    """, (user_id,))
+    reserved_bytes = cursor.fetchone()[0]
+    cursor.execute("SELECT used_bytes FROM user_usage WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    return (row[0] if row else None), reserved_bytes
+
+def reconcile_user_usage():
+    """重新扫描所有普通用户目录，修正账本中的已用空间
+
+    账本 = 目录扫描结果 + 断点续传的预占。扫描期间账本或预占发生变化（上传完成、删除等）时
+    不覆盖，留到下一轮；有进行中的后台任务的用户同样跳过，以免抹掉任务的预占或尚未提交的扣减。
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, username FROM users WHERE is_admin = 0")
+    users = cursor.fetchall()
+
+    for user_id, username in users:
+        try:
+            state = _usage_reconcile_state(cursor, user_id)
+            conn.commit()
+            if state is None:
+                continue
+            before, reserved_bytes = state
+            used_bytes = scan_user_usage(username) + reserved_bytes
+            if _usage_reconcile_state(cursor, user_id) != state:
+                conn.commit()
+                continue
+            if before is None:
+                cursor.execute("""
+                    INSERT OR IGNORE INTO user_usage (user_id, used_bytes, reconciled_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                """, (user_id, used_bytes))
+            else:
+                # 只在账本仍是扫描前的值时更新，扫描期间落下的增减不会丢失
+                cursor.execute("""
+                    UPDATE user_usage SET used_bytes = ?, reconciled_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND used_bytes = ?
+                """, (used_bytes, user_id, before))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f'Failed to reconcile usage for user {username}: {e}')
+
+def start_usage_reconciler():
+    """启动账本定期对账任务"""
+    interval = app.config['GRACEDISK_CONFIG'].get('usage_reconcile_interval', 3600)
+
+    def reconcile_task():
+        while True:
+            try:
+                time.sleep(interval)
+                reconcile_user_usage()
+            except Exception as e:
+                print(f'Usage reconciler error: {e}')
+
+    reconcile_thread = threading.Thread(target=reconcile_task)
+    reconcile_thread.daemon = True
+    reconcile_thread.start()
+
+def log_login(user_id, username, login_type, ip_address, user_agent):
+    """记录用户登录日志"""
+    try:
+        audit_writer.write("""
             INSERT INTO login_logs (user_id, username, login_type, ip_address, user_agent)
             VALUES (?, ?, ?, ?, ?)
         """, (user_id, username, login_type, ip_address, user_agent))
-        conn.commit()
-        conn.close()
     except Exception:
         pass  # 登录记录失败不应影响正常登录
 
@@ -200,6 +502,8 @@ def init_db():
     
     # Connect to the DB. It will be created if it doesn't exist.
     conn = sqlite3.connect(db_path)
+    # 启用 WAL 模式（持久化在数据库文件中），允许读写并发
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
 
     # Check for existing tables
@@ -263,58 +567,463 @@ def init_db():
         if 'expires_at' not in columns:
             cursor.execute('ALTER TABLE shares ADD COLUMN expires_at TIMESTAMP')
 
-            # Create file_operations table for tracking uploads/downloads
-        if 'file_operations' not in tables:
-            cursor.execute('''
-            CREATE TABLE file_operations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                operation_type TEXT NOT NULL, -- 'upload' or 'download'
-                file_path TEXT NOT NULL,
-                file_size INTEGER,
-                status TEXT NOT NULL DEFAULT 'completed', -- 'in_progress', 'completed', 'failed'
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-            ''')
-            print("Table 'file_operations' created.")
+    # Create file_operations table for tracking uploads/downloads
+    if 'file_operations' not in tables:
+        cursor.execute('''
+        CREATE TABLE file_operations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            operation_type TEXT NOT NULL, -- 'upload' or 'download'
+            file_path TEXT NOT NULL,
+            file_size INTEGER,
+            status TEXT NOT NULL DEFAULT 'completed', -- 'in_progress', 'completed', 'failed'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        print("Table 'file_operations' created.")
+    
+    # Create login_logs table for tracking user logins
+    if 'login_logs' not in tables:
+        cursor.execute('''
+        CREATE TABLE login_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            login_type TEXT NOT NULL,
+            ip_address TEXT,
+            user_agent TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        print("Table 'login_logs' created.")
+    else:
+        # 确保login_logs表结构正确
+        cursor.execute("PRAGMA table_info(login_logs)")
+        login_logs_columns = [row[1] for row in cursor.fetchall()]
+        required_columns = ['id', 'user_id', 'username', 'login_type', 'ip_address', 'user_agent', 'created_at']
         
-        # Create login_logs table for tracking user logins
-        if 'login_logs' not in tables:
-            cursor.execute('''
-            CREATE TABLE login_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                login_type TEXT NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            print("Table 'login_logs' created.")
-        else:
-            # 确保login_logs表结构正确
-            cursor.execute("PRAGMA table_info(login_logs)")
-            login_logs_columns = [row[1] for row in cursor.fetchall()]
-            required_columns = ['id', 'user_id', 'username', 'login_type', 'ip_address', 'user_agent', 'created_at']
-            
-            for col in required_columns:
-                if col not in login_logs_columns:
-                    if col == 'ip_address':
-                        cursor.execute('ALTER TABLE login_logs ADD COLUMN ip_address TEXT')
-                    elif col == 'user_agent':
-                        cursor.execute('ALTER TABLE login_logs ADD COLUMN user_agent TEXT')
-                    print(f"Added missing column '{col}' to login_logs table.")
+        for col in required_columns:
+            if col not in login_logs_columns:
+                if col == 'ip_address':
+                    cursor.execute('ALTER TABLE login_logs ADD COLUMN ip_address TEXT')
+                elif col == 'user_agent':
+                    cursor.execute('ALTER TABLE login_logs ADD COLUMN user_agent TEXT')
+                print(f"Added missing column '{col}' to login_logs table.")
+
+    # Create user_usage table for the incremental quota ledger
+    if 'user_usage' not in tables:
+        cursor.execute('''
+        CREATE TABLE user_usage (
+            user_id INTEGER PRIMARY KEY,
+            used_bytes INTEGER NOT NULL DEFAULT 0,
+            reconciled_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        print("Table 'user_usage' created.")
+
+    # Create resumable upload tables so interrupted uploads survive restarts
+    if 'resumable_uploads' not in tables:
+        cursor.execute('''
+        CREATE TABLE resumable_uploads (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            usage_user_id INTEGER,
+            save_path TEXT NOT NULL,
+            temp_path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            operation_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'uploading', -- 'uploading', 'completed', 'aborted'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        print("Table 'resumable_uploads' created.")
+
+    if 'resumable_chunks' not in tables:
+        cursor.execute('''
+        CREATE TABLE resumable_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index),
+            FOREIGN KEY (upload_id) REFERENCES resumable_uploads (id)
+        )
+        ''')
+        print("Table 'resumable_chunks' created.")
 
     conn.commit()
+
+    apply_schema_migrations(conn)
+    init_search_fts(conn)
     conn.close()
 
+# --- 数据库结构迁移 ---
+# 版本号保存在 PRAGMA user_version 中，init_db 建好基础表后按顺序执行尚未应用的迁移。
+# 新增迁移时只能在列表末尾追加，不要修改已发布的迁移。
+SCHEMA_MIGRATIONS = [
+    (1, '为历史记录、仪表盘、分享管理和断点续传清理添加索引', [
+        # file_history: WHERE user_id = ? ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_file_operations_user_created ON file_operations (user_id, created_at)',
+        # 仪表盘按时间范围统计操作类型和大小（覆盖索引，不需要回表）
+        'CREATE INDEX IF NOT EXISTS idx_file_operations_created ON file_operations (created_at, operation_type, file_size)',
+        # 仪表盘按时间范围统计登录类型和独立用户（覆盖索引）
+        'CREATE INDEX IF NOT EXISTS idx_login_logs_created ON login_logs (created_at, login_type, user_id)',
+        # manage_shares: ORDER BY created_at DESC（管理员）/ WHERE user_id = ? ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_shares_created ON shares (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_shares_user_created ON shares (user_id, created_at)',
+        # 仪表盘活跃分享统计
+        'CREATE INDEX IF NOT EXISTS idx_shares_expires ON shares (expires_at)',
+        # cleanup_expired_resumable_uploads: WHERE status = 'uploading' AND updated_at < ?
+        'CREATE INDEX IF NOT EXISTS idx_resumable_uploads_status_updated ON resumable_uploads (status, updated_at)',
+    ]),
+    (2, '文件名搜索索引', [
+        # root 为存储根目录的绝对路径，path 为相对路径（以 / 分隔）
+        '''CREATE TABLE IF NOT EXISTS file_index (
+            id INTEGER PRIMARY KEY,
+            root TEXT NOT NULL,
+            path TEXT NOT NULL,
+            name TEXT NOT NULL COLLATE NOCASE,
+            is_dir BOOLEAN NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            UNIQUE (root, path)
+        )''',
+        # 前缀搜索：root = ? AND name LIKE 'xxx%'
+        'CREATE INDEX IF NOT EXISTS idx_file_index_root_name ON file_index (root, name)',
+        '''CREATE TABLE IF NOT EXISTS file_index_roots (
+            root TEXT PRIMARY KEY,
+            status TEXT NOT NULL, -- 'indexing', 'ready'
+            indexed_at TIMESTAMP
+        )''',
+    ]),
+    (3, '多进程共享的上传会话状态', [
+        # sid 为 Socket.IO 连接 ID；data 为 JSON（文件名、临时文件路径、已上传字节数等）
+        '''CREATE TABLE IF NOT EXISTS upload_sessions (
+            sid TEXT PRIMARY KEY,
+            status TEXT NOT NULL, -- 'uploading', 'cancelled', 'completed', 'failed'
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+    ]),
+    (4, '后台任务', [
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL, -- 'delete', 'copy', 'move'
+            status TEXT NOT NULL, -- 'queued', 'running', 'cancelling', 'completed', 'failed', 'cancelled'
+            payload TEXT NOT NULL, -- 处理函数的参数和断点（JSON）
+            progress TEXT, -- 最近一次汇报的进度（JSON）
+            result TEXT, -- 结束时的结果（JSON）
+            created_at REAL NOT NULL,
+            started_at REAL, -- 被工作线程认领的时间，NULL 表示等待认领
+            heartbeat_at REAL,
+            finished_at REAL
+        )''',
+        # 工作线程认领：started_at IS NULL AND status IN (...) ORDER BY created_at
+        'CREATE INDEX IF NOT EXISTS idx_jobs_started_status ON jobs (started_at, status, created_at)',
+        # GET /jobs: WHERE user_id = ? ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs (user_id, created_at)',
+    ]),
+    (5, '回收站', [
+        '''CREATE TABLE IF NOT EXISTS trash_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            root TEXT NOT NULL, -- 存储根目录（绝对路径），项目保存在 root/.trash/stored_name
+            path TEXT NOT NULL, -- 删除前相对于 root 的路径，恢复到这里
+            stored_name TEXT NOT NULL,
+            is_dir BOOLEAN NOT NULL,
+            size INTEGER, -- 文件夹在清理线程计算之前为 NULL
+            usage_user_id INTEGER, -- 清理时扣减哪个用户的账本，NULL 表示不记账
+            deleted_by INTEGER NOT NULL,
+            deleted_at REAL NOT NULL,
+            purge_started_at REAL -- 正在被清理（认领时间），NULL 表示仍在回收站中
+        )''',
+        # 回收站页面: WHERE root = ? ORDER BY deleted_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_trash_root_deleted ON trash_items (root, deleted_at)',
+        # 清理线程: WHERE deleted_at < ? ORDER BY deleted_at
+        'CREATE INDEX IF NOT EXISTS idx_trash_deleted ON trash_items (deleted_at)',
+    ]),
+    (6, '临时文件登记', [
+        '''CREATE TABLE IF NOT EXISTS temp_files (
+            path TEXT PRIMARY KEY, -- 绝对路径
+            host TEXT NOT NULL, -- 创建它的主机名和进程号，用于判断进程是否已经退出
+            pid INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )''',
+        # 定期清理: WHERE created_at < ?
+        'CREATE INDEX IF NOT EXISTS idx_temp_files_created ON temp_files (created_at)',
+    ]),
+    (7, '去重存储 blob 登记', [
+        '''CREATE TABLE IF NOT EXISTS dedup_blobs (
+            digest TEXT PRIMARY KEY, -- SHA-256，blob 路径由它得出
+            size INTEGER NOT NULL,
+            ino INTEGER NOT NULL, -- blob 的 inode，删除用户文件时据此找到对应的 blob
+            created_at REAL NOT NULL
+        )''',
+        # 回收候选: WHERE ino IN (...)
+        'CREATE INDEX IF NOT EXISTS idx_dedup_blobs_ino ON dedup_blobs (ino)',
+    ]),
+]
+
+def apply_schema_migrations(conn):
+    """执行尚未应用的数据库结构迁移，每个迁移在单独的事务中完成"""
+    cursor = conn.cursor()
+    current_version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    applied = False
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            cursor.execute('BEGIN')
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied = True
+        print(f"Applied schema migration {version}: {description}")
+    if applied:
+        # 更新查询规划器使用的统计信息
+        cursor.execute('ANALYZE')
+        conn.commit()
+
+# 文件名搜索的 trigram 全文索引是否可用（见 init_search_fts）
+SEARCH_FTS_AVAILABLE = False
+
+def init_search_fts(conn):
+    """创建文件名的 trigram 全文索引（SQLite 3.34+ 且启用 FTS5），不可用时退化为 LIKE 扫描"""
+    global SEARCH_FTS_AVAILABLE
+    try:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_index_fts'").fetchone()
+        if not exists:
+            conn.execute('BEGIN')
+            conn.execute('''CREATE VIRTUAL TABLE file_index_fts USING fts5(
+                name, content='file_index', content_rowid='id', tokenize='trigram')''')
+            conn.execute('''CREATE TRIGGER file_index_ai AFTER INSERT ON file_index BEGIN
+                INSERT INTO file_index_fts (rowid, name) VALUES (new.id, new.name);
+            END''')
+            conn.execute('''CREATE TRIGGER file_index_ad AFTER DELETE ON file_index BEGIN
+                INSERT INTO file_index_fts (file_index_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            END''')
+            conn.execute('''CREATE TRIGGER file_index_au AFTER UPDATE ON file_index BEGIN
+                INSERT INTO file_index_fts (file_index_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                INSERT INTO file_index_fts (rowid, name) VALUES (new.id, new.name);
+            END''')
+            # 为已有记录建立索引
+            conn.execute("INSERT INTO file_index_fts (file_index_fts) VALUES ('rebuild')")
+            conn.commit()
+            print("Search index 'file_index_fts' created.")
+        SEARCH_FTS_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        print(f'FTS5 trigram search unavailable, falling back to LIKE scans: {e}')
+
+# --- 服务器运行方式 ---
+# config.yaml 的 server 块选择运行方式：
+#   async_mode: threading（线程）、eventlet 或 gevent（协程，适合大量空闲的 WebSocket 连接，
+#               但 SQLite、磁盘读写和图片处理会阻塞整个事件循环）
+#   gunicorn:   false 时使用内置服务器（threading 下为 Werkzeug 开发服务器）；true 时由 gunicorn 运行，
+#               threading 对应 gthread worker（workers 个进程 × threads 个线程），eventlet/gevent 对应同名 worker
+# 多个 worker 进程时，上传进度等 Socket.IO 消息需要通过 message_queue 在进程间转发：
+#   redis:// kafka:// zmq:// amqp:// 等由 python-socketio 提供（需要安装对应的客户端库）；
+#   sqlite://<文件路径> 使用本机的 SQLite 文件（见 SQLiteMessageQueue），同一台机器上的多个进程无需额外服务。
+# 上传会话状态也需要共享，见 upload_state_backend。
+SERVER_DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 5000,
+    'debug': True,
+    'async_mode': 'threading',
+    'gunicorn': False,
+    'workers': 1,
+    'threads': 16,
+    'worker_connections': 1000,
+    'timeout': 300,
+    'message_queue': None,
+}
+SERVER_ASYNC_MODES = {'threading', 'eventlet', 'gevent'}
+
+def get_server_settings():
+    """返回 server 配置块，未配置的项使用默认值"""
+    server = dict(SERVER_DEFAULTS)
+    server.update(app.config['GRACEDISK_CONFIG'].get('server') or {})
+    if server['async_mode'] not in SERVER_ASYNC_MODES:
+        raise ValueError(f"server.async_mode must be one of {sorted(SERVER_ASYNC_MODES)}, got {server['async_mode']!r}")
+    return server
+
+# SQLite 消息队列每个进程的轮询间隔（秒）和消息保留时间（秒）
+MESSAGE_QUEUE_POLL_INTERVAL = 0.05
+MESSAGE_QUEUE_RETENTION = 60
+
+class SQLiteMessageQueue(python_socketio.PubSubManager):
+    """以 SQLite 文件作为 Socket.IO 消息队列
+
+    每条消息插入 messages 表，各进程的监听线程按自增 id 轮询读取新消息；
+    适合同一台机器上的多个 worker 进程，延迟约为 MESSAGE_QUEUE_POLL_INTERVAL。
+    """
+    name = 'sqlite'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len('sqlite://'):]
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # 消息只需要在进程间传递，不需要在断电后保留
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )''')
+            self._local.conn = conn
+        return conn
+
+    def _publish(self, data):
+        self._connect().execute('INSERT INTO messages (channel, data, created_at) VALUES (?, ?, ?)',
+                                (self.channel, self.json.dumps(data), time.time()))
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        next_purge = time.monotonic() + MESSAGE_QUEUE_RETENTION
+        while True:
+            rows = conn.execute('SELECT id, data FROM messages WHERE id > ? AND channel = ? ORDER BY id',
+                                (last_id, self.channel)).fetchall()
+            for message_id, data in rows:
+                last_id = message_id
+                yield data
+            if time.monotonic() >= next_purge:
+                next_purge = time.monotonic() + MESSAGE_QUEUE_RETENTION
+                conn.execute('DELETE FROM messages WHERE created_at < ?', (time.time() - MESSAGE_QUEUE_RETENTION,))
+            time.sleep(MESSAGE_QUEUE_POLL_INTERVAL)
+
+def init_server():
+    """按配置的并发模型初始化 SocketIO"""
+    server = get_server_settings()
+    options = {}
+    message_queue = server['message_queue'] or None
+    if message_queue and message_queue.startswith('sqlite://'):
+        options['client_manager'] = SQLiteMessageQueue(message_queue)
+        message_queue = None
+    socketio.init_app(app, cors_allowed_origins="*", async_mode=server['async_mode'],
+                      message_queue=message_queue, **options)
+
 app.config['GRACEDISK_CONFIG'] = load_config()
+init_server()
 
 # 在应用启动前执行数据库初始化
 init_db()
 
+# --- 上传会话状态 ---
+# 以 Socket.IO 连接 ID 为键，记录该连接当前上传的状态（uploading / cancelled / completed / failed）、
+# 临时文件路径等。HTTP 上传请求写入，断开连接和页面关闭事件据此取消上传、清理临时文件。
+# 多个 worker 进程时上传请求和 Socket.IO 连接可能由不同进程处理，需要 upload_state_backend: sqlite。
+
+class MemoryUploadSessions:
+    """保存在当前进程内的上传会话（默认，适用于单进程）"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """返回会话信息的副本（包含 status），不存在时返回 None"""
+        with self._lock:
+            info = self._sessions.get(sid)
+            return dict(info) if info is not None else None
+
+    def set(self, sid, info):
+        with self._lock:
+            self._sessions[sid] = dict(info, updated_at=time.time())
+
+    def update(self, sid, **fields):
+        with self._lock:
+            if sid in self._sessions:
+                self._sessions[sid].update(fields, updated_at=time.time())
+
+    def set_status(self, sid, status, only_if):
+        """会话状态为 only_if 时改为 status，返回是否修改"""
+        with self._lock:
+            info = self._sessions.get(sid)
+            if info is None or info['status'] != only_if:
+                return False
+            info.update(status=status, updated_at=time.time())
+            return True
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def purge(self, max_age):
+        """删除超过 max_age 秒没有更新的会话（进程异常退出等原因遗留的记录）"""
+        cutoff = time.time() - max_age
+        with self._lock:
+            for sid in [sid for sid, info in self._sessions.items() if info['updated_at'] < cutoff]:
+                del self._sessions[sid]
+
+class SQLiteUploadSessions:
+    """保存在数据库 upload_sessions 表中的上传会话，所有 worker 进程共享"""
+
+    def get(self, sid):
+        row = get_db().execute('SELECT status, data FROM upload_sessions WHERE sid = ?', (sid,)).fetchone()
+        if row is None:
+            return None
+        return dict(json.loads(row['data']), status=row['status'])
+
+    def set(self, sid, info):
+        info = dict(info)
+        status = info.pop('status')
+        conn = get_db()
+        conn.execute('INSERT OR REPLACE INTO upload_sessions (sid, status, data, updated_at) VALUES (?, ?, ?, ?)',
+                     (sid, status, json.dumps(info), time.time()))
+        conn.commit()
+
+    def update(self, sid, **fields):
+        conn = get_db()
+        status = fields.pop('status', None)
+        # json_patch 在 SQLite 中合并字段，不需要先读出再写回
+        conn.execute('''UPDATE upload_sessions
+                        SET status = COALESCE(?, status), data = json_patch(data, ?), updated_at = ?
+                        WHERE sid = ?''', (status, json.dumps(fields), time.time(), sid))
+        conn.commit()
+
+    def set_status(self, sid, status, only_if):
+        conn = get_db()
+        cursor = conn.execute('UPDATE upload_sessions SET status = ?, updated_at = ? WHERE sid = ? AND status = ?',
+                              (status, time.time(), sid, only_if))
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def delete(self, sid):
+        conn = get_db()
+        conn.execute('DELETE FROM upload_sessions WHERE sid = ?', (sid,))
+        conn.commit()
+
+    def purge(self, max_age):
+        conn = get_db()
+        conn.execute('DELETE FROM upload_sessions WHERE updated_at < ?', (time.time() - max_age,))
+        conn.commit()
+
+UPLOAD_STATE_BACKENDS = {'memory': MemoryUploadSessions, 'sqlite': SQLiteUploadSessions}
+
+def create_upload_sessions():
+    backend = app.config['GRACEDISK_CONFIG'].get('upload_state_backend', 'memory')
+    if backend not in UPLOAD_STATE_BACKENDS:
+        raise ValueError(f"upload_state_backend must be one of {sorted(UPLOAD_STATE_BACKENDS)}, got {backend!r}")
+    return UPLOAD_STATE_BACKENDS[backend]()
+
+upload_sessions = create_upload_sessions()
+
 
 # 仅限管理员访问的装饰器
 def admin_required(f):
@@ -336,6 +1045,695 @@ def password_change_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- 目录列表缓存 ---
+# 以目录绝对路径为键缓存排序好的列表，目录的 mtime/inode 变化即视为失效。
+# 本程序自身修改文件（上传、删除、重命名等）后会主动调用 invalidate_listing。
+# 目录 mtime 距今不足 LISTING_RACY_WINDOW 秒时不复用缓存：同一时间粒度内的后续修改可能不会改变 mtime。
+LISTING_CACHE_MAX_DIRS = 256
+LISTING_CACHE_MAX_ENTRIES = 200000
+LISTING_RACY_WINDOW = 2.0
+_listing_cache = OrderedDict()
+_listing_cache_entries = 0
+_listing_cache_lock = threading.Lock()
+
+def _scan_directory(dir_path):
+    """用 os.scandir 读取目录，返回按文件夹优先、名称排序的条目列表"""
+    items = []
+    hidden = system_dir_names()
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.name in hidden and is_system_dir(entry.path):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                # 忽略无法访问的文件/文件夹
+                continue
+            items.append({
+                'name': entry.name,
+                'is_dir': is_dir,
+                'size': stat.st_size if not is_dir else '-',
+                'mtime': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+                'version': None if is_dir else file_etag(stat)
+            })
+    # 按类型（文件夹优先）和名称排序
+    items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    return items
+
+# 支持的排序方式，文件夹始终排在文件前面
+LISTING_SORT_KEYS = {
+    'name': lambda x: x['name'].lower(),
+    'size': lambda x: (0 if x['is_dir'] else x['size'], x['name'].lower()),
+    'mtime': lambda x: (x['mtime'], x['name'].lower()),
+}
+
+def _sort_listing(items, sort, reverse):
+    key = LISTING_SORT_KEYS[sort]
+    dirs = sorted((x for x in items if x['is_dir']), key=key, reverse=reverse)
+    files = sorted((x for x in items if not x['is_dir']), key=key, reverse=reverse)
+    return dirs + files
+
+def get_listing(dir_path, sort='name', reverse=False):
+    """返回 (版本号, 条目列表)，优先使用缓存。版本号在目录内容变化后改变。
+    返回的列表是共享的，调用方不能修改"""
+    global _listing_cache_entries
+    key = os.path.abspath(dir_path)
+    dir_stat = os.stat(key)
+    version = f'{dir_stat.st_ino:x}-{dir_stat.st_mtime_ns:x}'
+    with _listing_cache_lock:
+        cached = _listing_cache.get(key)
+        if cached is not None and cached[0] == version:
+            _listing_cache.move_to_end(key)
+            views = cached[1]
+            if (sort, reverse) in views:
+                return version, views[(sort, reverse)]
+            items = views[('name', False)]
+        else:
+            cached = None
+
+    if cached is None:
+        items = _scan_directory(key)
+    view = items if (sort, reverse) == ('name', False) else _sort_listing(items, sort, reverse)
+    if time.time() - dir_stat.st_mtime < LISTING_RACY_WINDOW:
+        return version, view
+
+    with _listing_cache_lock:
+        if cached is not None and _listing_cache.get(key) is cached:
+            # 同一份列表的其他排序视图
+            cached[1][(sort, reverse)] = view
+            return version, view
+        old = _listing_cache.pop(key, None)
+        if old is not None:
+            _listing_cache_entries -= len(old[1][('name', False)])
+        _listing_cache[key] = (version, {('name', False): items, (sort, reverse): view})
+        _listing_cache_entries += len(items)
+        # 按最近最少使用淘汰，同时限制目录数和条目总数
+        while len(_listing_cache) > 1 and (len(_listing_cache) > LISTING_CACHE_MAX_DIRS
+                                           or _listing_cache_entries > LISTING_CACHE_MAX_ENTRIES):
+            _, (_, evicted) = _listing_cache.popitem(last=False)
+            _listing_cache_entries -= len(evicted[('name', False)])
+    return version, view
+
+def list_directory(dir_path):
+    """返回目录的条目列表（按名称排序，文件夹在前）"""
+    return get_listing(dir_path)[1]
+
+def invalidate_listing(*paths):
+    """文件或文件夹被修改后调用：清除其所在目录以及（删除文件夹时）其下所有目录的缓存"""
+    global _listing_cache_entries
+    with _listing_cache_lock:
+        for path in paths:
+            target = os.path.abspath(path)
+            parent = os.path.dirname(target)
+            prefix = target + os.sep
+            for key in [k for k in _listing_cache if k == target or k == parent or k.startswith(prefix)]:
+                _listing_cache_entries -= len(_listing_cache.pop(key)[1][('name', False)])
+
+# --- 分页列表 ---
+# 文件列表由前端按需分页加载（虚拟滚动），每页条目用数组表示以减小 JSON 体积，字段顺序见 LIST_FIELDS。
+# 游标为 "偏移量:目录版本"，目录内容变化后旧游标失效，客户端需要重新加载。
+LIST_PAGE_SIZE = 200
+LIST_MAX_PAGE_SIZE = 1000
+LIST_FIELDS = ['name', 'is_dir', 'size', 'mtime', 'icon', 'type', 'version']
+
+def listing_page(dir_path, sort='name', reverse=False, offset=0, limit=LIST_PAGE_SIZE):
+    """返回目录列表的一页（/api/list 的响应内容）"""
+    version, items = get_listing(dir_path, sort, reverse)
+    helpers = inject_icon_map()
+    get_icon, get_file_type = helpers['get_icon'], helpers['get_file_type']
+    entries = []
+    for item in items[offset:offset + limit]:
+        is_dir = item['is_dir']
+        file_type = 'dir' if is_dir else get_file_type(item['name'])
+        entries.append([
+            item['name'],
+            is_dir,
+            None if is_dir else item['size'],
+            item['mtime'],
+            get_icon(item['name'], is_dir),
+            file_type,
+            # 文件版本只有图片需要（缩略图 URL），其余条目省略以减小响应
+            item['version'] if file_type == 'image' else None,
+        ])
+    next_offset = offset + len(entries)
+    return {
+        'success': True,
+        'version': version,
+        'total': len(items),
+        'offset': offset,
+        'sort': sort,
+        'order': 'desc' if reverse else 'asc',
+        'fields': LIST_FIELDS,
+        'entries': entries,
+        'next_cursor': f'{next_offset}:{version}' if next_offset < len(items) else None,
+    }
+
+# --- 文件名搜索索引 ---
+# 每个存储根目录（storage_path、visitor_storage_path、userfiles/<用户名>）的文件和文件夹记录在 file_index 表中，
+# 首次搜索时后台全量扫描一次，之后由修改文件的路由通过 paths_changed 增量更新；
+# 文件夹中的内容在 delayed_tasks 线程中重新遍历，请求中只删除旧记录。
+# 子串搜索使用 FTS5 trigram 索引（至少 3 个字符），前缀搜索使用 (root, name) 索引。
+SEARCH_CRAWL_BATCH = 5000
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+_search_roots = None
+_crawling_roots = set()
+_search_reindex_pending = set()
+_search_reindex_scheduled = False
+_search_roots_lock = threading.Lock()
+
+def _load_search_roots():
+    global _search_roots
+    with _search_roots_lock:
+        if _search_roots is None:
+            rows = get_db().execute("SELECT root FROM file_index_roots").fetchall()
+            _search_roots = {row['root'] for row in rows}
+        return _search_roots
+
+def _index_row(root, full_path, entry_stat, is_dir):
+    rel = os.path.relpath(full_path, root).replace(os.sep, '/')
+    return (root, rel, os.path.basename(full_path), is_dir,
+            None if is_dir else entry_stat.st_size, entry_stat.st_mtime)
+
+def _insert_index_rows(cursor, rows):
+    cursor.executemany("""
+        INSERT INTO file_index (root, path, name, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(root, path) DO UPDATE SET
+            name = excluded.name, is_dir = excluded.is_dir, size = excluded.size, mtime = excluded.mtime
+    """, rows)
+
+def _delete_index_subtree(cursor, root, rel):
+    # 'a/b/' 到 'a/b0' 之间正好是 a/b 下的所有路径（'0' 是 '/' 的下一个字符），可以走唯一索引
+    cursor.execute("""
+        DELETE FROM file_index WHERE root = ? AND (path = ? OR (path >= ? AND path < ?))
+    """, (root, rel, rel + '/', rel + '0'))
+
+def _iter_index_rows(root, top):
+    """遍历 top（含）下的所有文件和文件夹，生成索引记录"""
+    if top != root:
+        yield _index_row(root, top, os.stat(top), True)
+    hidden = system_dir_names()
+    stack = [top]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.name in hidden and is_system_dir(entry.path):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        yield _index_row(root, entry.path, entry.stat(follow_symlinks=False), is_dir)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        stack.append(entry.path)
+        except OSError:
+            continue
+
+def crawl_search_root(root):
+    """全量重建一个存储根目录的搜索索引"""
+    root = os.path.abspath(root)
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO file_index_roots (root, status) VALUES (?, 'indexing')
+        ON CONFLICT(root) DO UPDATE SET status = 'indexing'
+    """, (root,))
+    cursor.execute("DELETE FROM file_index WHERE root = ?", (root,))
+    conn.commit()
+    _load_search_roots().add(root)
+
+    start = time.time()
+    count = 0
+    batch = []
+    for row in _iter_index_rows(root, root):
+        batch.append(row)
+        if len(batch) >= SEARCH_CRAWL_BATCH:
+            _insert_index_rows(cursor, batch)
+            conn.commit()
+            count += len(batch)
+            batch = []
+    _insert_index_rows(cursor, batch)
+    count += len(batch)
+    cursor.execute("UPDATE file_index_roots SET status = 'ready', indexed_at = CURRENT_TIMESTAMP WHERE root = ?", (root,))
+    conn.commit()
+    print(f'Search index built for {root}: {count} entries in {time.time() - start:.1f}s')
+
+def _start_search_crawl(root):
+    """在后台线程中全量扫描根目录，已有扫描在进行时不重复启动"""
+    with _search_roots_lock:
+        if root in _crawling_roots:
+            return
+        _crawling_roots.add(root)
+
+    def crawl():
+        try:
+            crawl_search_root(root)
+        except Exception as e:
+            print(f'Search index crawl failed for {root}: {e}')
+        finally:
+            with _search_roots_lock:
+                _crawling_roots.discard(root)
+
+    crawl_thread = threading.Thread(target=crawl)
+    crawl_thread.daemon = True
+    crawl_thread.start()
+
+def ensure_search_root(root):
+    """返回根目录的索引状态，尚未建立索引时在后台开始全量扫描"""
+    root = os.path.abspath(root)
+    row = get_db().execute("SELECT status FROM file_index_roots WHERE root = ?", (root,)).fetchone()
+    if row is not None:
+        return row['status']
+    _start_search_crawl(root)
+    return 'indexing'
+
+def rescan_search_roots(top):
+    """重新扫描 top 及其下所有已建立索引的根目录（无法得知具体变化时使用）"""
+    top = os.path.abspath(top)
+    for root in list(_load_search_roots()):
+        if root == top or root.startswith(top + os.sep):
+            _start_search_crawl(root)
+
+def update_search_index(*paths):
+    """文件或文件夹被创建、删除、重命名后更新搜索索引（只处理已建立索引的根目录）"""
+    roots = _load_search_roots()
+    if not roots:
+        return
+    conn = get_db()
+    cursor = conn.cursor()
+    for path in paths:
+        full_path = os.path.abspath(path)
+        for root in list(roots):
+            if full_path == root and not os.path.exists(root):
+                # 根目录本身被删除（如删除用户），丢弃整个索引
+                cursor.execute("DELETE FROM file_index WHERE root = ?", (root,))
+                cursor.execute("DELETE FROM file_index_roots WHERE root = ?", (root,))
+                roots.discard(root)
+                continue
+            if not full_path.startswith(root + os.sep):
+                continue
+            rel = os.path.relpath(full_path, root).replace(os.sep, '/')
+            top = rel.split('/', 1)[0]
+            if top in system_dir_names() and is_system_dir(os.path.join(root, top)):
+                continue
+            _delete_index_subtree(cursor, root, rel)
+            if os.path.isdir(full_path):
+                # 文件夹本身立即写入，其中的内容交给后台线程遍历，避免移动或复制大文件夹时阻塞请求
+                _insert_index_rows(cursor, [_index_row(root, full_path, os.stat(full_path), True)])
+                _schedule_search_reindex(root, full_path)
+            elif os.path.exists(full_path):
+                _insert_index_rows(cursor, [_index_row(root, full_path, os.stat(full_path), False)])
+    conn.commit()
+
+def _schedule_search_reindex(root, full_path):
+    """稍后在后台线程中重新索引文件夹 full_path 下的内容，短时间内的多次请求合并处理"""
+    global _search_reindex_scheduled
+    with _search_roots_lock:
+        _search_reindex_pending.add((root, full_path))
+        if _search_reindex_scheduled:
+            return
+        _search_reindex_scheduled = True
+    delayed_tasks.call_later(0, _run_search_reindex)
+
+def _run_search_reindex():
+    global _search_reindex_scheduled, _search_reindex_pending
+    with _search_roots_lock:
+        _search_reindex_scheduled = False
+        pending, _search_reindex_pending = _search_reindex_pending, set()
+    conn = get_db()
+    cursor = conn.cursor()
+    for root, full_path in sorted(pending):
+        if root not in _load_search_roots() or not os.path.isdir(full_path):
+            continue
+        batch = []
+        for row in _iter_index_rows(root, full_path):
+            batch.append(row)
+            if len(batch) >= SEARCH_CRAWL_BATCH:
+                _insert_index_rows(cursor, batch)
+                conn.commit()
+                batch = []
+        _insert_index_rows(cursor, batch)
+        if not os.path.isdir(full_path):
+            # 遍历期间文件夹被删除或移走，丢弃刚写入的记录（新位置由对应的 paths_changed 处理）
+            _delete_index_subtree(cursor, root, os.path.relpath(full_path, root).replace(os.sep, '/'))
+        conn.commit()
+
+def search_files(root, query, mode='substring', limit=SEARCH_DEFAULT_LIMIT):
+    """在根目录的索引中按文件名搜索，返回 (结果行, 是否被截断)"""
+    root = os.path.abspath(root)
+    cursor = get_db().cursor()
+    like_escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if mode == 'prefix':
+        cursor.execute("""
+            SELECT path, name, is_dir, size, mtime FROM file_index
+            WHERE root = ? AND name LIKE ? ESCAPE '\\'
+            ORDER BY name LIMIT ?
+        """, (root, like_escaped + '%', limit + 1))
+    elif SEARCH_FTS_AVAILABLE and len(query) >= 3:
+        fts_query = '"' + query.replace('"', '""') + '"'
+        # CROSS JOIN 固定由全文索引驱动，避免规划器先按 root 扫描整个根目录的记录
+        cursor.execute("""
+            SELECT f.path, f.name, f.is_dir, f.size, f.mtime
+            FROM file_index_fts CROSS JOIN file_index f ON f.id = file_index_fts.rowid
+            WHERE file_index_fts MATCH ? AND f.root = ?
+            LIMIT ?
+        """, (fts_query, root, limit + 1))
+    else:
+        # 少于 3 个字符无法使用 trigram 索引，扫描到足够的结果即停止
+        cursor.execute("""
+            SELECT path, name, is_dir, size, mtime FROM file_index
+            WHERE root = ? AND name LIKE ? ESCAPE '\\'
+            LIMIT ?
+        """, (root, '%' + like_escaped + '%', limit + 1))
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+def paths_changed(*paths):
+    """本程序修改文件系统后调用：使目录列表缓存失效并更新搜索索引"""
+    invalidate_listing(*paths)
+    try:
+        update_search_index(*paths)
+    except Exception as e:
+        # 索引更新失败不影响文件操作本身，下次全量扫描会修正
+        print(f'Failed to update search index: {e}')
+
+# --- 文件系统监视 ---
+# 存储目录也可能被其他程序直接修改，仅靠 paths_changed 无法得知，列表缓存和搜索索引会过期。
+# FileWatcher 在 Linux 上用 inotify 监视每个存储根目录下的所有子目录；系统不支持 inotify，
+# 或 watch 数量达到上限（fs.inotify.max_user_watches）时，该根目录改为定期轮询各子目录的 mtime。
+# 事件在 FS_WATCH_COALESCE_DELAY 内合并去重后以 (changed_paths, rescan_roots) 通知订阅者：
+# changed_paths 中的路径（及其子树）发生了变化；内核事件队列溢出、待处理路径过多或切换到轮询时
+# 无法知道具体变化，改为在 rescan_roots 中通知整个根目录需要重新扫描。
+FS_WATCH_COALESCE_DELAY = 0.5
+FS_WATCH_MAX_PENDING = 10000
+FS_WATCH_READ_SIZE = 64 * 1024
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+FS_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                 | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+class Inotify:
+    """inotify 系统调用的 ctypes 封装，不支持的平台上构造时抛出 OSError"""
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (AttributeError, TypeError) as e:
+            raise OSError(errno.ENOSYS, f'inotify is not available: {e}')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self._init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=FS_WATCH_MASK):
+        """返回 watch 描述符；同一个目录重复添加时返回已有的描述符"""
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """等待最多 timeout 秒，返回 [(wd, mask, name)]"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, FS_WATCH_READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].split(b'\0', 1)[0])
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FileWatcher:
+    """监视存储根目录的变化并合并通知订阅者，见上方说明"""
+
+    def __init__(self, roots, poll_interval=30, coalesce_delay=FS_WATCH_COALESCE_DELAY):
+        roots = sorted({os.path.abspath(r) for r in roots})
+        # 嵌套的根目录只监视最外层
+        self.roots = [r for r in roots if not any(r.startswith(o + os.sep) for o in roots)]
+        self.poll_interval = poll_interval
+        self.coalesce_delay = coalesce_delay
+        self._subscribers = []
+        self._inotify = None
+        self._wd_paths = {}
+        self._poll_roots = set()
+        self._poll_snapshots = {}
+        self._pending = set()
+        self._rescan = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """callback(changed_paths, rescan_roots) 在监视线程中被调用"""
+        self._subscribers.append(callback)
+
+    @property
+    def mode(self):
+        if self._inotify is None:
+            return 'polling'
+        return 'inotify+polling' if self._poll_roots else 'inotify'
+
+    def start(self):
+        try:
+            self._inotify = Inotify()
+        except OSError as e:
+            print(f'inotify unavailable ({e}), polling storage roots every {self.poll_interval}s')
+        for root in self.roots:
+            if self._inotify is None or not self._watch_tree(root):
+                self._start_polling(root)
+        self._rescan.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def _watch_tree(self, top):
+        """为 top 及其所有子目录添加 watch，达到 watch 数量上限时返回 False"""
+        stack = [top]
+        while stack:
+            current = stack.pop()
+            try:
+                self._wd_paths[self._inotify.add_watch(current)] = current
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    return False
+                continue  # 已被删除或无权访问
+            try:
+                with os.scandir(current) as it:
+                    stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        return True
+
+    def _unwatch_tree(self, top):
+        for wd, path in list(self._wd_paths.items()):
+            if path == top or path.startswith(top + os.sep):
+                self._inotify.rm_watch(wd)
+                del self._wd_paths[wd]
+
+    def _start_polling(self, root):
+        if self._inotify is not None:
+            self._unwatch_tree(root)
+            print(f'inotify watch limit reached under {root}, falling back to polling '
+                  f'(raise fs.inotify.max_user_watches to avoid this)')
+        self._poll_roots.add(root)
+        self._poll(root)
+        # 切换期间的变化无法得知
+        self._rescan.add(root)
+
+    def _poll(self, root):
+        """比较各子目录的 (inode, mtime) 和条目名称，把新增/删除的路径加入待通知集合"""
+        seen = set()
+        stack = [root]
+        while stack:
+            current = stack.pop()
+            seen.add(current)
+            try:
+                dir_stat = os.stat(current)
+            except OSError:
+                continue
+            signature = (dir_stat.st_ino, dir_stat.st_mtime_ns)
+            snapshot = self._poll_snapshots.get(current)
+            if snapshot is None or snapshot[0] != signature:
+                names, subdirs = set(), []
+                try:
+                    with os.scandir(current) as it:
+                        for entry in it:
+                            names.add(entry.name)
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                except OSError:
+                    continue
+                if snapshot is not None:
+                    self._pending.update(os.path.join(current, name) for name in names ^ snapshot[1])
+                snapshot = (signature, names, subdirs)
+                self._poll_snapshots[current] = snapshot
+            stack.extend(os.path.join(current, name) for name in snapshot[2])
+        prefix = root + os.sep
+        for path in [p for p in self._poll_snapshots if (p == root or p.startswith(prefix)) and p not in seen]:
+            del self._poll_snapshots[path]
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # 事件已丢失：补上可能漏掉的新目录的 watch，并重新扫描所有根目录
+            for root in self.roots:
+                if root not in self._poll_roots:
+                    if not self._watch_tree(root):
+                        self._start_polling(root)
+                    self._rescan.add(root)
+            return
+        if mask & IN_IGNORED:
+            self._wd_paths.pop(wd, None)
+            return
+        directory = self._wd_paths.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name) if name else directory
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # 新目录中在添加 watch 之前创建的文件由订阅者重新扫描该目录时得到
+            if not self._watch_tree(path):
+                self._start_polling(self._root_of(path))
+        elif mask & IN_MOVE_SELF and not os.path.isdir(directory):
+            # 目录被移出监视范围（在范围内移动时 IN_MOVED_TO 已把 watch 更新到新路径）
+            self._unwatch_tree(directory)
+        self._pending.add(path)
+
+    def _collect_changes(self):
+        """返回合并后的 (changed_paths, rescan_roots) 并清空待处理集合"""
+        rescan = self._rescan
+        kept = set()
+        for path in sorted(self._pending, key=len):
+            root = self._root_of(path)
+            if root is None or root in rescan:
+                continue
+            # 祖先目录已在集合中时其子树会被整体处理
+            parent = path
+            while parent != root and parent not in kept:
+                parent = os.path.dirname(parent)
+            if parent not in kept:
+                kept.add(path)
+        self._pending = set()
+        self._rescan = set()
+        return sorted(kept), sorted(rescan)
+
+    def _dispatch(self):
+        paths, rescan = self._collect_changes()
+        if not paths and not rescan:
+            return
+        for callback in self._subscribers:
+            try:
+                callback(paths, rescan)
+            except Exception as e:
+                print(f'File watcher subscriber error: {e}')
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        deadline = None
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timeout = next_poll - now if self._poll_roots else self.poll_interval
+            if deadline is not None:
+                timeout = min(timeout, deadline - now)
+            timeout = max(timeout, 0)
+            try:
+                if self._inotify is not None:
+                    for wd, mask, name in self._inotify.read_events(timeout):
+                        self._handle_event(wd, mask, name)
+                else:
+                    self._stop.wait(timeout)
+
+                now = time.monotonic()
+                if self._poll_roots and now >= next_poll:
+                    for root in list(self._poll_roots):
+                        self._poll(root)
+                    next_poll = now + self.poll_interval
+
+                if len(self._pending) > FS_WATCH_MAX_PENDING:
+                    # 大批量变化（如复制整个目录树）时不再逐个处理，直接重新扫描涉及的根目录
+                    self._rescan.update(filter(None, map(self._root_of, self._pending)))
+                    self._pending = set()
+                if self._pending or self._rescan:
+                    if deadline is None:
+                        deadline = now + self.coalesce_delay
+                    if now >= deadline:
+                        self._dispatch()
+                        deadline = None
+            except Exception as e:
+                print(f'File watcher error: {e}')
+                time.sleep(1)
+
+fs_watcher = None
+
+def on_external_fs_changes(paths, rescan_roots):
+    """文件系统监视的默认订阅者：使列表缓存失效并更新搜索索引"""
+    if paths:
+        paths_changed(*paths)
+    if rescan_roots:
+        invalidate_listing(*rescan_roots)
+        for root in rescan_roots:
+            rescan_search_roots(root)
+
+def start_fs_watcher():
+    """监视所有存储根目录（管理员、访客和 userfiles），配置 fs_watch: false 时不启动"""
+    global fs_watcher
+    config = app.config['GRACEDISK_CONFIG']
+    if not config.get('fs_watch', True):
+        return None
+    userfiles_dir = config.get('userfiles_path', 'userfiles')
+    os.makedirs(userfiles_dir, exist_ok=True)
+    roots = [config.get('storage_path'), config.get('visitor_storage_path'), userfiles_dir]
+    roots = [r for r in roots if r and os.path.isdir(r)]
+    fs_watcher = FileWatcher(roots, poll_interval=config.get('fs_watch_poll_interval', 30))
+    fs_watcher.subscribe(on_external_fs_changes)
+    fs_watcher.start()
+    return fs_watcher
+
 def _render_file_list(subpath=""):
     """Shared logic for rendering the file list for a given subpath."""
     config = app.config['GRACEDISK_CONFIG']
@@ -365,16 +1763,13 @@ def _render_file_list(subpath=""):
             os.makedirs(base_path)
         
         # 获取用户的配额信息
-        db_path = config.get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (session['user_id'],))
         user_db_info = cursor.fetchone()
-        conn.close()
 
         quota_bytes = user_db_info['quota_gb'] * (1024**3)
-        used_bytes = get_folder_size(base_path)
+        used_bytes = get_user_used_bytes(session['user_id'], session['username'])
         
         storage_info = {
             'is_disk': False, # 标记为用户配额信息
@@ -401,24 +1796,8 @@ def _render_file_list(subpath=""):
         flash("路径不存在！", 'error')
         return redirect(url_for('root'))
 
-    items = []
-    for name in os.listdir(current_path):
-        item_path = os.path.join(current_path, name)
-        try:
-            stat = os.stat(item_path)
-            is_dir = os.path.isdir(item_path)
-            items.append({
-                'name': name,
-                'is_dir': is_dir,
-                'size': stat.st_size if not is_dir else '-',
-                'mtime': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-            })
-        except OSError:
-            # 忽略无法访问的文件/文件夹
-            continue
-    
-    # 按类型（文件夹优先）和名称排序
-    items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    # 首屏数据直接嵌入页面，后续页面由前端通过 /api/list 加载
+    listing = listing_page(current_path)
     
     # 生成面包屑导航
     breadcrumbs = [{"name": "主目录", "path": ""}]
@@ -430,7 +1809,9 @@ def _render_file_list(subpath=""):
                 "path": "/".join(parts[:i+1])
             })
 
-    return render_template('index.html', items=items, storage_info=storage_info, breadcrumbs=breadcrumbs, current_subpath=subpath)
+    return render_template('index.html', listing=listing, storage_info=storage_info, breadcrumbs=breadcrumbs, current_subpath=subpath,
+                           list_page_size=LIST_PAGE_SIZE, list_max_page_size=LIST_MAX_PAGE_SIZE,
+                           trash_enabled=trash_retention_seconds() > 0)
 
 @app.route('/')
 def root():
@@ -457,6 +1838,98 @@ def browse(subpath=""):
     
     return _render_file_list(subpath)
 
+@app.route('/api/list')
+@password_change_required
+def api_list():
+    """分页返回目录条目，支持按名称、大小、修改时间排序"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    config = app.config['GRACEDISK_CONFIG']
+    if session.get('is_admin'):
+        base_path = config.get('storage_path')
+    elif session.get('is_visitor'):
+        base_path = config.get('visitor_storage_path', config.get('storage_path'))
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+        os.makedirs(base_path, exist_ok=True)
+
+    subpath = request.args.get('path', '')
+    safe_subpath = os.path.normpath(subpath).lstrip('.\\/')
+    current_path = os.path.join(base_path, safe_subpath)
+    if not os.path.abspath(current_path).startswith(os.path.abspath(base_path)):
+        return jsonify({'error': '无效路径'}), 400
+    if not os.path.isdir(current_path):
+        return jsonify({'error': '路径不存在'}), 404
+
+    sort = request.args.get('sort', 'name')
+    if sort not in LISTING_SORT_KEYS:
+        return jsonify({'error': f'不支持的排序方式: {sort}'}), 400
+    reverse = request.args.get('order', 'asc') == 'desc'
+
+    try:
+        limit = min(max(int(request.args.get('limit', LIST_PAGE_SIZE)), 1), LIST_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            offset, expected_version = cursor.split(':', 1)
+        else:
+            offset, expected_version = request.args.get('offset', 0), request.args.get('version')
+        offset = max(int(offset), 0)
+    except ValueError:
+        return jsonify({'error': '无效的分页参数'}), 400
+
+    page = listing_page(current_path, sort, reverse, offset, limit)
+    if expected_version and expected_version != page['version']:
+        # 目录在翻页期间发生了变化，之前的偏移量已经不可靠
+        return jsonify({'error': '目录内容已变化，请重新加载', 'version': page['version']}), 409
+    return jsonify(page)
+
+@app.route('/search')
+@password_change_required
+def search():
+    """按文件名搜索当前用户存储根目录下的文件和文件夹"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    config = app.config['GRACEDISK_CONFIG']
+    if session.get('is_admin'):
+        base_path = config.get('storage_path')
+    elif session.get('is_visitor'):
+        base_path = config.get('visitor_storage_path', config.get('storage_path'))
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+        os.makedirs(base_path, exist_ok=True)
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '请输入搜索内容'}), 400
+    mode = request.args.get('mode', 'substring')
+    if mode not in ('substring', 'prefix'):
+        return jsonify({'error': f'不支持的搜索方式: {mode}'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': '无效的 limit 参数'}), 400
+
+    status = ensure_search_root(base_path)
+    start = time.perf_counter()
+    rows, truncated = search_files(base_path, query, mode, limit)
+    results = [{
+        'path': row['path'],
+        'name': row['name'],
+        'is_dir': bool(row['is_dir']),
+        'size': row['size'],
+        'mtime': datetime.fromtimestamp(row['mtime']).strftime('%Y-%m-%d %H:%M:%S') if row['mtime'] else None,
+    } for row in rows]
+    return jsonify({
+        'success': True,
+        'results': results,
+        'truncated': truncated,
+        # 首次建立索引期间结果可能不完整
+        'indexing': status != 'ready',
+        'took_ms': round((time.perf_counter() - start) * 1000, 2),
+    })
+
 
 @app.route('/preview/<path:path>')
 def preview_file(path):
@@ -478,15 +1951,249 @@ def preview_file(path):
     if file_type == 'other':
         return "This file type cannot be previewed.", 400
     
-    # 对于视频文件，使用专门的视频预览页面
-    if file_type == 'video':
-        return render_template('video_preview.html', 
-                             file_path=path, 
-                             filename=filename, 
-                             parent_path=parent_path, 
-                             file_type=file_type)
-    
-    return render_template('preview.html', file_path=path, filename=filename, parent_path=parent_path, file_type=file_type)
+    # 文件版本用于 /filedata 的长期缓存，文件修改后 URL 随之变化
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    elif session.get('is_visitor'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('visitor_storage_path', app.config['GRACEDISK_CONFIG'].get('storage_path'))
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+    file_path = os.path.join(base_path, os.path.normpath(path).lstrip('.\\/'))
+    file_version = None
+    if os.path.abspath(file_path).startswith(os.path.abspath(base_path)):
+        try:
+            file_version = file_etag(os.stat(file_path))
+        except OSError:
+            pass
+    
+    # 对于视频文件，使用专门的视频预览页面
+    if file_type == 'video':
+        return render_template('video_preview.html', 
+                             file_path=path, 
+                             filename=filename, 
+                             parent_path=parent_path, 
+                             file_type=file_type,
+                             file_version=file_version)
+    
+    return render_template('preview.html', file_path=path, filename=filename, parent_path=parent_path,
+                           file_type=file_type, file_version=file_version)
+
+# --- 文件发送引擎 ---
+# /filedata、/download 和 /share/<token> 共用同一套发送逻辑：
+# 真实的 MIME 类型、标准的单区间/多区间（multipart/byteranges）Range 响应，
+# 整文件和单区间交给 WSGI 服务器的 wsgi.file_wrapper（如 gunicorn 会使用 sendfile 零拷贝发送），
+# 服务器不提供 file_wrapper 时按块边界对齐的大块读取。
+
+FILE_SERVE_BLOCK_SIZE = 1024 * 1024  # 每次读取 1MB，并与块边界对齐
+MAX_BYTE_RANGES = 16  # 单个请求最多处理的区间数，超过时返回整个文件
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # URL 中带有版本号的响应可以长期缓存
+
+def file_etag(stat_result):
+    """由 inode、大小和修改时间生成强校验值（不含引号）"""
+    return f'{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}'
+
+def _is_not_modified(etag, mtime):
+    """按 RFC 7232 判断条件请求：有 If-None-Match 时忽略 If-Modified-Since"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+def _if_range_matches(etag, mtime):
+    """If-Range 与当前文件一致时才按 Range 发送部分内容，否则发送整个文件"""
+    if not request.headers.get('If-Range'):
+        return True
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(mtime) == int(if_range.date.timestamp())
+    return False
+
+# Python 默认把 .ts 识别为 Qt 翻译文件，这里按 HLS 分段使用的 MPEG-TS 处理
+mimetypes.add_type('video/mp2t', '.ts')
+
+def guess_mimetype(path):
+    """根据扩展名猜测 MIME 类型"""
+    mimetype, _ = mimetypes.guess_type(path)
+    return mimetype or 'application/octet-stream'
+
+def parse_range_header(range_header, file_size):
+    """
+    解析 Range 请求头，返回按起始位置排序并合并后的 [(start, end), ...]（end 包含在内）。
+    没有 Range 头或格式无效时返回 None（按 RFC 7233 忽略，发送整个文件），
+    所有区间都无法满足时返回空列表。
+    """
+    if not range_header:
+        return None
+    units, _, range_set = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not range_set.strip():
+        return None
+
+    ranges = []
+    for spec in range_set.split(','):
+        spec = spec.strip()
+        match = re.fullmatch(r'(\d*)-(\d*)', spec)
+        if not match or (not match.group(1) and not match.group(2)):
+            return None
+        first, last = match.group(1), match.group(2)
+        if not first:
+            # 后缀区间 bytes=-N：文件最后 N 个字节
+            suffix_length = int(last)
+            if suffix_length == 0 or file_size == 0:
+                continue
+            start, end = max(file_size - suffix_length, 0), file_size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= file_size:
+                continue
+            end = min(int(last), file_size - 1) if last else file_size - 1  # 结束位置不能超过文件末尾
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_BYTE_RANGES:
+        return None
+
+    # 合并重叠或相邻的区间，避免同一段数据被重复发送
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _iter_file_range(f, start, length):
+    """从 start 开始读取 length 字节；首次读取补齐到块边界，之后每次读取一个完整的块"""
+    f.seek(start)
+    remaining = length
+    read_size = min(FILE_SERVE_BLOCK_SIZE - start % FILE_SERVE_BLOCK_SIZE, remaining)
+    while remaining > 0:
+        data = f.read(read_size)
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+        read_size = min(FILE_SERVE_BLOCK_SIZE, remaining)
+
+class _FileRange:
+    """
+    只暴露文件中 [start, start + length) 区间的只读文件对象，交给 wsgi.file_wrapper 使用。
+    read() 不会越过区间末尾；fileno()/tell() 让支持 sendfile 的服务器可以直接零拷贝发送。
+    """
+    def __init__(self, file_path, start, length):
+        self._file = open(file_path, 'rb', buffering=0)
+        self._file.seek(start)
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+def _iter_single_range(file_path, start, length):
+    with open(file_path, 'rb', buffering=0) as f:
+        yield from _iter_file_range(f, start, length)
+
+def _iter_multipart_ranges(file_path, parts, boundary):
+    with open(file_path, 'rb', buffering=0) as f:
+        for part_header, start, end in parts:
+            yield part_header
+            yield from _iter_file_range(f, start, end - start + 1)
+        yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+def _content_disposition(download_name):
+    """生成兼容中文文件名的 Content-Disposition 头"""
+    try:
+        download_name.encode('ascii')
+        return f'attachment; filename="{download_name}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = url_quote(download_name, safe="!#$&+^`|~")
+        return f'attachment; filename="{simple}"; filename*=UTF-8\'\'{quoted}'
+
+def _single_range_response(file_path, start, length, status, headers, mimetype):
+    """发送一段连续数据，优先使用服务器提供的 file_wrapper"""
+    headers['Content-Length'] = str(length)
+    headers['Content-Type'] = mimetype
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        body = file_wrapper(_FileRange(file_path, start, length), FILE_SERVE_BLOCK_SIZE)
+    else:
+        body = _iter_single_range(file_path, start, length)
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+def serve_file(file_path, as_attachment=False, download_name=None, immutable=False):
+    """
+    按请求的 Range 头和条件请求头发送文件，返回 Response。
+    immutable 为 True 时表示 URL 已包含文件版本，允许浏览器长期缓存。
+    """
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    etag = file_etag(stat)
+    mimetype = guess_mimetype(download_name or file_path)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'private, max-age={IMMUTABLE_MAX_AGE}, immutable' if immutable else 'private, no-cache'
+    }
+
+    if _is_not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    if as_attachment:
+        headers['Content-Disposition'] = _content_disposition(download_name or os.path.basename(file_path))
+
+    range_header = request.headers.get('Range')
+    if range_header and not _if_range_matches(etag, stat.st_mtime):
+        range_header = None
+    ranges = parse_range_header(range_header, file_size)
+
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{file_size}'
+        return Response(status=416, headers=headers)
+
+    if ranges is None or (len(ranges) == 1 and ranges[0] == (0, file_size - 1)):
+        # 整个文件：优先使用服务器提供的 file_wrapper
+        return _single_range_response(file_path, 0, file_size, 200, headers, mimetype)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        return _single_range_response(file_path, start, end - start + 1, 206, headers, mimetype)
+
+    # 多个区间：multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for start, end in ranges:
+        part_header = (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+        ).encode('ascii')
+        parts.append((part_header, start, end))
+        content_length += len(part_header) + end - start + 1
+    content_length += len(f'\r\n--{boundary}--\r\n')
+    headers['Content-Length'] = str(content_length)
+    headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    return Response(_iter_multipart_ranges(file_path, parts, boundary), status=206,
+                    headers=headers, direct_passthrough=True)
 
 @app.route('/filedata/<path:path>')
 def get_file_data(path):
@@ -506,62 +2213,540 @@ def get_file_data(path):
     if not os.path.abspath(file_path).startswith(os.path.abspath(base_path)):
         return "Forbidden", 403
     
-    if not os.path.exists(file_path):
+    if not os.path.exists(file_path) or os.path.isdir(file_path):
         return "File not found", 404
 
-    file_size = os.path.getsize(file_path)
-    range_header = request.headers.get('Range', None)
-    
-    start = 0
-    length = file_size
+    # 预览页面在 URL 中带上文件版本（v），版本一致时内容不会再变化
+    version = request.args.get('v')
+    immutable = bool(version) and version == file_etag(os.stat(file_path))
+    return serve_file(file_path, immutable=immutable)
+
+# --- 缩略图 ---
+# 文件列表和预览页面使用缩小后的 WebP（不支持时为 JPEG）图片，而不是原图。
+# 缩略图在第一次请求时由线程池生成（限制同时解码的图片数量，也就限制了内存占用），
+# 保存在 thumbnail_cache_dir 中，文件名是 (绝对路径, 大小, mtime, 尺寸) 的哈希：原图修改后自然换成新文件，
+# 旧文件不再被访问，由按总大小的 LRU 淘汰（命中时更新文件 mtime，重启后按 mtime 恢复顺序）。
+# 原图不大于目标尺寸时不生成缩略图，只在同一位置写一个空的标记文件，与缩略图一起淘汰。
+THUMBNAIL_SIZES = {'small': 64, 'large': 1600}
+THUMBNAIL_ORIGINAL_MARKER = '.orig'
+THUMBNAIL_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WAIT_TIMEOUT = 30
+
+class ThumbnailCache:
+    """缩略图生成线程池和磁盘缓存"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        self._total_bytes = 0
+        self._jobs = {}
+        self._pool = None
+
+    def _setup(self):
+        """首次使用时读取配置并扫描已有的缓存文件（调用方持有锁）"""
+        if self._entries is not None:
+            return
+        config = app.config['GRACEDISK_CONFIG']
+        self.cache_dir = os.path.abspath(config.get('thumbnail_cache_dir', 'thumbnails'))
+        self.max_bytes = config.get('thumbnail_cache_max_mb', 512) * 1024 * 1024
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('thumbnail_workers', 2), thread_name_prefix='thumbnail')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if filename.endswith('.tmp'):
+                        os.remove(path)  # 上次运行中断时留下的临时文件
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        self._entries = OrderedDict((path, size) for _, path, size in files)
+        self._total_bytes = sum(size for _, _, size in files)
+        self._evict()
+
+    def _evict(self):
+        # 至少保留最近使用的一个，刚生成的缩略图还要发送给请求方
+        while len(self._entries) > 1 and self._total_bytes > self.max_bytes:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    if range_header:
-        range_match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-        if range_match:
-            start = int(range_match.group(1))
-            end = range_match.group(2)
-            
-            if end:
-                end = int(end)
-                length = end - start + 1
+    def get(self, file_path, size_name):
+        """返回缩略图文件路径；原图本身不大于目标尺寸时返回 None（直接发送原图）"""
+        stat = os.stat(file_path)
+        key = hashlib.sha256('\0'.join([
+            os.path.abspath(file_path), str(stat.st_size), str(stat.st_mtime_ns), size_name
+        ]).encode('utf-8', 'surrogateescape')).hexdigest()
+
+        with self._lock:
+            self._setup()
+            for ext in ('.webp', '.jpg', THUMBNAIL_ORIGINAL_MARKER):
+                thumb_path = os.path.join(self.cache_dir, key[:2], key + ext)
+                if thumb_path in self._entries:
+                    self._entries.move_to_end(thumb_path)
+                    try:
+                        os.utime(thumb_path)
+                    except OSError:
+                        # 文件已被外部删除，重新生成
+                        self._total_bytes -= self._entries.pop(thumb_path)
+                        continue
+                    return None if ext == THUMBNAIL_ORIGINAL_MARKER else thumb_path
+            # 同一张缩略图只生成一次，并发的请求等待同一个任务
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._pool.submit(self._generate, file_path, THUMBNAIL_SIZES[size_name],
+                                        os.path.join(self.cache_dir, key[:2], key))
+                self._jobs[key] = job
+                job.add_done_callback(lambda _: self._jobs.pop(key, None))
+        return job.result(timeout=THUMBNAIL_WAIT_TIMEOUT)
+
+    def _generate(self, file_path, size, base_path):
+        from PIL import Image, ImageOps, features
+
+        with Image.open(file_path) as img:
+            if img.width <= size and img.height <= size:
+                self._add_entry(self._write_marker(base_path))
+                return None
+            # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，大图的解码时间和内存随之减少
+            img.draft('RGB', (size, size))
+            thumb = ImageOps.exif_transpose(img)
+            thumb.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        has_alpha = thumb.mode in ('RGBA', 'LA') or (thumb.mode == 'P' and 'transparency' in thumb.info)
+        if features.check('webp'):
+            fmt, ext = 'WEBP', '.webp'
+            thumb = thumb.convert('RGBA' if has_alpha else 'RGB')
+        else:
+            fmt, ext = 'JPEG', '.jpg'
+            if has_alpha:
+                # JPEG 不支持透明，铺在白色背景上
+                rgba = thumb.convert('RGBA')
+                thumb = Image.new('RGB', rgba.size, (255, 255, 255))
+                thumb.paste(rgba, mask=rgba.getchannel('A'))
             else:
-                length = file_size - start
-            
-            headers = {
-                'Content-Range': f'bytes {start}-{start + length - 1}/{file_size}',
-                'Accept-Ranges': 'bytes',
-                'Content-Length': str(length),
-                'Content-Type': 'video/mp4' # Or get mimetype dynamically
-            }
-    
-    def generate():
-        with open(file_path, 'rb') as f:
-                    f.seek(start)
-                    remaining = length
-                    while remaining > 0:
-                        chunk_size = min(4096, remaining)
-                        data = f.read(chunk_size)
-                        if not data:
-                            break
-                        yield data
-                        remaining -= len(data)
+                thumb = thumb.convert('RGB')
+
+        thumb_path = base_path + ext
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        temp_path = f'{thumb_path}.{uuid.uuid4().hex[:8]}.tmp'
+        thumb.save(temp_path, fmt, quality=THUMBNAIL_QUALITY)
+        os.replace(temp_path, thumb_path)
+        self._add_entry(thumb_path)
+        return thumb_path
+
+    def _write_marker(self, base_path):
+        """原图不大于目标尺寸：写一个空文件记住这个结论，下次列表时不必再打开原图"""
+        marker_path = base_path + THUMBNAIL_ORIGINAL_MARKER
+        os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+        open(marker_path, 'wb').close()
+        return marker_path
+
+    def _add_entry(self, thumb_path):
+        with self._lock:
+            old_size = self._entries.pop(thumb_path, 0)
+            size_bytes = os.path.getsize(thumb_path)
+            self._entries[thumb_path] = size_bytes
+            self._total_bytes += size_bytes - old_size
+            self._evict()
+
+thumbnail_cache = ThumbnailCache()
+
+@app.route('/thumbnail/<path:path>')
+def get_thumbnail(path):
+    if 'user_id' not in session:
+        return "Forbidden", 403
 
-        return Response(stream_with_context(generate()), status=206, headers=headers)
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    elif session.get('is_visitor'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('visitor_storage_path', app.config['GRACEDISK_CONFIG'].get('storage_path'))
+    else:
+        base_path = os.path.join('userfiles', session['username'])
 
-    # Fallback for non-range requests
-    def generate_full():
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(4096)
-                if not data:
+    safe_path = os.path.normpath(path).lstrip('.\\/')
+    file_path = os.path.join(base_path, safe_path)
+
+    if not os.path.abspath(file_path).startswith(os.path.abspath(base_path)):
+        return "Forbidden", 403
+
+    if not os.path.exists(file_path) or os.path.isdir(file_path):
+        return "File not found", 404
+
+    if file_path.split('.')[-1].lower() not in THUMBNAIL_EXTENSIONS:
+        return "Thumbnail not available", 404
+
+    size_name = request.args.get('size', 'small')
+    if size_name not in THUMBNAIL_SIZES:
+        return "Invalid thumbnail size", 400
+
+    # 与 /filedata 相同：URL 中带有原图版本（v）时允许浏览器长期缓存
+    version = request.args.get('v')
+    immutable = bool(version) and version == file_etag(os.stat(file_path))
+    try:
+        thumb_path = thumbnail_cache.get(file_path, size_name)
+    except ImportError:
+        return "缩略图功能需要安装 Pillow: pip install Pillow", 404
+    except concurrent.futures.TimeoutError:
+        return "Thumbnail generation timed out", 503
+    except Exception as e:
+        # 损坏的图片、超过 Pillow 像素上限的图片等，前端会退回显示图标
+        print(f'Failed to generate thumbnail for {file_path}: {e}')
+        return "Thumbnail not available", 404
+
+    if thumb_path is None:
+        return serve_file(file_path, immutable=immutable)
+    return serve_file(thumb_path, immutable=immutable)
+
+# --- 视频封面和 HLS 转码 ---
+# 配置了 ffmpeg 时，视频预览页面显示从视频中截取的封面，较大的视频在首次预览时排队转码为多种码率的 HLS，
+# 转码完成后由播放器按网速自动切换码率，转码完成前仍直接播放原文件。
+# 转码任务进入有界队列（满时返回 503），由固定数量的工作线程依次执行，ffmpeg 以较低优先级和有限线程数运行，
+# 不会占满 Web 进程所需的 CPU。结果缓存在 video_cache_dir/<键>/ 中，键是 (绝对路径, 大小, mtime) 的哈希，
+# 目录总大小超过 video_cache_max_gb 时按最近访问时间淘汰（正在转码的除外）。
+VIDEO_RENDITIONS = [
+    # (名称, 高度, 视频码率 kbps, 音频码率 kbps)
+    ('360p', 360, 800, 96),
+    ('720p', 720, 2800, 128),
+    ('1080p', 1080, 5000, 192),
+]
+VIDEO_HLS_SEGMENT_SECONDS = 6
+VIDEO_HLS_MIN_BYTES = 50 * 1024 * 1024
+VIDEO_POSTER_WIDTH = 1280
+VIDEO_POSTER_TIMEOUT = 30
+VIDEO_POSTER_CONCURRENCY = 2
+VIDEO_TRANSCODE_NICE = 10
+
+class VideoTranscoder:
+    """调用本地 ffmpeg 生成视频封面和 HLS，管理转码队列和磁盘缓存"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        self._total_bytes = 0
+        self._jobs = {}
+        self._queue = None
+        self._poster_slots = threading.BoundedSemaphore(VIDEO_POSTER_CONCURRENCY)
+        self.ffmpeg = None
+
+    def _setup(self):
+        """首次使用时读取配置、扫描缓存并启动工作线程（调用方持有锁）"""
+        if self._entries is not None:
+            return
+        config = app.config['GRACEDISK_CONFIG']
+        if config.get('video_transcode', True):
+            self.ffmpeg = shutil.which(config.get('ffmpeg_path', 'ffmpeg'))
+        self.cache_dir = os.path.abspath(config.get('video_cache_dir', 'video_cache'))
+        self.max_bytes = config.get('video_cache_max_gb', 20) * 1024 ** 3
+        self.threads = config.get('video_transcode_threads', 2)
+        self._entries = OrderedDict()
+        if self.ffmpeg is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        dirs = []
+        for name in os.listdir(self.cache_dir):
+            key_dir = os.path.join(self.cache_dir, name)
+            hls_dir = os.path.join(key_dir, 'hls')
+            if os.path.isdir(hls_dir) and not os.path.exists(os.path.join(hls_dir, 'complete')):
+                # 上次运行中断的转码
+                shutil.rmtree(hls_dir, ignore_errors=True)
+            try:
+                dirs.append((os.stat(key_dir).st_mtime, name, get_folder_size(key_dir)))
+            except OSError:
+                continue
+        dirs.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in dirs)
+        self._total_bytes = sum(size for _, _, size in dirs)
+        self._evict()
+
+        self._queue = queue.Queue(maxsize=config.get('video_transcode_queue', 8))
+        for _ in range(config.get('video_transcode_workers', 1)):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+
+    @property
+    def available(self):
+        with self._lock:
+            self._setup()
+        return self.ffmpeg is not None
+
+    def _key(self, file_path):
+        stat = os.stat(file_path)
+        key = hashlib.sha256('\0'.join([
+            os.path.abspath(file_path), str(stat.st_size), str(stat.st_mtime_ns)
+        ]).encode('utf-8', 'surrogateescape')).hexdigest()
+        return key, stat
+
+    def _touch(self, key):
+        """记录一次访问（调用方持有锁）"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            try:
+                os.utime(os.path.join(self.cache_dir, key))
+            except OSError:
+                pass
+
+    def _account(self, key):
+        """重新统计一个缓存目录的大小并按需淘汰（调用方持有锁）"""
+        size = get_folder_size(os.path.join(self.cache_dir, key))
+        self._total_bytes += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key in self._jobs:
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def probe(self, file_path):
+        """从 ffmpeg -i 的输出中读取时长、分辨率和是否有音轨"""
+        result = subprocess.run([self.ffmpeg, '-hide_banner', '-nostdin', '-i', file_path],
+                                capture_output=True, text=True, errors='replace', timeout=VIDEO_POSTER_TIMEOUT)
+        info = {'duration': 0.0, 'width': 0, 'height': 0, 'has_audio': False}
+        match = re.search(r'Duration: (\d+):(\d+):([\d.]+)', result.stderr)
+        if match:
+            hours, minutes, seconds = match.groups()
+            info['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        match = re.search(r'Stream #.*?: Video: .*?\b(\d{2,5})x(\d{2,5})\b', result.stderr)
+        if match:
+            info['width'], info['height'] = int(match.group(1)), int(match.group(2))
+            # 手机拍摄的竖屏视频：ffmpeg 解码时会自动旋转
+            if re.search(r'rotation of -?(90|270)', result.stderr):
+                info['width'], info['height'] = info['height'], info['width']
+        info['has_audio'] = re.search(r'Stream #.*?: Audio:', result.stderr) is not None
+        if not info['height']:
+            raise ValueError('no video stream found')
+        return info
+
+    def poster(self, file_path):
+        """返回封面图片路径，需要时截取一帧生成"""
+        key, _ = self._key(file_path)
+        with self._lock:
+            self._setup()
+            poster_path = os.path.join(self.cache_dir, key, 'poster.jpg')
+            if os.path.exists(poster_path):
+                self._touch(key)
+                return poster_path
+
+        if not self._poster_slots.acquire(timeout=VIDEO_POSTER_TIMEOUT):
+            raise TimeoutError('too many poster requests')
+        try:
+            duration = self.probe(file_path)['duration']
+            os.makedirs(os.path.dirname(poster_path), exist_ok=True)
+            temp_path = f'{poster_path}.{uuid.uuid4().hex[:8]}.jpg'
+            # 跳过片头（常见黑屏），视频太短时取第一帧
+            for offset in (min(5.0, duration * 0.1), 0):
+                subprocess.run([
+                    self.ffmpeg, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y',
+                    '-ss', f'{offset:.2f}', '-i', file_path, '-frames:v', '1',
+                    '-vf', f"scale='min({VIDEO_POSTER_WIDTH},iw)':-2", '-q:v', '4', temp_path
+                ], capture_output=True, timeout=VIDEO_POSTER_TIMEOUT)
+                if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
                     break
-                yield data
+            else:
+                raise ValueError('ffmpeg did not produce a frame')
+            os.replace(temp_path, poster_path)
+        finally:
+            self._poster_slots.release()
+
+        with self._lock:
+            self._account(key)
+        return poster_path
+
+    def stream_status(self, file_path):
+        """返回 HLS 状态，尚未转码时加入转码队列：
+        unavailable（未配置 ffmpeg）、direct（文件较小，直接播放）、busy（队列已满）、
+        queued、running、failed、ready（此时 key 用于拼接播放列表地址）"""
+        with self._lock:
+            self._setup()
+        if self.ffmpeg is None:
+            return {'status': 'unavailable'}
+        key, stat = self._key(file_path)
+        if stat.st_size < VIDEO_HLS_MIN_BYTES:
+            return {'status': 'direct'}
+
+        with self._lock:
+            if os.path.exists(os.path.join(self.cache_dir, key, 'hls', 'complete')):
+                self._touch(key)
+                return {'status': 'ready', 'key': key}
+            job = self._jobs.get(key)
+            if job is None:
+                job = {'status': 'queued', 'progress': 0.0, 'error': None}
+                try:
+                    self._queue.put_nowait((key, file_path))
+                except queue.Full:
+                    return {'status': 'busy'}
+                self._jobs[key] = job
+            return {'status': job['status'], 'progress': job['progress'], 'error': job['error']}
+
+    def hls_file(self, key, name):
+        """返回缓存中的 HLS 文件路径，不存在时返回 None"""
+        if not re.fullmatch(r'[0-9a-f]{64}', key) or not re.fullmatch(r'[\w-]+(/[\w-]+)?\.(m3u8|ts)', name):
+            return None
+        path = os.path.join(self.cache_dir, key, 'hls', name)
+        with self._lock:
+            self._setup()
+            if not os.path.isfile(path):
+                return None
+            self._touch(key)
+        return path
+
+    def _worker(self):
+        while True:
+            key, file_path = self._queue.get()
+            job = self._jobs[key]
+            job['status'] = 'running'
+            hls_dir = os.path.join(self.cache_dir, key, 'hls')
+            start = time.time()
+            try:
+                self._transcode(file_path, hls_dir, job)
+                with self._lock:
+                    del self._jobs[key]
+                    self._account(key)
+                print(f'Transcoded {file_path} to HLS in {time.time() - start:.0f}s')
+            except Exception as e:
+                print(f'Failed to transcode {file_path}: {e}')
+                shutil.rmtree(hls_dir, ignore_errors=True)
+                # 保留失败状态，避免每次预览都重新尝试；重启后会再次尝试
+                job.update(status='failed', error=str(e))
+
+    def _transcode(self, file_path, hls_dir, job):
+        info = self.probe(file_path)
+        # 不放大：只生成不高于原视频的码率档位，原视频很小时只生成一档原始分辨率
+        renditions = [r for r in VIDEO_RENDITIONS if r[1] <= info['height']]
+        if not renditions:
+            _, _, video_kbps, audio_kbps = VIDEO_RENDITIONS[0]
+            height = info['height'] - info['height'] % 2
+            renditions = [(f'{height}p', height, video_kbps, audio_kbps)]
+
+        shutil.rmtree(hls_dir, ignore_errors=True)
+        os.makedirs(hls_dir)
+        split = ''.join(f'[v{n}]' for n in range(len(renditions)))
+        filters = [f'[0:v]split={len(renditions)}{split}']
+        command = [self.ffmpeg, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-i', file_path]
+        stream_map = []
+        for n, (name, height, video_kbps, audio_kbps) in enumerate(renditions):
+            filters.append(f'[v{n}]scale=-2:{height}[out{n}]')
+            command += ['-map', f'[out{n}]']
+            if info['has_audio']:
+                command += ['-map', '0:a:0', f'-b:a:{n}', f'{audio_kbps}k']
+            command += [f'-b:v:{n}', f'{video_kbps}k', f'-maxrate:v:{n}', f'{video_kbps * 107 // 100}k',
+                        f'-bufsize:v:{n}', f'{video_kbps * 3 // 2}k']
+            stream_map.append(f'v:{n},a:{n},name:{name}' if info['has_audio'] else f'v:{n},name:{name}')
+        command += [
+            '-filter_complex', ';'.join(filters),
+            '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+            # 每个分段都从关键帧开始，各档位的分段边界一致，播放器才能无缝切换
+            '-force_key_frames', f'expr:gte(t,n_forced*{VIDEO_HLS_SEGMENT_SECONDS})', '-sc_threshold', '0',
+            '-c:a', 'aac', '-ac', '2',
+            '-threads', str(self.threads),
+            '-f', 'hls', '-hls_time', str(VIDEO_HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(hls_dir, '%v', 'seg_%05d.ts'),
+            '-master_pl_name', 'master.m3u8', '-var_stream_map', ' '.join(stream_map),
+            '-progress', 'pipe:1', '-nostats',
+            os.path.join(hls_dir, '%v', 'index.m3u8'),
+        ]
+
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors, text=True)
+            if hasattr(os, 'setpriority'):
+                try:
+                    os.setpriority(os.PRIO_PROCESS, process.pid, VIDEO_TRANSCODE_NICE)
+                except OSError:
+                    pass
+            for line in process.stdout:
+                if line.startswith('out_time_us=') and info['duration']:
+                    try:
+                        job['progress'] = min(int(line.split('=', 1)[1]) / 1e6 / info['duration'], 1.0)
+                    except ValueError:
+                        pass
+            if process.wait() != 0:
+                errors.seek(0)
+                message = errors.read().decode('utf-8', 'replace').strip().splitlines()
+                raise RuntimeError(f'ffmpeg exited with {process.returncode}: {message[-1] if message else ""}')
+        open(os.path.join(hls_dir, 'complete'), 'w').close()
 
-    headers = {
-        'Content-Length': str(file_size),
-        'Content-Type': 'video/mp4' # Or get mimetype dynamically
-    }
-    return Response(stream_with_context(generate_full()), headers=headers)
+video_transcoder = VideoTranscoder()
+
+def _video_file_path(path):
+    """视频相关路由共用：返回当前用户可访问的视频文件路径，无权访问或不存在时返回 None"""
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    elif session.get('is_visitor'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('visitor_storage_path', app.config['GRACEDISK_CONFIG'].get('storage_path'))
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+
+    safe_path = os.path.normpath(path).lstrip('.\\/')
+    file_path = os.path.join(base_path, safe_path)
+    if not os.path.abspath(file_path).startswith(os.path.abspath(base_path)):
+        return None
+    if not os.path.isfile(file_path) or file_path.split('.')[-1].lower() not in {'mp4', 'webm', 'mov'}:
+        return None
+    return file_path
+
+@app.route('/video_poster/<path:path>')
+def get_video_poster(path):
+    if 'user_id' not in session:
+        return "Forbidden", 403
+    file_path = _video_file_path(path)
+    if file_path is None:
+        return "File not found", 404
+    if not video_transcoder.available:
+        return "Poster not available", 404
+
+    version = request.args.get('v')
+    immutable = bool(version) and version == file_etag(os.stat(file_path))
+    try:
+        poster_path = video_transcoder.poster(file_path)
+    except (TimeoutError, subprocess.TimeoutExpired):
+        return "Poster generation timed out", 503
+    except Exception as e:
+        print(f'Failed to generate poster for {file_path}: {e}')
+        return "Poster not available", 404
+    return serve_file(poster_path, immutable=immutable)
+
+@app.route('/video_stream/<path:path>')
+def get_video_stream(path):
+    """查询视频的 HLS 状态，尚未转码时排队转码"""
+    if 'user_id' not in session:
+        return jsonify({'error': '未登录'}), 401
+    file_path = _video_file_path(path)
+    if file_path is None:
+        return jsonify({'error': '文件不存在'}), 404
+
+    result = video_transcoder.stream_status(file_path)
+    if result['status'] == 'busy':
+        return jsonify({'success': False, 'status': 'busy', 'error': '转码队列已满，请稍后重试'}), 503, {'Retry-After': '60'}
+    key = result.pop('key', None)
+    if key:
+        result['playlist'] = url_for('get_hls_file', key=key, name='master.m3u8')
+    return jsonify({'success': True, **result})
+
+@app.route('/hls/<key>/<path:name>')
+def get_hls_file(key, name):
+    # 键只能从 /video_stream 获得，该路由已检查过文件访问权限
+    if 'user_id' not in session:
+        return "Forbidden", 403
+    file_path = video_transcoder.hls_file(key, name)
+    if file_path is None:
+        return "File not found", 404
+    # 转码完成后分段不会再变化
+    return serve_file(file_path, immutable=name.endswith('.ts'))
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
@@ -589,7 +2774,7 @@ def download_file(filename):
     
     # download_file 函数不再记录下载操作，记录逻辑移至前端点击时
 
-    return send_file(file_path, as_attachment=True)
+    return serve_file(file_path, as_attachment=True)
 
 @app.route('/delete/<path:path>')
 def delete_item(path):
@@ -621,12 +2806,15 @@ def delete_item(path):
         flash('文件或文件夹不存在', 'error')
         return redirect(request.referrer or url_for('root'))
 
+    # 移入回收站（或由后台任务删除）后立即返回，账本在文件真正删除时扣减
     try:
-        if os.path.isdir(item_path):
-            shutil.rmtree(item_path)
+        is_dir = os.path.isdir(item_path)
+        _, errors, _ = delete_items(session['user_id'], base_path, [(safe_path, item_path)], session_usage_user_id())
+        if errors:
+            raise OSError(errors[0])
+        if is_dir:
             flash(f"文件夹 '{os.path.basename(item_path)}' 已被删除", 'success')
         else:
-            os.remove(item_path)
             flash(f"文件 '{os.path.basename(item_path)}' 已被删除", 'success')
     except OSError as e:
         flash(f"删除失败: {e}", 'error')
@@ -641,114 +2829,415 @@ def delete_item(path):
 def handle_connect():
     """客户端连接事件"""
     print(f'Client connected: {request.sid}')
+    # 后台任务的进度发送到用户房间，刷新页面后仍能收到
+    if 'user_id' in session:
+        join_room(user_room(session['user_id']))
+
+# 客户端断开后，等待多少秒再清理仍标记为取消的上传会话
+UPLOAD_CANCEL_GRACE = 5
+# 超过此时间（秒）没有更新的上传会话视为遗留记录（如进程异常退出），由定期清理任务删除
+UPLOAD_SESSION_MAX_AGE = 24 * 3600
+
+def cleanup_cancelled_upload(sid):
+    """清理断开连接后仍未完成的上传会话（由 delayed_tasks 调用）"""
+    session_info = upload_sessions.get(sid)
+    if session_info is not None:
+        if session_info.get('status') == 'cancelled':
+            try:
+                audit_writer.write("""
+                    UPDATE file_operations 
+                    SET status = 'interrupted' 
+                    WHERE id = ?
+                """, (session_info.get('operation_id'),))
+            except:
+                pass
+            
+            # 删除会话（暂存文件由上传循环发现取消后释放，进程异常退出时由 temp_files 清理）
+            upload_sessions.delete(sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """客户端断开连接事件"""
     print(f'Client disconnected: {request.sid}')
     # 清理上传会话（给一些时间让上传完成）
-    if request.sid in upload_sessions:
-        session_info = upload_sessions[request.sid]
-        if session_info.get('status') == 'uploading':
-            # 标记为取消而不是立即中断
-            upload_sessions[request.sid]['status'] = 'cancelled'
-            print(f'Upload marked as cancelled for session: {request.sid}')
-            
-            # 延迟清理，给上传线程一些时间完成
-            session_id = request.sid  # 在请求上下文中获取session_id
-            def delayed_cleanup(sid):
-                time.sleep(5)  # 等待5秒
-                if sid in upload_sessions:
-                    session_info = upload_sessions[sid]
-                    if session_info.get('status') == 'cancelled':
-                        try:
-                            db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-                            conn = sqlite3.connect(db_path)
-                            cursor = conn.cursor()
-                            cursor.execute("""
-                                UPDATE file_operations 
-                                SET status = 'interrupted' 
-                                WHERE id = ?
-                            """, (session_info.get('operation_id'),))
-                            conn.commit()
-                            conn.close()
-                        except:
-                            pass
-                        
-                        # 清理临时文件
-                        if 'temp_path' in session_info:
-                            temp_path = session_info['temp_path']
-                            if os.path.exists(temp_path):
-                                try:
-                                    os.remove(temp_path)
-                                    print(f'Cleaned up temp file: {temp_path}')
-                                except Exception as e:
-                                    print(f'Failed to clean up temp file {temp_path}: {e}')
-                        
-                        # 删除会话
-                        if sid in upload_sessions:
-                            del upload_sessions[sid]
-            
-            cleanup_thread = threading.Thread(target=delayed_cleanup, args=(session_id,))
-            cleanup_thread.daemon = True
-            cleanup_thread.start()
-        else:
-            # 非上传会话，直接删除
-            del upload_sessions[request.sid]
+    # 标记为取消而不是立即中断，上传请求可能在另一个进程中
+    if upload_sessions.set_status(request.sid, 'cancelled', only_if='uploading'):
+        print(f'Upload marked as cancelled for session: {request.sid}')
+        
+        # 延迟清理，给上传请求一些时间完成；所有延迟清理共用一个后台线程
+        delayed_tasks.call_later(UPLOAD_CANCEL_GRACE, cleanup_cancelled_upload, request.sid)
+    else:
+        # 非上传会话，直接删除
+        upload_sessions.delete(request.sid)
 
 # 添加页面刷新/关闭时的清理
 @socketio.on('page_unload')
 def handle_page_unload():
     """处理页面刷新或关闭事件"""
     print(f'Page unload detected for session: {request.sid}')
-    if request.sid in upload_sessions:
-        session_info = upload_sessions[request.sid]
-        if session_info.get('status') == 'uploading':
-            # 立即标记为取消
-            upload_sessions[request.sid]['status'] = 'cancelled'
-            print(f'Upload cancelled due to page unload: {request.sid}')
-            
-            # 立即清理临时文件
-            if 'temp_path' in session_info:
-                temp_path = session_info['temp_path']
-                if os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                        print(f'Immediately cleaned up temp file: {temp_path}')
-                    except Exception as e:
-                        print(f'Failed to immediately clean up temp file {temp_path}: {e}')
+    # 立即标记为取消
+    if upload_sessions.set_status(request.sid, 'cancelled', only_if='uploading'):
+        print(f'Upload cancelled due to page unload: {request.sid}')
+        # 上传循环在下一次状态检查（UPLOAD_STATE_CHECK_INTERVAL 秒内）时停止并释放暂存文件
 
 # 移除了 start_upload 事件处理，因为上传会话在 real_time_upload_with_progress 中管理
 
+# --- 临时文件登记 ---
+# 上传过程中的具名临时文件（暂存目录中的 .tmp，见 upload_spool）在创建前登记到 temp_files 表，写完改名或删除后注销；
+# O_TMPFILE 创建的匿名文件没有名字，进程退出时由内核回收，不需要登记。
+# 定期清理只查询登记时间超过 TEMP_FILE_STALE 秒的记录，再检查这些文件的修改时间（正在写入的文件会不断更新），
+# 不再遍历整个存储目录，也不会误删用户自己上传的 .tmp 文件；管理员的 storage_path 同样适用。
+# 记录中保存创建它的主机名和进程号：启动时（start_background_tasks）立即清理同一主机上已经退出的进程留下的临时文件，
+# 即进程在上传中途崩溃或被杀死的情况；其他主机的记录只能按时间清理。
+# 断点续传的 .part 文件登记在 resumable_uploads 表中，复制/移动的 .copy.tmp 由后台任务的断点管理，不在此登记。
+TEMP_FILE_STALE = 3600
+PROCESS_STARTED_AT = time.time()
+
+class TempFileRegistry:
+    """记录正在写入的临时文件，用于清理进程异常退出或上传中断后遗留的文件"""
+
+    def __init__(self):
+        self.host = socket.gethostname()
+
+    def register(self, path):
+        conn = get_db()
+        conn.execute("""
+            INSERT OR REPLACE INTO temp_files (path, host, pid, created_at) VALUES (?, ?, ?, ?)
+        """, (os.path.abspath(path), self.host, os.getpid(), time.time()))
+        conn.commit()
+        return path
+
+    def release(self, path):
+        """临时文件已被改名或删除后调用"""
+        conn = get_db()
+        conn.execute("DELETE FROM temp_files WHERE path = ?", (os.path.abspath(path),))
+        conn.commit()
+
+    def _is_orphaned(self, row):
+        """创建记录的进程是否已经退出（只能判断本机的进程）"""
+        if row['host'] != self.host:
+            return False
+        if row['pid'] == os.getpid():
+            # 进程号相同但记录早于本进程启动：上一次运行留下的
+            return row['created_at'] < PROCESS_STARTED_AT
+        if os.name == 'nt':
+            # Windows 上 os.kill 会结束目标进程，不能用来探测
+            return False
+        try:
+            os.kill(row['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def _remove(self, row):
+        try:
+            os.remove(row['path'])
+            print(f"Cleaned up orphaned temp file: {row['path']}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to clean up orphaned temp file {row['path']}: {e}")
+            return
+        conn = get_db()
+        conn.execute("DELETE FROM temp_files WHERE path = ? AND created_at = ?", (row['path'], row['created_at']))
+        conn.commit()
+
+    def recover(self):
+        """启动时调用：删除本机上已退出的进程留下的临时文件，返回删除的数量"""
+        cursor = get_db().cursor()
+        cursor.execute("SELECT * FROM temp_files WHERE host = ?", (self.host,))
+        orphaned = [row for row in cursor.fetchall() if self._is_orphaned(row)]
+        for row in orphaned:
+            self._remove(row)
+        return len(orphaned)
+
+    def cleanup(self, max_age=TEMP_FILE_STALE):
+        """删除登记时间和最后修改时间都超过 max_age 秒，或创建进程已退出的临时文件"""
+        now = time.time()
+        cursor = get_db().cursor()
+        cursor.execute("SELECT * FROM temp_files WHERE created_at < ?", (now - max_age,))
+        for row in cursor.fetchall():
+            try:
+                active = now - os.path.getmtime(row['path']) < max_age
+            except OSError:
+                active = False  # 文件已不存在，只删除记录
+            if not active or self._is_orphaned(row):
+                self._remove(row)
+
+temp_files = TempFileRegistry()
+
 def cleanup_orphaned_temp_files():
     """清理孤立的临时文件"""
     try:
-        # 扫描用户文件目录，查找 .tmp 文件
-        userfiles_dir = app.config['GRACEDISK_CONFIG'].get('userfiles_path', 'userfiles')
-        if os.path.exists(userfiles_dir):
-            for root, dirs, files in os.walk(userfiles_dir):
-                for file in files:
-                    if file.endswith('.tmp'):
-                        file_path = os.path.join(root, file)
-                        # 检查文件是否超过1小时（可能是孤立文件）
-                        try:
-                            file_age = time.time() - os.path.getmtime(file_path)
-                            if file_age > 3600:  # 1小时
-                                os.remove(file_path)
-                                print(f'Cleaned up orphaned temp file: {file_path}')
-                        except Exception as e:
-                            print(f'Failed to clean up orphaned temp file {file_path}: {e}')
+        temp_files.cleanup()
     except Exception as e:
         print(f'Error during orphaned temp file cleanup: {e}')
 
+# --- 上传暂存区 ---
+# 上传的数据先写入所在存储根目录（storage_path、userfiles/<用户名>）下的暂存目录 upload_spool_dir（默认 .uploads），
+# 与目标文件在同一文件系统上，写完后原子地出现在目标位置；暂存目录和 .trash 一样不出现在列表和搜索结果中。
+# Linux 上用 O_TMPFILE 在暂存目录中创建没有名字的文件：写到一半的文件在任何目录中都看不到，进程退出时由内核回收，
+# 完成时一次 linkat 把它链接到目标路径（目标已存在时先链接到暂存目录再 os.replace 覆盖）。
+# 文件系统不支持 O_TMPFILE（或没有 /proc）时退回暂存目录中的具名临时文件，登记在 temp_files 中，完成时 os.replace。
+# 已知大小的上传用 fallocate 一次预留全部空间，大文件不会因为边写边分配而产生大量碎片，空间不足时也能立即失败；
+# 提交前截断到实际写入的长度。
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+
+class _Libc:
+    """linkat / fallocate 的 ctypes 封装，不支持的平台上对应属性为 None"""
+
+    def __init__(self):
+        self.linkat = self.fallocate = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        except (OSError, TypeError):
+            return
+        linkat = getattr(libc, 'linkat', None)
+        if linkat is not None:
+            linkat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+            self.linkat = linkat
+        fallocate = getattr(libc, 'fallocate64', None) or getattr(libc, 'fallocate', None)
+        if fallocate is not None:
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            self.fallocate = fallocate
+
+_libc = _Libc()
+
+def preallocate(fd, size):
+    """用 fallocate 为 fd 分配 size 字节（文件长度随之变为 size），返回是否成功；
+    文件系统或平台不支持时返回 False，空间不足时抛出 OSError"""
+    if _libc.fallocate is None or size <= 0:
+        return False
+    if _libc.fallocate(fd, 0, 0, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EDQUOT):
+        raise OSError(err, os.strerror(err))
+    return False
+
+def link_replace(src, dst, tmp_dir):
+    """让 dst 成为 src 的硬链接；dst 不存在时是一次 link，已存在时先链接到 tmp_dir 再原子地替换"""
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        pass
+    tmp = os.path.join(tmp_dir, uuid.uuid4().hex + '.link')
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        os.remove(tmp)
+        raise
+
+class SpoolFile:
+    """暂存区中正在写入的上传文件，通过 file 写入，commit() 放到目标位置，close() 释放（未提交时删除）
+
+    path 为 None 时是 O_TMPFILE 创建的匿名文件，只能通过 /proc/self/fd 访问。
+    """
+
+    def __init__(self, spool_dir, file, path=None, preallocated=False):
+        self.spool_dir = spool_dir
+        self.file = file
+        self.path = path
+        self.preallocated = preallocated
+        self.committed = False
+
+    @property
+    def source(self):
+        """可以打开或链接的路径"""
+        return self.path if self.path is not None else f'/proc/self/fd/{self.file.fileno()}'
+
+    def _flush(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        if self.preallocated:
+            # 截掉预分配但没有写入的部分
+            self.file.truncate()
+            self.preallocated = False
+
+    def read_blocks(self, block_size):
+        self._flush()
+        with open(self.source, 'rb') as f:
+            yield from iter(lambda: f.read(block_size), b'')
+
+    def link(self, dst):
+        """在 dst 建立指向这个文件的硬链接，dst 已存在时抛出 FileExistsError"""
+        self._flush()
+        if self.path is not None:
+            os.link(self.path, dst)
+            return
+        if _libc.linkat(AT_FDCWD, os.fsencode(self.source), AT_FDCWD, os.fsencode(dst), AT_SYMLINK_FOLLOW) != 0:
+            err = ctypes.get_errno()
+            if err == errno.EEXIST:
+                raise FileExistsError(err, os.strerror(err), dst)
+            raise OSError(err, os.strerror(err), dst)
+
+    def commit(self, save_path):
+        """把文件原子地放到 save_path，覆盖已有的文件"""
+        self._flush()
+        try:
+            if self.path is not None:
+                os.replace(self.path, save_path)
+            else:
+                try:
+                    self.link(save_path)
+                except FileExistsError:
+                    tmp = os.path.join(self.spool_dir, uuid.uuid4().hex + '.link')
+                    self.link(tmp)
+                    try:
+                        os.replace(tmp, save_path)
+                    except OSError:
+                        os.remove(tmp)
+                        raise
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # 目标在存储根目录中挂载的其他文件系统上：复制到目标目录中的临时文件再替换
+            tmp = temp_files.register(os.path.join(os.path.dirname(save_path), f'.{uuid.uuid4().hex}.tmp'))
+            try:
+                copy_file_data(self.source, tmp)
+                os.replace(tmp, save_path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                temp_files.release(tmp)
+        self.committed = True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.path is not None:
+            if not self.committed:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            temp_files.release(self.path)
+
+class UploadSpool:
+    """为上传创建暂存文件"""
+
+    def __init__(self):
+        # 不支持 O_TMPFILE 的暂存目录，避免每次上传都尝试一次
+        self._no_tmpfile = set()
+
+    @property
+    def dir_name(self):
+        return app.config['GRACEDISK_CONFIG'].get('upload_spool_dir', '.uploads')
+
+    def spool_dir(self, save_path):
+        """save_path 所在存储根目录下的暂存目录"""
+        path = os.path.abspath(save_path)
+        userfiles = os.path.abspath('userfiles')
+        if path.startswith(userfiles + os.sep):
+            root = os.path.join(userfiles, os.path.relpath(path, userfiles).split(os.sep, 1)[0])
+        else:
+            storage = os.path.abspath(app.config['GRACEDISK_CONFIG'].get('storage_path'))
+            root = storage if path.startswith(storage + os.sep) else os.path.dirname(path)
+        spool_dir = os.path.join(root, self.dir_name)
+        os.makedirs(spool_dir, exist_ok=True)
+        return spool_dir
+
+    def _open_tmpfile(self, spool_dir):
+        if (not hasattr(os, 'O_TMPFILE') or _libc.linkat is None or spool_dir in self._no_tmpfile
+                or not app.config['GRACEDISK_CONFIG'].get('upload_spool_tmpfile', True)
+                or not os.path.isdir('/proc/self/fd')):
+            return None
+        try:
+            return os.open(spool_dir, os.O_TMPFILE | os.O_WRONLY, 0o666)
+        except OSError as e:
+            # EOPNOTSUPP: 文件系统不支持；EISDIR: 内核早于 3.11
+            print(f'O_TMPFILE is not supported in {spool_dir}, using named temp files: {e}')
+            self._no_tmpfile.add(spool_dir)
+            return None
+
+    def create(self, save_path, size=0):
+        """为将要保存到 save_path、大小约为 size 字节的上传创建暂存文件"""
+        spool_dir = self.spool_dir(save_path)
+        path = None
+        fd = self._open_tmpfile(spool_dir)
+        if fd is None:
+            path = temp_files.register(os.path.join(spool_dir, uuid.uuid4().hex + '.tmp'))
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except OSError:
+                temp_files.release(path)
+                raise
+        try:
+            preallocated = app.config['GRACEDISK_CONFIG'].get('upload_preallocate', True) and preallocate(fd, size)
+        except OSError:
+            os.close(fd)
+            if path is not None:
+                os.remove(path)
+                temp_files.release(path)
+            raise
+        return SpoolFile(spool_dir, os.fdopen(fd, 'wb'), path, preallocated)
+
+    def adopt(self, path):
+        """已经写完的具名暂存文件（断点续传的 .part），用于 dedup_store.finalize；提交成功后 close() 删除剩下的文件"""
+        return SpoolFile(os.path.dirname(path), None, path)
+
+upload_spool = UploadSpool()
+
+def _abort_resumable_upload(cursor, upload):
+    """把断点续传记录标记为放弃并退回初始化时预占的配额（与调用方在同一事务中提交）"""
+    cursor.execute("DELETE FROM resumable_chunks WHERE upload_id = ?", (upload['id'],))
+    cursor.execute("UPDATE resumable_uploads SET status = 'aborted' WHERE id = ? AND status = 'uploading'",
+                   (upload['id'],))
+    if cursor.rowcount and upload['usage_user_id'] is not None:
+        cursor.execute("UPDATE user_usage SET used_bytes = MAX(used_bytes - ?, 0) WHERE user_id = ?",
+                       (upload['file_size'], upload['usage_user_id']))
+    cursor.execute("UPDATE file_operations SET status = 'interrupted' WHERE id = ?", (upload['operation_id'],))
+
+def cleanup_expired_resumable_uploads():
+    """清理长时间没有新分块的断点续传上传"""
+    try:
+        config = app.config['GRACEDISK_CONFIG']
+        expire_hours = config.get('resumable_upload_expire_hours', 24)
+        conn = get_db()
+        cursor = conn.cursor()
+        # updated_at 由 CURRENT_TIMESTAMP 写入（UTC），截止时间也在 SQLite 中按 UTC 计算
+        cursor.execute("""
+            SELECT * FROM resumable_uploads
+            WHERE status = 'uploading' AND updated_at < datetime('now', ?)
+        """, (f'-{expire_hours} hours',))
+        expired = cursor.fetchall()
+        for upload in expired:
+            if os.path.exists(upload['temp_path']):
+                try:
+                    os.remove(upload['temp_path'])
+                except OSError as e:
+                    print(f"Failed to remove expired upload {upload['temp_path']}: {e}")
+                    continue
+            _abort_resumable_upload(cursor, upload)
+            print(f"Cleaned up expired resumable upload: {upload['id']}")
+        conn.commit()
+    except Exception as e:
+        get_db().rollback()
+        print(f'Error during resumable upload cleanup: {e}')
+
 # 启动定期清理任务
 def start_cleanup_scheduler():
     """启动定期清理任务"""
     def cleanup_task():
+        try:
+            # 启动后先完整检查一次去重存储，之后每天一次
+            dedup_store.sweep_if_due()
+        except Exception as e:
+            print(f'Dedup store sweep error: {e}')
         while True:
             try:
                 time.sleep(300)  # 每5分钟执行一次
                 cleanup_orphaned_temp_files()
+                cleanup_expired_resumable_uploads()
+                upload_sessions.purge(UPLOAD_SESSION_MAX_AGE)
+                dedup_store.sweep_if_due()
+                job_manager.purge()
             except Exception as e:
                 print(f'Cleanup scheduler error: {e}')
     
@@ -756,31 +3245,512 @@ def start_cleanup_scheduler():
     cleanup_thread.daemon = True
     cleanup_thread.start()
 
-def real_time_upload_with_progress(file_data, file_size, save_path, upload_id, user_id, session_id):
-    """实时上传文件并发送进度"""
-    chunk_size = 64 * 1024  # 64KB chunks
+# --- 去重存储 ---
+# dedup_uploads 开启后，上传的文件在写入时计算 SHA-256，内容相同的文件在 dedup_store_path 中只保存一份（blob），
+# 各用户目录中的文件是指向 blob 的硬链接，浏览、下载、重命名、移动都与普通文件相同。
+# 引用计数就是 blob 的硬链接数减一，由文件系统维护：删除用户文件只删除一个链接，
+# 链接数降到 1（只剩存储区自己）的 blob 由垃圾回收删除。
+# blob 设为只读，防止通过某个链接原地修改内容而改变其他用户的副本。
+# 每个 blob 登记在 dedup_blobs 表中（摘要、大小、inode）。purge_tree 删除只读且链接数不超过 2 的文件时
+# 记下它的 inode（note_unlink），collect_garbage() 只检查这些候选 blob，不遍历存储区；
+# sweep() 遍历整个存储区，补登记录、删除漏掉的 blob 并统计，只在启动后和每天执行一次。
+# 配额：每个用户按自己目录中看到的文件大小计算，与内容是否和他人共享无关；去重节省的只是磁盘空间。
+# dedup_store_path 必须与存储目录在同一文件系统上，否则无法建立硬链接，文件按普通方式保存。
+DEDUP_HASH_BLOCK = 1024 * 1024
+DEDUP_GC_DELAY = 5
+DEDUP_SWEEP_INTERVAL = 24 * 3600
+
+class DedupStore:
+    """按内容摘要保存上传文件的存储区"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._configured = False
+        self.enabled = False
+        self.root = None
+        self._gc_scheduled = False
+        self._candidates = set()
+        self._stats = None
+        self._swept_at = 0
+
+    def _setup(self):
+        if self._configured:
+            return
+        with self._lock:
+            if not self._configured:
+                config = app.config['GRACEDISK_CONFIG']
+                self.enabled = bool(config.get('dedup_uploads', False))
+                self.root = os.path.abspath(config.get('dedup_store_path', 'dedup_store'))
+                if self.enabled:
+                    os.makedirs(self.root, exist_ok=True)
+                self._configured = True
+
+    def new_hasher(self):
+        """启用去重时返回一个 SHA-256 对象，供上传循环边写边计算；未启用时返回 None"""
+        self._setup()
+        return hashlib.sha256() if self.enabled else None
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _register(self, digest, stat):
+        conn = get_db()
+        conn.execute("""
+            INSERT OR REPLACE INTO dedup_blobs (digest, size, ino, created_at) VALUES (?, ?, ?, ?)
+        """, (digest, stat.st_size, stat.st_ino, time.time()))
+        conn.commit()
+
+    def _unregister(self, digest, ino):
+        # 带上 inode：同一摘要的 blob 可能已经被重新创建
+        conn = get_db()
+        conn.execute("DELETE FROM dedup_blobs WHERE digest = ? AND ino = ?", (digest, ino))
+        conn.commit()
+
+    def finalize(self, spool, save_path, hasher=None):
+        """把写完的暂存文件（SpoolFile）放到 save_path，返回是否与已有内容共用了 blob
+
+        hasher 为上传时计算的摘要；为 None 时（如分块上传）在这里读取文件计算。
+        """
+        self._setup()
+        if self.enabled:
+            if hasher is None:
+                hasher = hashlib.sha256()
+                for block in spool.read_blocks(DEDUP_HASH_BLOCK):
+                    hasher.update(block)
+            try:
+                return self._link_blob(spool, save_path, hasher.hexdigest())
+            except OSError as e:
+                # 跨文件系统（EXDEV）或文件系统不支持硬链接
+                print(f'Dedup store unavailable for {save_path}, saving normally: {e}')
+        spool.commit(save_path)
+        return False
+
+    def _link_blob(self, spool, save_path, digest):
+        blob_path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        for _ in range(2):
+            try:
+                # 新内容：暂存文件本身成为 blob，再放到用户目录（两者是同一个 inode）
+                spool.link(blob_path)
+                os.chmod(blob_path, 0o444)
+                self._register(digest, os.stat(blob_path))
+                spool.commit(save_path)
+                return False
+            except FileExistsError:
+                pass
+            # 已有相同内容：用指向 blob 的硬链接代替暂存文件（暂存文件由调用方 close() 释放）
+            try:
+                link_replace(blob_path, save_path, spool.spool_dir)
+            except FileNotFoundError:
+                continue  # blob 刚被垃圾回收，重新以暂存文件作为 blob
+            return True
+        raise OSError(f'blob {digest} keeps disappearing')
+
+    def note_unlink(self, stat):
+        """purge_tree 删除文件前调用：只读且只剩它和 blob 两个链接的文件，删除后 blob 可能不再被引用"""
+        self._setup()
+        if not self.enabled or stat.st_nlink > 2 or stat.st_mode & 0o222:
+            return
+        with self._lock:
+            self._candidates.add(stat.st_ino)
+
+    def schedule_collect(self):
+        """删除文件后调用：稍后回收不再被引用的 blob，短时间内的多次删除只回收一次"""
+        self._setup()
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._gc_scheduled or not self._candidates:
+                return
+            self._gc_scheduled = True
+        delayed_tasks.call_later(DEDUP_GC_DELAY, self.collect_garbage)
+
+    def collect_garbage(self):
+        """检查 note_unlink 记下的候选 blob，删除链接数为 1 的，返回删除的数量"""
+        self._setup()
+        with self._lock:
+            self._gc_scheduled = False
+            candidates, self._candidates = list(self._candidates), set()
+        if not self.enabled or not candidates:
+            return 0
+        removed = 0
+        conn = get_db()
+        for i in range(0, len(candidates), 500):
+            batch = candidates[i:i + 500]
+            rows = conn.execute(
+                f"SELECT digest, ino FROM dedup_blobs WHERE ino IN ({','.join('?' * len(batch))})",
+                batch).fetchall()
+            for row in rows:
+                path = self._blob_path(row['digest'])
+                try:
+                    stat = os.stat(path)
+                    if stat.st_ino != row['ino']:
+                        continue  # 不是这个 blob（inode 号被复用）
+                    if stat.st_nlink > 1:
+                        continue
+                    # 与 finalize 并发时，刚建立的链接仍指向同一个 inode，删除 blob 不会丢失数据
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f'Dedup store: failed to remove blob {path}: {e}')
+                    continue
+                self._unregister(row['digest'], row['ino'])
+                removed += 1
+        if removed:
+            if self._stats:
+                self._stats['removed'] += removed
+            print(f'Dedup store: removed {removed} unreferenced blobs')
+        return removed
+
+    def sweep(self):
+        """遍历整个存储区：删除链接数为 1 的 blob，补登和清除 dedup_blobs 记录，并统计引用数和节省的空间"""
+        self._setup()
+        if not self.enabled:
+            return None
+        self._swept_at = time.time()
+        conn = get_db()
+        registered = {row['digest']: row['ino'] for row in conn.execute("SELECT digest, ino FROM dedup_blobs")}
+        stats = {'blobs': 0, 'references': 0, 'stored_bytes': 0, 'logical_bytes': 0, 'removed': 0}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_nlink <= 1:
+                        os.remove(path)
+                        stats['removed'] += 1
+                        continue
+                except OSError:
+                    continue
+                if registered.pop(filename, None) != stat.st_ino:
+                    self._register(filename, stat)
+                stats['blobs'] += 1
+                stats['references'] += stat.st_nlink - 1
+                stats['stored_bytes'] += stat.st_size
+                stats['logical_bytes'] += stat.st_size * (stat.st_nlink - 1)
+        # 剩下的记录对应的 blob 已经不存在
+        for digest, ino in registered.items():
+            self._unregister(digest, ino)
+        stats['saved_bytes'] = stats['logical_bytes'] - stats['stored_bytes']
+        stats['collected_at'] = time.time()
+        self._stats = stats
+        if stats['removed']:
+            print(f"Dedup store: removed {stats['removed']} unreferenced blobs")
+        return stats
+
+    def sweep_if_due(self):
+        """距上次 sweep() 超过 DEDUP_SWEEP_INTERVAL 时执行一次（进程启动后第一次调用总会执行）"""
+        self._setup()
+        if self.enabled and time.time() - self._swept_at >= DEDUP_SWEEP_INTERVAL:
+            self.sweep()
+
+    def stats(self):
+        """最近一次 sweep() 时的统计；未启用时返回 None"""
+        self._setup()
+        if not self.enabled:
+            return None
+        return self._stats or self.sweep()
+
+dedup_store = DedupStore()
+
+# 上传准入控制：限制同时写盘的上传数量，按用户轮流放行排队的上传
+UPLOAD_RETRY_AFTER = 5
+UPLOAD_WAIT_SAMPLES = 1000
+
+class UploadScheduler:
+    """上传名额调度器
+
+    同时进行的上传不超过 upload_max_concurrent 个，每个用户不超过 upload_max_per_user 个；
+    超出的请求排队等待，名额释放时在有请求排队的用户之间轮流放行，单个用户的大量上传不会饿死其他用户。
+    用户自己的队列已满时拒绝（429），总队列已满或等待超时时拒绝（503）。
+    限制在每个进程内生效（gunicorn 下每个 worker 各有一份）。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._config = None
+        self._running = 0
+        self._running_by_user = {}
+        self._waiting = OrderedDict()  # user_id -> deque[ticket]，顺序即轮转顺序
+        self._waiting_count = 0
+        self._wait_times = deque(maxlen=UPLOAD_WAIT_SAMPLES)
+        self._counters = {'admitted': 0, 'rejected_user_queue': 0, 'rejected_queue_full': 0, 'timed_out': 0}
+
+    def _setup(self):
+        """首次使用时读取配置（调用方持有锁）"""
+        if self._config is not None:
+            return
+        config = app.config['GRACEDISK_CONFIG']
+        self._config = {
+            'max_concurrent': max(1, config.get('upload_max_concurrent', 8)),
+            'max_per_user': max(1, config.get('upload_max_per_user', 4)),
+            'queue_size': config.get('upload_queue_size', 64),
+            'queue_per_user': config.get('upload_queue_per_user', 16),
+            'queue_timeout': config.get('upload_queue_timeout', 60),
+        }
+
+    def _can_run(self, user_id):
+        return (self._running < self._config['max_concurrent'] and
+                self._running_by_user.get(user_id, 0) < self._config['max_per_user'])
+
+    def _start(self, user_id):
+        self._running += 1
+        self._running_by_user[user_id] = self._running_by_user.get(user_id, 0) + 1
+        self._counters['admitted'] += 1
+
+    def _dispatch(self):
+        """按用户轮转把空出的名额分给排队的请求（调用方持有锁）"""
+        granted = False
+        progress = True
+        while progress and self._waiting and self._running < self._config['max_concurrent']:
+            progress = False
+            for user_id in list(self._waiting):
+                if not self._can_run(user_id):
+                    continue
+                tickets = self._waiting.pop(user_id)
+                ticket = tickets.popleft()
+                self._waiting_count -= 1
+                if tickets:
+                    self._waiting[user_id] = tickets  # 放到轮转顺序的末尾
+                ticket['granted'] = True
+                self._wait_times.append(time.monotonic() - ticket['since'])
+                self._start(user_id)
+                granted = progress = True
+                if self._running >= self._config['max_concurrent']:
+                    break
+        if granted:
+            self._cond.notify_all()
+
+    def acquire(self, user_id):
+        """等待一个上传名额，成功返回 None，被拒绝时返回 (错误信息, 状态码)"""
+        with self._cond:
+            self._setup()
+            if user_id not in self._waiting and self._can_run(user_id):
+                self._wait_times.append(0.0)
+                self._start(user_id)
+                return None
+            tickets = self._waiting.get(user_id)
+            if tickets is not None and len(tickets) >= self._config['queue_per_user']:
+                self._counters['rejected_user_queue'] += 1
+                return '您同时进行的上传过多，请稍后重试', 429
+            if self._waiting_count >= self._config['queue_size']:
+                self._counters['rejected_queue_full'] += 1
+                return '服务器繁忙，请稍后重试', 503
+            ticket = {'granted': False, 'since': time.monotonic()}
+            self._waiting.setdefault(user_id, deque()).append(ticket)
+            self._waiting_count += 1
+            deadline = ticket['since'] + self._config['queue_timeout']
+            while not ticket['granted']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    tickets = self._waiting[user_id]
+                    tickets.remove(ticket)
+                    self._waiting_count -= 1
+                    if not tickets:
+                        del self._waiting[user_id]
+                    self._counters['timed_out'] += 1
+                    return '服务器繁忙，排队超时，请稍后重试', 503
+                self._cond.wait(remaining)
+            return None
+
+    def release(self, user_id):
+        with self._cond:
+            self._running -= 1
+            if self._running_by_user[user_id] > 1:
+                self._running_by_user[user_id] -= 1
+            else:
+                del self._running_by_user[user_id]
+            self._dispatch()
+
+    def stats(self):
+        """当前运行/排队数量和最近 UPLOAD_WAIT_SAMPLES 次放行的排队时间，用于调整限制"""
+        with self._cond:
+            self._setup()
+            waits = sorted(self._wait_times)
+            percentile = lambda p: round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0
+            return dict(self._config, **self._counters,
+                        running=self._running,
+                        waiting=self._waiting_count,
+                        running_by_user={str(k): v for k, v in self._running_by_user.items()},
+                        waiting_by_user={str(k): len(v) for k, v in self._waiting.items()},
+                        wait_p50_ms=percentile(0.5),
+                        wait_p95_ms=percentile(0.95),
+                        wait_max_ms=round(waits[-1] * 1000, 1) if waits else 0)
+
+upload_scheduler = UploadScheduler()
+
+def upload_slot(f):
+    """上传路由的装饰器：在读取请求体之前取得上传名额，请求结束后释放"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # 未登录和访客由路由自己返回错误
+        if 'user_id' not in session or session.get('is_visitor'):
+            return f(*args, **kwargs)
+        user_id = session['user_id']
+        error = upload_scheduler.acquire(user_id)
+        if error:
+            if request.endpoint == 'upload_file':
+                # 传统表单上传返回页面而不是 JSON
+                flash(error[0], 'error')
+                return redirect(request.referrer or url_for('root'))
+            return jsonify({'success': False, 'error': error[0]}), error[1], {'Retry-After': str(UPLOAD_RETRY_AFTER)}
+        try:
+            return f(*args, **kwargs)
+        finally:
+            upload_scheduler.release(user_id)
+    return decorated_function
+
+class DelayedTasks:
+    """在一个后台线程中按时间顺序执行延迟任务，代替每个任务各自 sleep 的线程"""
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_started(self):
+        # 与 AuditWriter 相同，fork 出的子进程会重新启动线程（调用方持有锁）
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='delayed-tasks')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def call_later(self, delay, func, *args):
+        """delay 秒后在后台线程中调用 func(*args)"""
+        with self._cond:
+            self._ensure_started()
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), func, args))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, func, args = heapq.heappop(self._heap)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f'Delayed task {getattr(func, "__name__", func)} failed: {e}')
+
+delayed_tasks = DelayedTasks()
+
+# 每个上传的进度最多每 PROGRESS_INTERVAL 秒发送一次；速度按指数加权平均平滑，系数越大越跟随瞬时速度
+PROGRESS_INTERVAL = 0.5
+PROGRESS_SPEED_ALPHA = 0.3
+
+class ProgressBroadcaster:
+    """上传进度的集中发送器
+
+    上传循环只调用 update() 记录已写入的字节数，不计算速度、也不发送消息；
+    后台线程每 PROGRESS_INTERVAL 秒计算一次平滑速度和剩余时间，把同一房间（Socket.IO 连接）
+    中有变化的上传合并成一条 upload_progress 消息：{'uploads': [进度, ...]}。
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL, alpha=PROGRESS_SPEED_ALPHA):
+        self.interval = interval
+        self.alpha = alpha
+        self._uploads = {}  # (room, upload_id) -> 进度状态
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_started(self):
+        # 与 AuditWriter 相同，fork 出的子进程会重新启动线程（调用方持有锁）
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='upload-progress')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def start(self, room, upload_id, filename, total_bytes):
+        """登记一个上传，下一次发送时会包含它的 0% 进度"""
+        with self._cond:
+            self._ensure_started()
+            self._uploads[(room, upload_id)] = {
+                'filename': filename,
+                'total_bytes': total_bytes,
+                'uploaded_bytes': 0,
+                'sent_bytes': None,
+                'sample_bytes': 0,
+                'sample_time': time.monotonic(),
+                'speed': None,
+            }
+            self._cond.notify()
+
+    def update(self, room, upload_id, uploaded_bytes):
+        """记录已写入的字节数（每个块调用一次，只做一次字典赋值）"""
+        state = self._uploads.get((room, upload_id))
+        if state is not None:
+            state['uploaded_bytes'] = uploaded_bytes
+
+    def finish(self, room, upload_id):
+        """上传结束时注销；返回后不会再发送这个上传的进度，之后发送的完成/错误事件不会被旧进度覆盖"""
+        with self._cond:
+            self._uploads.pop((room, upload_id), None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._uploads:
+                    self._cond.wait()
+            time.sleep(self.interval)
+            with self._cond:
+                # 持有锁发送，保证 finish() 返回后不会再有这个上传的进度消息
+                for room, items in self._collect().items():
+                    try:
+                        socketio.emit('upload_progress', {'uploads': items}, room=room)
+                    except Exception as e:
+                        print(f'Error sending progress update: {e}')
+
+    def _collect(self):
+        """计算各上传的平滑速度，按房间分组返回有变化的进度（调用方持有锁）"""
+        now = time.monotonic()
+        rooms = {}
+        for (room, upload_id), state in self._uploads.items():
+            uploaded = state['uploaded_bytes']
+            elapsed = now - state['sample_time']
+            if elapsed > 0:
+                rate = (uploaded - state['sample_bytes']) / elapsed
+                state['speed'] = rate if state['speed'] is None else self.alpha * rate + (1 - self.alpha) * state['speed']
+                state['sample_bytes'] = uploaded
+                state['sample_time'] = now
+            if uploaded == state['sent_bytes']:
+                continue
+            state['sent_bytes'] = uploaded
+            total = state['total_bytes']
+            speed = state['speed'] or 0
+            rooms.setdefault(room, []).append({
+                'upload_id': upload_id,
+                'filename': state['filename'],
+                'progress': uploaded / total * 100 if total > 0 else 100,
+                'uploaded_bytes': uploaded,
+                'total_bytes': total,
+                'speed': speed,
+                'eta': (total - uploaded) / speed if speed > 0 else 0
+            })
+        return rooms
+
+progress_broadcaster = ProgressBroadcaster()
+
+def real_time_upload_with_progress(stream, file_size, save_path, upload_id, user_id, session_id, usage_user_id=None):
+    """实时上传文件并发送进度
+
+    stream 是可读的文件流（请求体或表单文件），按块读取后直接写入暂存文件（见 upload_spool），
+    内存占用只与块大小有关，与文件大小无关。
+    usage_user_id 不为 None 时，上传完成后计入该用户的空间使用量账本。
+    """
+    chunk_size = UPLOAD_CHUNK_SIZE
     uploaded_bytes = 0
     start_time = time.time()
+    spool = None
     
-    # 确保上传会话存在并标记为正在上传
-    if session_id not in upload_sessions:
-        upload_sessions[session_id] = {
-            'filename': os.path.basename(save_path),
-            'file_size': file_size,
-            'upload_id': upload_id,
-            'uploaded_bytes': 0,
-            'start_time': start_time,
-            'status': 'uploading',
-            'last_progress': 0,
-            'temp_path': None  # 稍后设置
-        }
-    else:
-        upload_sessions[session_id]['status'] = 'uploading'
-        upload_sessions[session_id]['last_progress'] = 0
-    
-    # 记录上传操作到数据库
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
+    # 记录上传操作到数据库（后续状态更新需要 operation_id，这里同步插入）
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
@@ -788,170 +3758,99 @@ def real_time_upload_with_progress(file_data, file_size, save_path, upload_id, u
     """, (user_id, 'upload', os.path.basename(save_path), file_size, 'in_progress'))
     operation_id = cursor.lastrowid
     conn.commit()
-    conn.close()
-    
-    # 更新上传会话信息
-    upload_sessions[session_id]['operation_id'] = operation_id
     
-    # 发送初始进度（0%）
-    try:
-        socketio.emit('upload_progress', {
-            'upload_id': upload_id,
-            'filename': os.path.basename(save_path),
-            'progress': 0,
-            'uploaded_bytes': 0,
-            'total_bytes': file_size,
-            'speed': 0,
-            'eta': 0
-        }, room=session_id)
-# 初始进度已发送
-    except Exception as e:
-        print(f'Error sending initial progress: {e}')
-    
-    temp_path = save_path + '.tmp'  # 使用临时文件避免冲突
+    # 登记上传会话并标记为正在上传；断开连接或关闭页面时据此取消上传，由上传循环释放暂存文件
+    upload_sessions.set(session_id, {
+        'filename': os.path.basename(save_path),
+        'file_size': file_size,
+        'upload_id': upload_id,
+        'uploaded_bytes': 0,
+        'start_time': start_time,
+        'status': 'uploading',
+        'operation_id': operation_id
+    })
     
-    # 保存临时文件路径到会话中
-    if session_id in upload_sessions:
-        upload_sessions[session_id]['temp_path'] = temp_path
+    # 进度由 progress_broadcaster 定时合并发送
+    progress_broadcaster.start(session_id, upload_id, os.path.basename(save_path), file_size)
     
     try:
         # 确保目录存在
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         
-        with open(temp_path, 'wb') as f:
-            data_position = 0
-            
-            while data_position < len(file_data):
-                # 检查是否被中断（增加更宽松的检查）
-                if session_id not in upload_sessions:
+        hasher = dedup_store.new_hasher()
+        spool = upload_spool.create(save_path, file_size)
+        f = spool.file
+        chunk_count = 0
+        next_state_check = 0
+        
+        while uploaded_bytes < file_size:
+            # 定期检查是否被中断并记录进度（会话状态可能在数据库中，不在每个块都查询）
+            now = time.monotonic()
+            if now >= next_state_check:
+                next_state_check = now + UPLOAD_STATE_CHECK_INTERVAL
+                session_info = upload_sessions.get(session_id)
+                if session_info is None:
                     # 会话不存在，可能是连接问题
                     break
-                elif upload_sessions[session_id].get('status') == 'cancelled':
-                    # 上传被中断，删除临时文件
-                    try:
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                    except:
-                        pass
-                    
-                    # 更新数据库状态
-                    conn = sqlite3.connect(db_path)
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE file_operations SET status = 'interrupted' WHERE id = ?", (operation_id,))
-                    conn.commit()
-                    conn.close()
+                elif session_info.get('status') == 'cancelled':
+                    # 上传被中断（暂存文件在 finally 中释放），更新数据库状态
+                    audit_writer.write("UPDATE file_operations SET status = 'interrupted' WHERE id = ?", (operation_id,))
                     
+                    progress_broadcaster.finish(session_id, upload_id)
                     socketio.emit('upload_error', {
                         'upload_id': upload_id,
                         'error': '上传被中断'
                     }, room=session_id)
-                    return
-                
-                # 获取下一个数据块
-                end_position = min(data_position + chunk_size, len(file_data))
-                chunk = file_data[data_position:end_position]
-                
-                if not chunk:
-                    break
-                
-                f.write(chunk)
-                uploaded_bytes += len(chunk)
-                data_position = end_position
-                
-                # 计算进度和速度
-                elapsed_time = time.time() - start_time
-                progress = (uploaded_bytes / file_size) * 100
-                speed = uploaded_bytes / elapsed_time if elapsed_time > 0 else 0
-                
-                # 估算剩余时间
-                if speed > 0:
-                    remaining_bytes = file_size - uploaded_bytes
-                    eta = remaining_bytes / speed
-                else:
-                    eta = 0
-                
-                # 更新会话状态
-                if session_id in upload_sessions:
-                    upload_sessions[session_id]['uploaded_bytes'] = uploaded_bytes
-                
-                # 发送进度更新（增加更新频率，特别是小文件）
-                should_update = (
-                    uploaded_bytes % (chunk_size * 4) == 0 or  # 每256KB发送一次更新
-                    uploaded_bytes == file_size or              # 完成时
-                    progress - upload_sessions[session_id].get('last_progress', 0) >= 5  # 进度增加5%时
-                )
-                if should_update:
-                    try:
-                        progress_data = {
-                            'upload_id': upload_id,
-                            'filename': os.path.basename(save_path),
-                            'progress': progress,
-                            'uploaded_bytes': uploaded_bytes,
-                            'total_bytes': file_size,
-                            'speed': speed,
-                            'eta': eta
-                        }
-                        socketio.emit('upload_progress', progress_data, room=session_id)
-                        
-                        # 更新最后发送的进度
-                        if session_id in upload_sessions:
-                            upload_sessions[session_id]['last_progress'] = progress
-                    except Exception as e:
-                        print(f'Error sending progress update: {e}')
-                        # 继续上传，不因为进度发送失败而中断
-                
-                # 小延迟以避免阻塞
-                if uploaded_bytes % (chunk_size * 16) == 0:  # 每1MB休息一下
-                    time.sleep(0.005)
+                    return False
+                upload_sessions.update(session_id, uploaded_bytes=uploaded_bytes)
+            
+            # 从流中读取下一个数据块
+            chunk = stream.read(min(chunk_size, file_size - uploaded_bytes))
+            
+            if not chunk:
+                break
+            
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            uploaded_bytes += len(chunk)
+            chunk_count += 1
+            
+            progress_broadcaster.update(session_id, upload_id, uploaded_bytes)
+            
+            # 小延迟以避免阻塞
+            if chunk_count % 16 == 0:
+                time.sleep(0.005)
+    
+        if uploaded_bytes < file_size:
+            # 会话丢失或客户端提前断开，数据不完整
+            raise IOError(f'上传数据不完整 ({uploaded_bytes}/{file_size} 字节)')
         
-        # 上传完成，原子操作移动临时文件到最终位置
-        try:
-            # Windows 下需要先删除目标文件（如果存在）
-            if os.path.exists(save_path):
-                os.remove(save_path)
-            os.rename(temp_path, save_path)
-        except Exception as e:
-            # 移动失败，清理临时文件
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except:
-                pass
-            raise e
+        # 上传完成，原子地放到最终位置（启用去重时与相同内容共用 blob）
+        dedup_store.finalize(spool, save_path, hasher)
+        paths_changed(save_path)
         
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE file_operations SET status = 'completed' WHERE id = ?", (operation_id,))
-        conn.commit()
-        conn.close()
+        audit_writer.write("UPDATE file_operations SET status = 'completed' WHERE id = ?", (operation_id,))
+        
+        if usage_user_id is not None:
+            adjust_user_usage(usage_user_id, file_size)
         
         # 清理上传会话
-        if session_id in upload_sessions:
-            upload_sessions[session_id]['status'] = 'completed'
+        upload_sessions.update(session_id, status='completed')
         
+        progress_broadcaster.finish(session_id, upload_id)
         socketio.emit('upload_complete', {
             'upload_id': upload_id,
             'filename': os.path.basename(save_path),
             'file_size': file_size
         }, room=session_id)
+        return True
         
     except Exception as e:
-        # 上传失败，清理临时文件和目标文件
-        for path in [temp_path, save_path]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except:
-                    pass
+        # 上传失败；提交是最后一步，目标位置不会留下不完整的文件
+        audit_writer.write("UPDATE file_operations SET status = 'failed' WHERE id = ?", (operation_id,))
         
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE file_operations SET status = 'failed' WHERE id = ?", (operation_id,))
-        conn.commit()
-        conn.close()
-        
-        if session_id in upload_sessions:
-            upload_sessions[session_id]['status'] = 'failed'
+        upload_sessions.update(session_id, status='failed')
         
         # 根据错误类型提供更有用的错误信息
         error_msg = str(e)
@@ -964,12 +3863,63 @@ def real_time_upload_with_progress(file_data, file_size, save_path, upload_id, u
         else:
             error_msg = f"上传失败: {error_msg}"
         
+        progress_broadcaster.finish(session_id, upload_id)
         socketio.emit('upload_error', {
             'upload_id': upload_id,
             'error': error_msg
         }, room=session_id)
+        return False
+    finally:
+        if spool is not None:
+            spool.close()
+
+def unique_path(path, is_dir=False):
+    """path 已存在时依次尝试 name(1).ext、name(2).ext ……（文件夹不区分扩展名），冲突过多时返回 None"""
+    if not os.path.lexists(path):
+        return path
+    name, ext = (path, '') if is_dir else os.path.splitext(path)
+    # 防止无限循环
+    for i in range(1, 1001):
+        candidate = f"{name}({i}){ext}"
+        if not os.path.lexists(candidate):
+            return candidate
+    return None
+
+def _resolve_upload_target(filename, subpath, file_size):
+    """校验配额和上传路径，返回 (保存路径, None)；失败时返回 (None, (错误信息, 状态码))"""
+    # 确定基础保存路径
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+        
+        # 检查用户配额
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (session['user_id'],))
+        user_db_info = cursor.fetchone()
+
+        quota_bytes = user_db_info['quota_gb'] * (1024**3)
+        used_bytes = get_user_used_bytes(session['user_id'], session['username'])
+
+        if used_bytes + file_size > quota_bytes:
+            return None, ('空间不足', 413)
+
+    # 路径处理和安全校验
+    safe_subpath = os.path.normpath(subpath).lstrip('.\\/')
+    current_path = os.path.join(base_path, safe_subpath)
+    if not os.path.abspath(current_path).startswith(os.path.abspath(base_path)):
+        return None, ('无效的上传路径', 400)
+
+    # 处理文件名冲突（改进版）
+    save_path = unique_path(os.path.join(current_path, filename))
+    if save_path is None:
+        return None, ('文件名冲突过多，请重命名文件', 400)
+
+    return save_path, None
 
 @app.route('/upload_websocket', methods=['POST'])
+@upload_slot
 def upload_file_websocket():
     """WebSocket 实时上传端点"""
     if 'user_id' not in session:
@@ -994,70 +3944,65 @@ def upload_file_websocket():
 
     filename = safe_filename(file.filename)
     
-    # 确定基础保存路径
-    if session.get('is_admin'):
-        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
-    else:
-        base_path = os.path.join('userfiles', session['username'])
-        
-        # 检查用户配额
-        config = app.config['GRACEDISK_CONFIG']
-        db_path = config.get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (session['user_id'],))
-        user_db_info = cursor.fetchone()
-        conn.close()
-
-        quota_bytes = user_db_info['quota_gb'] * (1024**3)
-        used_bytes = get_folder_size(base_path)
-
-        if used_bytes + file.content_length > quota_bytes:
-            return jsonify({'error': '空间不足'}), 413
-
-    # 路径处理和安全校验
-    safe_subpath = os.path.normpath(subpath).lstrip('.\\/')
-    current_path = os.path.join(base_path, safe_subpath)
-    if not os.path.abspath(current_path).startswith(os.path.abspath(base_path)):
-        return jsonify({'error': '无效的上传路径'}), 400
-
-    # 处理文件名冲突（改进版）
-    save_path = os.path.join(current_path, filename)
-    if os.path.exists(save_path):
-        name, ext = os.path.splitext(filename)
-        i = 1
-        while os.path.exists(save_path):
-            new_filename = f"{name}({i}){ext}"
-            save_path = os.path.join(current_path, new_filename)
-            i += 1
-            # 防止无限循环
-            if i > 1000:
-                return jsonify({'error': '文件名冲突过多，请重命名文件'}), 400
-    
-    # 读取文件数据到内存（避免文件流被关闭的问题）
+    session_id = request.headers.get('X-Socket-ID', '')
+    if not session_id:
+        return jsonify({'error': '缺少 Socket ID'}), 400
+    
+    # 获取文件大小（表单文件已由 Werkzeug 缓存到磁盘临时文件，不会读入内存）
     try:
-        file.seek(0)  # 确保从头开始读取
-        file_data = file.read()
-        file_size = len(file_data)
+        file.stream.seek(0, os.SEEK_END)
+        file_size = file.stream.tell()
+        file.stream.seek(0)  # 确保从头开始读取
     except Exception as e:
         return jsonify({'error': f'读取文件失败: {str(e)}'}), 400
     
-    # 启动后台上传线程
-    session_id = request.headers.get('X-Socket-ID', '')
-    if session_id:
-        upload_thread = threading.Thread(
-            target=real_time_upload_with_progress,
-            args=(file_data, file_size, save_path, upload_id, session['user_id'], session_id)
-        )
-        upload_thread.daemon = True
-        upload_thread.start()
-        
+    save_path, error = _resolve_upload_target(filename, subpath, file_size)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
+    
+    # 在请求线程中按块写入，文件流在请求结束后会被关闭
+    if real_time_upload_with_progress(file.stream, file_size, save_path, upload_id,
+                                      session['user_id'], session_id, session_usage_user_id()):
         return jsonify({'success': True, 'upload_id': upload_id})
-    else:
+    return jsonify({'success': False, 'error': '上传失败', 'upload_id': upload_id}), 500
+
+@app.route('/upload_stream', methods=['POST'])
+@upload_slot
+def upload_file_stream():
+    """流式上传端点：请求体即文件内容，边接收边写入临时文件，不做整体缓冲"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    # 访客不能上传
+    if session.get('is_visitor'):
+        return jsonify({'error': '访客无法上传文件'}), 403
+    
+    filename = request.args.get('filename', '')
+    upload_id = request.args.get('upload_id', '')
+    subpath = request.args.get('subpath', '')
+    session_id = request.headers.get('X-Socket-ID', '')
+    file_size = request.content_length
+    
+    if not filename:
+        return jsonify({'error': '未选择文件'}), 400
+    if not upload_id:
+        return jsonify({'error': '缺少上传ID'}), 400
+    if not session_id:
         return jsonify({'error': '缺少 Socket ID'}), 400
+    if file_size is None:
+        return jsonify({'error': '缺少 Content-Length'}), 411
+    
+    save_path, error = _resolve_upload_target(safe_filename(filename), subpath, file_size)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
+    
+    if real_time_upload_with_progress(request.stream, file_size, save_path, upload_id,
+                                      session['user_id'], session_id, session_usage_user_id()):
+        return jsonify({'success': True, 'upload_id': upload_id})
+    return jsonify({'success': False, 'error': '上传失败', 'upload_id': upload_id}), 500
 
 @app.route('/upload', methods=['POST'])
+@upload_slot
 def upload_file():
     """传统上传方式（保持兼容性）"""
     if 'user_id' not in session:
@@ -1095,17 +4040,13 @@ def upload_file():
             base_path = os.path.join('userfiles', session['username'])
             
             # 检查用户配额
-            config = app.config['GRACEDISK_CONFIG']
-            db_path = config.get('users_db_path', 'users.db')
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (session['user_id'],))
             user_db_info = cursor.fetchone()
-            conn.close()
 
             quota_bytes = user_db_info['quota_gb'] * (1024**3)
-            used_bytes = get_folder_size(base_path)
+            used_bytes = get_user_used_bytes(session['user_id'], session['username'])
 
             if used_bytes + file_size > quota_bytes:
                 # 这里不能直接调用模板里的 format_file_size, 我们需要一个独立的Python版本
@@ -1135,25 +4076,21 @@ def upload_file():
                 save_path = os.path.join(current_path, f"{name}({i}){ext}")
                 i += 1
         
-        # 使用临时文件保存，然后原子移动
-        temp_path = save_path + '.tmp'
+        # 先写入暂存文件，然后原子地放到最终位置
+        spool = None
         try:
             # 确保目录存在
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            file.save(temp_path)
+            spool = upload_spool.create(save_path, file_size)
+            file.save(spool.file)
             
-            # 原子移动到最终位置
-            if os.path.exists(save_path):
-                os.remove(save_path)
-            os.rename(temp_path, save_path)
-        except Exception as e:
-            # 清理临时文件
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
+            dedup_store.finalize(spool, save_path)
+            paths_changed(save_path)
             
+            usage_user_id = session_usage_user_id()
+            if usage_user_id is not None:
+                adjust_user_usage(usage_user_id, file_size)
+        except Exception as e:
             error_msg = str(e)
             if "Permission denied" in error_msg or "being used by another process" in error_msg:
                 flash("文件被占用或权限不足，请稍后重试", 'error')
@@ -1162,39 +4099,280 @@ def upload_file():
             else:
                 flash(f"上传失败: {error_msg}", 'error')
             return redirect(request.referrer or url_for('root'))
+        finally:
+            if spool is not None:
+                spool.close()
         
         # 记录上传操作
-        db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
+        audit_writer.write("""
             INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
             VALUES (?, ?, ?, ?, ?)
         """, (session['user_id'], 'upload', os.path.basename(save_path), file_size, 'completed'))
-        conn.commit()
-        conn.close()
         
         flash(f"文件 '{os.path.basename(save_path)}' 上传成功", 'success')
 
-    # 返回到上传时所在的目录
-    if subpath:
-        return redirect(url_for('browse', subpath=subpath))
-    return redirect(url_for('root'))
+    # 返回到上传时所在的目录
+    if subpath:
+        return redirect(url_for('browse', subpath=subpath))
+    return redirect(url_for('root'))
+
+
+# --- 断点续传上传 ---
+# 协议流程（类似 tus）：
+#   POST   /resumable/init                      创建上传，返回 upload_id 和分块大小
+#   GET    /resumable/<upload_id>               查询已接收的分块和连续偏移量
+#   PUT    /resumable/<upload_id>/chunks/<n>    上传第 n 个分块（可多个连接并行）
+#   POST   /resumable/<upload_id>/commit        所有分块到齐后移动到最终位置
+#   DELETE /resumable/<upload_id>               放弃上传
+# 分块直接按偏移量写入同一个 .part 文件，上传状态保存在数据库中，服务重启后可以继续。
+
+RESUMABLE_DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+RESUMABLE_MIN_CHUNK_SIZE = 1024 * 1024
+RESUMABLE_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+def _load_resumable_upload(cursor, upload_id):
+    """读取属于当前用户且仍在进行中的断点续传记录"""
+    cursor.execute("""
+        SELECT * FROM resumable_uploads WHERE id = ? AND user_id = ? AND status = 'uploading'
+    """, (upload_id, session['user_id']))
+    return cursor.fetchone()
+
+@app.route('/resumable/init', methods=['POST'])
+def resumable_init():
+    """创建断点续传上传"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    if session.get('is_visitor'):
+        return jsonify({'error': '访客无法上传文件'}), 403
+    
+    data = request.get_json() or {}
+    filename = data.get('filename', '')
+    subpath = data.get('subpath', '')
+    file_size = data.get('file_size')
+    chunk_size = data.get('chunk_size') or RESUMABLE_DEFAULT_CHUNK_SIZE
+    
+    if not filename:
+        return jsonify({'error': '未选择文件'}), 400
+    if not isinstance(file_size, int) or file_size < 0:
+        return jsonify({'error': '文件大小无效'}), 400
+    if not isinstance(chunk_size, int):
+        return jsonify({'error': '分块大小无效'}), 400
+    chunk_size = max(RESUMABLE_MIN_CHUNK_SIZE, min(chunk_size, RESUMABLE_MAX_CHUNK_SIZE))
+    
+    save_path, error = _resolve_upload_target(safe_filename(filename), subpath, file_size)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    # .part 文件按完整大小预分配，初始化时就预占配额：提交时不再计入，放弃或过期时退回
+    usage_user_id = session_usage_user_id()
+    if usage_user_id is not None:
+        cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (usage_user_id,))
+        quota_bytes = cursor.fetchone()['quota_gb'] * (1024**3)
+        if not reserve_user_usage(usage_user_id, session['username'], file_size, quota_bytes):
+            return jsonify({'error': '空间不足'}), 413
+    
+    upload_id = str(uuid.uuid4())
+    total_chunks = max(1, -(-file_size // chunk_size))
+    
+    try:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        # .part 文件需要在服务重启后继续写入，放在暂存目录中而不是 O_TMPFILE
+        temp_path = os.path.join(upload_spool.spool_dir(save_path), f'{upload_id}.part')
+        # 预先分配目标大小（不支持 fallocate 时为稀疏文件），各分块按偏移量写入
+        with open(temp_path, 'wb') as f:
+            if not (app.config['GRACEDISK_CONFIG'].get('upload_preallocate', True)
+                    and preallocate(f.fileno(), file_size)):
+                f.truncate(file_size)
+    except OSError as e:
+        if usage_user_id is not None:
+            adjust_user_usage(usage_user_id, -file_size)
+        return jsonify({'error': f'创建上传失败: {e}'}), 500
+    
+    cursor.execute("""
+        INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
+        VALUES (?, ?, ?, ?, ?)
+    """, (session['user_id'], 'upload', os.path.basename(save_path), file_size, 'in_progress'))
+    operation_id = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO resumable_uploads (id, user_id, usage_user_id, save_path, temp_path, file_size,
+                                       chunk_size, total_chunks, operation_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (upload_id, session['user_id'], usage_user_id, save_path, temp_path, file_size,
+          chunk_size, total_chunks, operation_id))
+    conn.commit()
+    
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'chunk_size': chunk_size,
+        'total_chunks': total_chunks
+    })
+
+@app.route('/resumable/<upload_id>', methods=['GET'])
+def resumable_status(upload_id):
+    """查询断点续传进度，客户端据此跳过已上传的分块"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    upload = _load_resumable_upload(cursor, upload_id)
+    if not upload:
+        return jsonify({'error': '上传不存在或已结束'}), 404
+    cursor.execute("""
+        SELECT chunk_index FROM resumable_chunks WHERE upload_id = ? ORDER BY chunk_index
+    """, (upload_id,))
+    received = [row['chunk_index'] for row in cursor.fetchall()]
+    
+    # 连续偏移量：从文件开头起不间断收到的字节数
+    contiguous = 0
+    while contiguous < len(received) and received[contiguous] == contiguous:
+        contiguous += 1
+    offset = min(contiguous * upload['chunk_size'], upload['file_size'])
+    
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'filename': os.path.basename(upload['save_path']),
+        'file_size': upload['file_size'],
+        'chunk_size': upload['chunk_size'],
+        'total_chunks': upload['total_chunks'],
+        'received_chunks': received,
+        'offset': offset
+    })
+
+@app.route('/resumable/<upload_id>/chunks/<int:chunk_index>', methods=['PUT'])
+@upload_slot
+def resumable_put_chunk(upload_id, chunk_index):
+    """写入一个分块，同一分块重复上传会覆盖之前的数据"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    upload = _load_resumable_upload(cursor, upload_id)
+    if not upload:
+        return jsonify({'error': '上传不存在或已结束'}), 404
+    
+    if chunk_index < 0 or chunk_index >= upload['total_chunks']:
+        return jsonify({'error': '分块序号超出范围'}), 400
+    
+    offset = chunk_index * upload['chunk_size']
+    expected_size = min(upload['chunk_size'], upload['file_size'] - offset)
+    if request.content_length != expected_size:
+        return jsonify({'error': f'分块大小应为 {expected_size} 字节'}), 400
+    
+    try:
+        fd = os.open(upload['temp_path'], os.O_WRONLY)
+        try:
+            written = 0
+            while written < expected_size:
+                data = request.stream.read(min(UPLOAD_CHUNK_SIZE, expected_size - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        return jsonify({'error': f'写入分块失败: {e}'}), 500
+    
+    if written != expected_size:
+        return jsonify({'error': '分块数据不完整'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR REPLACE INTO resumable_chunks (upload_id, chunk_index, size) VALUES (?, ?, ?)
+    """, (upload_id, chunk_index, written))
+    cursor.execute("UPDATE resumable_uploads SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (upload_id,))
+    conn.commit()
+    
+    return jsonify({'success': True, 'chunk_index': chunk_index, 'size': written})
+
+@app.route('/resumable/<upload_id>/commit', methods=['POST'])
+def resumable_commit(upload_id):
+    """所有分块到齐后，把 .part 文件移动到最终位置"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    upload = _load_resumable_upload(cursor, upload_id)
+    if not upload:
+        return jsonify({'error': '上传不存在或已结束'}), 404
+    
+    cursor.execute("SELECT COUNT(*) AS received FROM resumable_chunks WHERE upload_id = ?", (upload_id,))
+    received = cursor.fetchone()['received']
+    if received < upload['total_chunks'] and upload['file_size'] > 0:
+        return jsonify({'error': '分块尚未全部上传',
+                        'received': received,
+                        'total_chunks': upload['total_chunks']}), 409
+    
+    # 初始化之后目标位置可能被占用，重新处理文件名冲突
+    save_path = unique_path(upload['save_path'])
+    if save_path is None:
+        return jsonify({'error': '文件名冲突过多，请重命名文件'}), 400
+    
+    try:
+        # 分块可能乱序到达，去重所需的摘要在这里读取整个文件计算
+        spool = upload_spool.adopt(upload['temp_path'])
+        dedup_store.finalize(spool, save_path)
+    except OSError as e:
+        return jsonify({'error': f'保存文件失败: {e}'}), 500
+    # 与已有内容共用 blob 时 .part 文件仍在，在这里删除
+    spool.close()
+    paths_changed(save_path)
+    
+    cursor.execute("DELETE FROM resumable_chunks WHERE upload_id = ?", (upload_id,))
+    cursor.execute("""
+        UPDATE resumable_uploads SET status = 'completed', save_path = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    """, (save_path, upload_id))
+    cursor.execute("UPDATE file_operations SET status = 'completed', file_path = ? WHERE id = ?",
+                   (os.path.basename(save_path), upload['operation_id']))
+    conn.commit()
+    # 配额已在初始化时预占
+    
+    return jsonify({'success': True, 'filename': os.path.basename(save_path), 'file_size': upload['file_size']})
+
+@app.route('/resumable/<upload_id>', methods=['DELETE'])
+def resumable_abort(upload_id):
+    """放弃断点续传上传并删除已接收的数据"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    upload = _load_resumable_upload(cursor, upload_id)
+    if not upload:
+        return jsonify({'error': '上传不存在或已结束'}), 404
+    
+    if os.path.exists(upload['temp_path']):
+        try:
+            os.remove(upload['temp_path'])
+        except OSError as e:
+            return jsonify({'error': f'删除临时文件失败: {e}'}), 500
+        paths_changed(upload['temp_path'])
+    
+    _abort_resumable_upload(cursor, upload)
+    conn.commit()
+    
+    return jsonify({'success': True})
 
 
 @app.route('/manage_users')
 @admin_required
 def manage_users():
-    config = app.config['GRACEDISK_CONFIG']
-    db_path = config.get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # 查询所有非管理员用户
     cursor.execute("SELECT id, username, quota_gb FROM users WHERE is_admin = 0")
     users = cursor.fetchall()
-    conn.close()
     
     return render_template('manage_users.html', users=users)
 
@@ -1207,10 +4385,7 @@ def delete_user(user_id):
         # 可以通过flash消息给用户更明确的提示
         return redirect(url_for('manage_users'))
 
-    config = app.config['GRACEDISK_CONFIG']
-    db_path = config.get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
 
     # 删除前先获取用户名，以便删除文件夹
@@ -1220,27 +4395,26 @@ def delete_user(user_id):
     if user:
         # 1. 从数据库中删除用户
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        cursor.execute("DELETE FROM user_usage WHERE user_id = ?", (user_id,))
+        user_folder = os.path.join('userfiles', user['username'])
+        # 回收站中的项目随用户文件夹一起删除
+        cursor.execute("DELETE FROM trash_items WHERE root = ?", (os.path.abspath(user_folder),))
         conn.commit()
 
         # 2. 删除用户对应的文件夹
-        user_folder = os.path.join('userfiles', user['username'])
         if os.path.exists(user_folder):
             try:
-                shutil.rmtree(user_folder)
+                delete_in_background(session['user_id'], 'userfiles', [user_folder], None)
             except OSError as e:
                 # TODO: 记录删除文件夹失败的错误
                 print(f"Error deleting folder {user_folder}: {e}")
     
-    conn.close()
     return redirect(url_for('manage_users'))
 
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_user(user_id):
-    config = app.config['GRACEDISK_CONFIG']
-    db_path = config.get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
 
     error = None
@@ -1260,13 +4434,11 @@ def edit_user(user_id):
                            (new_quota_gb, user_id))
         
         conn.commit()
-        conn.close()
         return redirect(url_for('manage_users'))
 
     # 处理首次加载页面 (GET请求)
     cursor.execute("SELECT id, username, quota_gb FROM users WHERE id = ?", (user_id,))
     user = cursor.fetchone()
-    conn.close()
 
     if not user:
         # 如果找不到用户，重定向回管理页面
@@ -1287,9 +4459,7 @@ def add_user():
         if not username or not password:
             error = '用户名和密码不能为空'
         else:
-            config = app.config['GRACEDISK_CONFIG']
-            db_path = config.get('users_db_path', 'users.db')
-            conn = sqlite3.connect(db_path)
+            conn = get_db()
             cursor = conn.cursor()
 
             # 检查用户名是否已存在
@@ -1315,7 +4485,6 @@ def add_user():
                 if not error:
                     return redirect(url_for('manage_users'))
 
-            conn.close()
 
     return render_template('add_user.html', error=error)
 
@@ -1347,15 +4516,11 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        db_path = config.get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        # 让查询结果可以像字典一样通过列名访问
-        conn.row_factory = sqlite3.Row 
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
         user = cursor.fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password'], password):
             # 登录成功，设置 session
@@ -1401,13 +4566,11 @@ def change_password():
             error = "密码长度至少需要8位"
         else:
             hashed_password = generate_password_hash(new_password)
-            db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-            conn = sqlite3.connect(db_path)
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET password = ?, must_change_password = ? WHERE id = ?",
                            (hashed_password, False, session['user_id']))
             conn.commit()
-            conn.close()
 
             session['must_change_password'] = False
             flash("密码已成功更新！", "success")
@@ -1415,148 +4578,1184 @@ def change_password():
 
     return render_template('change_password.html', error=error)
 
-@app.route('/create_folder', methods=['POST'])
+@app.route('/create_folder', methods=['POST'])
+@password_change_required
+def create_folder():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    if session.get('is_visitor'):
+        return jsonify({'error': '访客无法创建文件夹'}), 403
+    
+    data = request.get_json()
+    folder_name = data.get('name', '').strip()
+    subpath = data.get('subpath', '')
+    
+    if not folder_name:
+        return jsonify({'error': '文件夹名称不能为空'}), 400
+    
+    # 安全检查文件夹名称
+    if any(char in folder_name for char in ['/', '\\', ':', '*', '?', '"', '<', '>', '|']):
+        return jsonify({'error': '文件夹名称包含非法字符'}), 400
+    
+    # 确定基础路径
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+    
+    # 构建安全路径
+    safe_subpath = os.path.normpath(subpath).lstrip('.\\/')
+    current_path = os.path.join(base_path, safe_subpath)
+    
+    if not os.path.abspath(current_path).startswith(os.path.abspath(base_path)):
+        return jsonify({'error': '无效路径'}), 400
+    
+    folder_path = os.path.join(current_path, folder_name)
+    
+    if os.path.exists(folder_path):
+        return jsonify({'error': '文件夹已存在'}), 400
+    
+    try:
+        os.makedirs(folder_path)
+        paths_changed(folder_path)
+        return jsonify({'success': True})
+    except OSError as e:
+        return jsonify({'error': f'创建失败: {e}'}), 500
+
+@app.route('/rename', methods=['POST'])
+@password_change_required
+def rename_item():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    if session.get('is_visitor'):
+        return jsonify({'error': '访客无法重命名文件'}), 403
+    
+    data = request.get_json()
+    old_path = data.get('old_path', '')
+    new_name = data.get('new_name', '').strip()
+    
+    if not old_path or not new_name:
+        return jsonify({'error': '参数不完整'}), 400
+    
+    # 安全检查新名称
+    if any(char in new_name for char in ['/', '\\', ':', '*', '?', '"', '<', '>', '|']):
+        return jsonify({'error': '名称包含非法字符'}), 400
+    
+    # 确定基础路径
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+    
+    # 构建安全路径
+    safe_old_path = os.path.normpath(old_path).lstrip('.\\/')
+    old_full_path = os.path.join(base_path, safe_old_path)
+    
+    if not os.path.abspath(old_full_path).startswith(os.path.abspath(base_path)):
+        return jsonify({'error': '无效路径'}), 400
+    
+    if not os.path.exists(old_full_path):
+        return jsonify({'error': '文件不存在'}), 404
+    
+    # 构建新路径
+    new_full_path = os.path.join(os.path.dirname(old_full_path), new_name)
+    
+    if os.path.exists(new_full_path):
+        return jsonify({'error': '目标名称已存在'}), 400
+    
+    try:
+        os.rename(old_full_path, new_full_path)
+        paths_changed(old_full_path, new_full_path)
+        return jsonify({'success': True})
+    except OSError as e:
+        return jsonify({'error': f'重命名失败: {e}'}), 500
+
+@app.route('/batch_delete', methods=['POST'])
+@password_change_required
+def batch_delete():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    if session.get('is_visitor'):
+        return jsonify({'error': '访客无法删除文件'}), 403
+    
+    data = request.get_json()
+    items = data.get('items', [])
+    
+    if not items:
+        return jsonify({'error': '没有选择要删除的项目'}), 400
+    
+    # 确定基础路径
+    if session.get('is_admin'):
+        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
+    else:
+        base_path = os.path.join('userfiles', session['username'])
+    
+    full_paths = []
+    errors = []
+    
+    for item_path in items:
+        safe_path = os.path.normpath(item_path).lstrip('.\\/')
+        full_path = os.path.join(base_path, safe_path)
+        
+        if (not os.path.abspath(full_path).startswith(os.path.abspath(base_path))
+                or os.path.abspath(full_path) == os.path.abspath(base_path)):
+            errors.append(f'{item_path}: 无效路径')
+            continue
+        
+        if not os.path.lexists(full_path):
+            errors.append(f'{item_path}: 文件不存在')
+            continue
+        
+        full_paths.append((item_path, full_path))
+    
+    # 全部移入回收站；未开启回收站时移入同一个 .trash 目录，由一个后台任务删除
+    deleted_count = 0
+    job_id = None
+    if full_paths:
+        try:
+            deleted_count, failed, job_id = delete_items(
+                session['user_id'], base_path, full_paths, session_usage_user_id())
+            errors.extend(failed)
+        except OSError as e:
+            errors.append(str(e))
+    
+    if errors:
+        return jsonify({'success': False, 'errors': errors, 'deleted': deleted_count, 'job_id': job_id}), 207
+    
+    return jsonify({'success': True, 'deleted': deleted_count, 'job_id': job_id})
+
+# --- 后台任务 ---
+# 批量删除、大量数据的复制/移动等耗时操作作为后台任务执行：请求只做校验和登记（写入 jobs 表），立即返回 job_id。
+# 每个进程有 job_workers 个工作线程，从 jobs 表中认领排队的任务（在一条 UPDATE 中认领，多个进程不会重复执行）。
+# 处理函数通过 Job.report() 汇报进度：每 PROGRESS_INTERVAL 秒发送一次 job_progress 事件，
+# 每 JOB_HEARTBEAT_INTERVAL 秒把 payload（处理函数自己的断点）、进度和账本变化在同一事务中保存（心跳）。
+# 进程退出或崩溃后，心跳超过 JOB_STALE_AFTER 秒的任务重新排队，由处理函数根据 payload 中的断点继续执行。
+# 进度和结果通过 Socket.IO 的 job_progress / job_complete 事件发送到用户房间 user_<id>（该用户打开的所有页面），
+# 也可以用 GET /jobs、GET /jobs/<job_id> 查询；POST /jobs/<job_id>/cancel 取消支持取消的任务，在下一次心跳时生效。
+JOB_HEARTBEAT_INTERVAL = 1.0
+JOB_STALE_AFTER = 60
+# 空闲的工作线程每隔多少秒检查一次其他进程登记的任务和需要恢复的任务
+JOB_POLL_INTERVAL = 2.0
+# 已结束的任务保留多少天
+JOB_KEEP_DAYS = 7
+JOB_FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+class JobCancelled(Exception):
+    """任务被取消时由 Job.report() / Job.checkpoint() 抛出，处理函数清理后应重新抛出"""
+
+class JobLost(Exception):
+    """任务已被重新排队并由其他工作线程认领（本线程心跳超时）时由 Job.checkpoint() 抛出；
+    处理函数不要捕获它，也不要清理：临时文件等已经属于新的执行者"""
+
+def user_room(user_id):
+    return f'user_{user_id}'
+
+def job_to_dict(row):
+    return {
+        'job_id': row['id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'progress': json.loads(row['progress'] or '{}'),
+        'result': json.loads(row['result']) if row['result'] else None,
+        'created_at': row['created_at'],
+        'finished_at': row['finished_at'],
+    }
+
+class Job:
+    """正在执行的任务，传给处理函数；payload 可以直接修改，随心跳一起保存"""
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.user_id = row['user_id']
+        self.payload = json.loads(row['payload'])
+        self.progress = json.loads(row['progress'] or '{}')
+        self.cancel_requested = row['status'] == 'cancelling'
+        # 认领时间作为认领凭据：重新排队、被其他线程认领后不再相同，本线程的保存不再生效
+        self.claim = row['started_at']
+        self._usage = {}
+        self._last_beat = time.monotonic()
+        self._last_emit = 0
+
+    def add_usage(self, user_id, delta_bytes):
+        """记录账本变化，在下一次保存时与断点一起提交"""
+        if user_id is not None and delta_bytes:
+            self._usage[user_id] = self._usage.get(user_id, 0) + delta_bytes
+
+    def report(self, **progress):
+        """更新进度（可以频繁调用）；到时间时发送和保存，任务被取消时抛出 JobCancelled"""
+        self.progress.update(progress)
+        now = time.monotonic()
+        if now - self._last_emit >= PROGRESS_INTERVAL:
+            self._last_emit = now
+            self._emit('job_progress', {'job_id': self.id, 'kind': self.kind, 'status': 'running',
+                                       'progress': self.progress})
+        if now - self._last_beat >= JOB_HEARTBEAT_INTERVAL:
+            self.checkpoint()
+
+    def keepalive(self):
+        """只发送心跳（到时间时），不检查取消；用于不能中途停止的阶段，如删除源文件、取消后的清理"""
+        if time.monotonic() - self._last_beat >= JOB_HEARTBEAT_INTERVAL:
+            self.checkpoint(check_cancel=False)
+
+    def checkpoint(self, check_cancel=True):
+        """立即保存断点、进度和账本变化；任务被取消时抛出 JobCancelled，认领已失效时抛出 JobLost"""
+        self._last_beat = time.monotonic()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE jobs SET payload = ?, progress = ?, heartbeat_at = ? WHERE id = ? AND started_at = ?
+            RETURNING status
+        """, (json.dumps(self.payload), json.dumps(self.progress), time.time(), self.id, self.claim))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            raise JobLost()
+        status = row['status']
+        self._flush_usage(cursor)
+        conn.commit()
+        if check_cancel and status == 'cancelling':
+            self.cancel_requested = True
+            raise JobCancelled()
+
+    def _flush_usage(self, cursor):
+        for user_id, delta_bytes in self._usage.items():
+            cursor.execute("UPDATE user_usage SET used_bytes = MAX(used_bytes + ?, 0) WHERE user_id = ?",
+                           (delta_bytes, user_id))
+        self._usage = {}
+
+    def finish(self, status, result):
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE jobs SET status = ?, payload = ?, progress = ?, result = ?, finished_at = ?
+            WHERE id = ? AND started_at = ?
+        """, (status, json.dumps(self.payload), json.dumps(self.progress), json.dumps(result), time.time(),
+              self.id, self.claim))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            raise JobLost()
+        self._flush_usage(cursor)
+        conn.commit()
+        cursor.execute("SELECT * FROM jobs WHERE id = ?", (self.id,))
+        self._emit('job_complete', job_to_dict(cursor.fetchone()))
+
+    def _emit(self, event, data):
+        try:
+            socketio.emit(event, data, room=user_room(self.user_id))
+        except Exception as e:
+            print(f'Error sending {event} for job {self.id}: {e}')
+
+class JobManager:
+    """后台任务的登记、认领和工作线程"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._threads = []
+        self._handlers = {}
+        self._last_recover = 0
+
+    def register(self, kind, handler, cancellable=False):
+        """登记任务类型：handler(job) 返回结果字典（含非空 errors 时任务记为 failed）"""
+        self._handlers[kind] = (handler, cancellable)
+
+    def start(self):
+        """启动工作线程；与 AuditWriter 相同，fork 出的子进程会重新启动"""
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            workers = app.config['GRACEDISK_CONFIG'].get('job_workers', 2)
+            while len(self._threads) < workers:
+                thread = threading.Thread(target=self._run, name=f'job-worker-{len(self._threads)}')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind, user_id, payload):
+        """登记一个任务并唤醒工作线程，返回 job_id"""
+        job_id = uuid.uuid4().hex
+        conn = get_db()
+        conn.execute("""
+            INSERT INTO jobs (id, user_id, kind, status, payload, created_at) VALUES (?, ?, ?, 'queued', ?, ?)
+        """, (job_id, user_id, kind, json.dumps(payload), time.time()))
+        conn.commit()
+        self.start()
+        with self._cond:
+            self._cond.notify()
+        return job_id
+
+    def get(self, job_id, user_id):
+        cursor = get_db().cursor()
+        cursor.execute("SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id))
+        return cursor.fetchone()
+
+    def list(self, user_id, limit=20):
+        cursor = get_db().cursor()
+        cursor.execute("SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit))
+        return cursor.fetchall()
+
+    def cancel(self, job_id, user_id):
+        """请求取消，返回 None 或 (错误信息, 状态码)"""
+        row = self.get(job_id, user_id)
+        if row is None:
+            return ('任务不存在', 404)
+        if not self._handlers[row['kind']][1]:
+            return ('该任务不能取消', 409)
+        conn = get_db()
+        cursor = conn.cursor()
+        # 尚未开始的任务也由工作线程认领后处理取消（如退回预占的配额）
+        cursor.execute("UPDATE jobs SET status = 'cancelling' WHERE id = ? AND status IN ('queued', 'running')",
+                       (job_id,))
+        conn.commit()
+        if cursor.rowcount == 0 and row['status'] != 'cancelling':
+            return ('任务已结束', 409)
+        return None
+
+    def counts(self):
+        cursor = get_db().cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in cursor.fetchall()}
+
+    def purge(self):
+        """删除结束超过 JOB_KEEP_DAYS 天的任务记录"""
+        conn = get_db()
+        conn.execute(f"DELETE FROM jobs WHERE status IN {JOB_FINISHED_STATUSES} AND finished_at < ?",
+                     (time.time() - JOB_KEEP_DAYS * 86400,))
+        conn.commit()
+
+    def _claim(self):
+        """认领一个排队的任务（包括心跳超时、需要恢复的任务），没有时返回 None"""
+        conn = get_db()
+        cursor = conn.cursor()
+        now = time.time()
+        if now - self._last_recover >= JOB_STALE_AFTER / 2:
+            self._last_recover = now
+            cursor.execute("""
+                UPDATE jobs SET started_at = NULL, status = CASE status WHEN 'running' THEN 'queued' ELSE status END
+                WHERE status IN ('running', 'cancelling') AND started_at IS NOT NULL AND heartbeat_at < ?
+            """, (now - JOB_STALE_AFTER,))
+            if cursor.rowcount:
+                print(f'Requeued {cursor.rowcount} stale background jobs')
+            conn.commit()
+        cursor.execute("SELECT 1 FROM jobs WHERE started_at IS NULL AND status IN ('queued', 'cancelling') LIMIT 1")
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute("""
+            UPDATE jobs SET status = CASE status WHEN 'queued' THEN 'running' ELSE status END,
+                            started_at = ?, heartbeat_at = ?
+            WHERE id = (SELECT id FROM jobs WHERE started_at IS NULL AND status IN ('queued', 'cancelling')
+                        ORDER BY created_at LIMIT 1)
+            RETURNING *
+        """, (now, now))
+        row = cursor.fetchone()
+        conn.commit()
+        return row
+
+    def _run(self):
+        while True:
+            try:
+                row = self._claim()
+            except sqlite3.Error as e:
+                print(f'Job claim failed: {e}')
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(JOB_POLL_INTERVAL)
+                continue
+            self._execute(row)
+
+    def _execute(self, row):
+        job = Job(row)
+        handler = self._handlers.get(job.kind, (None,))[0]
+        try:
+            if handler is None:
+                raise ValueError(f'unknown job kind {job.kind}')
+            # 认领前已被取消的任务也交给处理函数：它在第一次 checkpoint() 时收到 JobCancelled 并自行清理
+            result = handler(job) or {}
+            status = 'failed' if result.get('errors') else 'completed'
+        except JobLost:
+            print(f'Job {job.id} ({job.kind}) was requeued after a missed heartbeat, stopping this run')
+            return
+        except JobCancelled:
+            result = {'errors': []}
+            status = 'cancelled'
+        except Exception as e:
+            print(f'Job {job.id} ({job.kind}) failed: {e}')
+            result = {'errors': [str(e)]}
+            status = 'failed'
+        try:
+            job.finish(status, result)
+        except JobLost:
+            print(f'Job {job.id} ({job.kind}) was requeued before it finished, result discarded')
+        except Exception as e:
+            print(f'Failed to record result of job {job.id}: {e}')
+
+job_manager = JobManager()
+
+# --- 删除 ---
+# 删除时先把选中的项目改名移入所在存储根目录下的 .trash/<job_id>/（同一文件系统内 O(1)），请求立即完成；
+# 再由后台 delete 任务逐个删除其中的文件，并按删除的文件大小扣减用户账本。
+# .trash 不出现在文件列表和搜索结果中。
+TRASH_DIR_NAME = '.trash'
+
+def system_dir_names():
+    """存储根目录中不对用户显示的目录名：回收站和上传暂存目录"""
+    return (TRASH_DIR_NAME, upload_spool.dir_name)
+
+def is_system_dir(path):
+    """path 是否为某个存储根目录（storage_path、userfiles/<用户名>）或 userfiles 下的 .trash 或上传暂存目录"""
+    path = os.path.abspath(path)
+    if os.path.basename(path) not in system_dir_names():
+        return False
+    parent = os.path.dirname(path)
+    userfiles = os.path.abspath('userfiles')
+    return (parent == os.path.abspath(app.config['GRACEDISK_CONFIG'].get('storage_path'))
+            or parent == userfiles or os.path.dirname(parent) == userfiles)
+
+def delete_in_background(user_id, trash_parent, full_paths, usage_user_id):
+    """把 full_paths 移入 trash_parent/.trash/ 下的一个新目录，并登记后台删除任务
+
+    返回 (job_id, 成功移走的路径列表, [(路径, 错误), ...])，没有移走任何项目时 job_id 为 None。
+    """
+    stage = os.path.join(trash_parent, TRASH_DIR_NAME, uuid.uuid4().hex)
+    os.makedirs(stage)
+    moved, errors = [], []
+    for full_path in full_paths:
+        try:
+            os.rename(full_path, os.path.join(stage, str(len(moved))))
+            moved.append(full_path)
+        except OSError as e:
+            errors.append((full_path, e))
+    job_id = None
+    if moved:
+        paths_changed(*moved)
+        job_id = job_manager.submit('delete', user_id, {
+            'stage': os.path.abspath(stage),
+            'usage_user_id': usage_user_id,
+            'files': 0,
+            'freed_bytes': 0,
+        })
+    else:
+        os.rmdir(stage)
+    return job_id, moved, errors
+
+def purge_tree(path):
+    """逐个删除 path（文件或文件夹）中的文件，每删除一个文件产出它的大小；path 不存在时什么也不做"""
+    if not os.path.lexists(path):
+        return
+    if os.path.islink(path) or not os.path.isdir(path):
+        # 与 get_folder_size 一致，符号链接不计入占用
+        is_link = os.path.islink(path)
+        file_stat = os.lstat(path)
+        dedup_store.note_unlink(file_stat)
+        os.remove(path)
+        yield 0 if is_link else file_stat.st_size
+        return
+    dirs = []
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        dirs.append(current)
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                file_stat = entry.stat(follow_symlinks=False)
+                dedup_store.note_unlink(file_stat)
+                os.remove(entry.path)
+                yield 0 if entry.is_symlink() else file_stat.st_size
+    # 先序遍历的逆序：子目录总在父目录之前删除
+    for current in reversed(dirs):
+        os.rmdir(current)
+
+def run_delete_job(job):
+    """删除 stage 目录中的所有内容；中断后重新执行时跳过已经不存在的部分"""
+    p = job.payload
+    usage_user_id = p.get('usage_user_id')
+    for size in purge_tree(p['stage']):
+        p['files'] += 1
+        p['freed_bytes'] += size
+        job.add_usage(usage_user_id, -size)
+        job.report(files=p['files'], freed_bytes=p['freed_bytes'])
+    dedup_store.schedule_collect()
+    return {'files': p['files'], 'freed_bytes': p['freed_bytes']}
+
+job_manager.register('delete', run_delete_job)
+
+# --- 回收站 ---
+# trash_retention_days 大于 0 时，删除的项目改名移入所在存储根目录的 .trash/<随机名>（O(1)），并在 trash_items 表中
+# 记录原路径、大小和删除时间，可以在回收站页面恢复或彻底删除；等于 0 时直接由后台任务删除（见 delete_in_background）。
+# 超过保留期的项目由低优先级的清理线程（start_trash_purger）分批删除：每秒最多删除 trash_purge_rate 个文件，
+# 还可以用 trash_purge_hours 限定在夜间等空闲时段进行，大量项目同时到期也不会占满磁盘 I/O。
+# 配额：回收站中的内容仍在磁盘上，继续计入所有者的已用空间（对账扫描也包含 .trash），彻底删除时才扣减；
+# 需要空间时可以清空回收站立即释放。
+TRASH_PURGE_INTERVAL = 600
+# 每删除多少个文件提交一次账本变化并检查限速
+TRASH_PURGE_BATCH = 100
+# 认领清理的项目超过多少秒没有进展视为中断（进程退出），可以被重新认领
+TRASH_PURGE_STALE = 300
+trash_wakeup = threading.Event()
+
+def trash_retention_seconds():
+    return app.config['GRACEDISK_CONFIG'].get('trash_retention_days', 30) * 86400
+
+def move_to_trash(user_id, base_path, items, usage_user_id):
+    """把 [(请求中的路径, 完整路径), ...] 移入 base_path/.trash 并登记，返回 (移入的数量, 错误列表)"""
+    root = os.path.abspath(base_path)
+    trash_dir = os.path.join(root, TRASH_DIR_NAME)
+    os.makedirs(trash_dir, exist_ok=True)
+    now = time.time()
+    rows = []
+    for item_path, full_path in items:
+        full_path = os.path.abspath(full_path)
+        is_dir = os.path.isdir(full_path) and not os.path.islink(full_path)
+        try:
+            # 文件的大小现在就能得到，文件夹的大小由清理线程稍后计算，删除请求不遍历目录
+            size = None if is_dir else os.lstat(full_path).st_size
+        except OSError:
+            size = None
+        rows.append((item_path, full_path, (root, os.path.relpath(full_path, root).replace(os.sep, '/'),
+                                            uuid.uuid4().hex, is_dir, size, usage_user_id, user_id, now)))
+    # 先登记再移动：进程在两步之间退出时只会留下指向不存在文件的记录（清理时删除），不会留下无人知道的文件
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO trash_items (root, path, stored_name, is_dir, size, usage_user_id, deleted_by, deleted_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [row for _, _, row in rows])
+    conn.commit()
+    moved, errors, failed = [], [], []
+    for item_path, full_path, row in rows:
+        try:
+            os.rename(full_path, os.path.join(trash_dir, row[2]))
+            moved.append(full_path)
+        except OSError as e:
+            errors.append(f'{item_path}: {e}')
+            failed.append((root, row[2]))
+    if failed:
+        cursor.executemany("DELETE FROM trash_items WHERE root = ? AND stored_name = ?", failed)
+        conn.commit()
+    if moved:
+        paths_changed(*moved)
+        trash_wakeup.set()
+    return len(moved), errors
+
+def delete_items(user_id, base_path, items, usage_user_id):
+    """删除 [(请求中的路径, 完整路径), ...]：开启回收站时移入回收站，否则由后台任务删除
+
+    返回 (删除的数量, 错误列表, 后台任务 ID 或 None)。
+    """
+    if trash_retention_seconds() > 0:
+        count, errors = move_to_trash(user_id, base_path, items, usage_user_id)
+        return count, errors, None
+    names = {os.path.abspath(full_path): item_path for item_path, full_path in items}
+    job_id, moved, failed = delete_in_background(user_id, base_path, list(names), usage_user_id)
+    return len(moved), [f'{names[path]}: {e}' for path, e in failed], job_id
+
+def get_trash_bytes(base_path):
+    """回收站中已知大小的项目的总字节数（新删除的文件夹在清理线程计算大小之前不计入）"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT COALESCE(SUM(size), 0) FROM trash_items WHERE root = ? AND purge_started_at IS NULL",
+                   (os.path.abspath(base_path),))
+    return cursor.fetchone()[0]
+
+def trash_item_path(row):
+    return os.path.join(row['root'], TRASH_DIR_NAME, row['stored_name'])
+
+def list_trash(base_path):
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT * FROM trash_items WHERE root = ? AND purge_started_at IS NULL ORDER BY deleted_at DESC
+    """, (os.path.abspath(base_path),))
+    return cursor.fetchall()
+
+def _take_trash_items(base_path, item_ids):
+    """从记录中取出（删除）根目录下指定 ID 的项目，正在被清理的项目除外"""
+    conn = get_db()
+    cursor = conn.cursor()
+    rows = []
+    for item_id in item_ids:
+        cursor.execute("""
+            DELETE FROM trash_items WHERE id = ? AND root = ? AND purge_started_at IS NULL RETURNING *
+        """, (item_id, os.path.abspath(base_path)))
+        row = cursor.fetchone()
+        if row is not None:
+            rows.append(row)
+    conn.commit()
+    return rows
+
+def restore_trash_items(base_path, item_ids):
+    """把项目移回原位置（原位置已有同名项目时自动改名），返回 (恢复的数量, 错误列表)"""
+    conn = get_db()
+    restored, errors = 0, []
+    for row in _take_trash_items(base_path, item_ids):
+        target = unique_path(os.path.join(row['root'], row['path']), row['is_dir'])
+        try:
+            if target is None:
+                raise OSError('文件名冲突过多')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(trash_item_path(row), target)
+        except OSError as e:
+            errors.append(f"{row['path']}: {e}")
+            # 放回记录，仍留在回收站中
+            conn.execute("""
+                INSERT INTO trash_items (id, root, path, stored_name, is_dir, size, usage_user_id, deleted_by, deleted_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (row['id'], row['root'], row['path'], row['stored_name'], row['is_dir'], row['size'],
+                  row['usage_user_id'], row['deleted_by'], row['deleted_at']))
+            conn.commit()
+            continue
+        paths_changed(target)
+        restored += 1
+    return restored, errors
+
+def purge_trash_items(user_id, base_path, item_ids):
+    """彻底删除回收站中的项目（不限速，由后台任务执行），返回 (删除的数量, 后台任务 ID 或 None)"""
+    rows = _take_trash_items(base_path, item_ids)
+    if not rows:
+        return 0, None
+    job_id, moved, _ = delete_in_background(user_id, base_path, [trash_item_path(row) for row in rows
+                                                                 if os.path.lexists(trash_item_path(row))],
+                                            rows[0]['usage_user_id'])
+    return len(rows), job_id
+
+def in_trash_purge_window():
+    """当前时间是否在 trash_purge_hours（如 "1-6"，表示 1:00 到 6:00；可以跨零点）之内，未配置时总是 True"""
+    hours = app.config['GRACEDISK_CONFIG'].get('trash_purge_hours')
+    if not hours:
+        return True
+    start, end = (int(h) for h in str(hours).split('-'))
+    hour = datetime.now().hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+def measure_trash_sizes():
+    """计算回收站中尚未记录大小的文件夹"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, root, stored_name FROM trash_items WHERE size IS NULL AND purge_started_at IS NULL")
+    for row in cursor.fetchall():
+        conn.execute("UPDATE trash_items SET size = ? WHERE id = ?", (get_path_size(trash_item_path(row)), row['id']))
+        conn.commit()
+
+def purge_trash_item(item_id, rate=None):
+    """认领并删除一个回收站项目，每删除 TRASH_PURGE_BATCH 个文件在一个事务中扣减账本并续期认领；
+    rate 为每秒最多删除的文件数。返回删除的文件数，项目已被其他进程认领时返回 0"""
+    conn = get_db()
+    cursor = conn.cursor()
+    now = time.time()
+    cursor.execute("""
+        UPDATE trash_items SET purge_started_at = ?
+        WHERE id = ? AND (purge_started_at IS NULL OR purge_started_at < ?) RETURNING *
+    """, (now, item_id, now - TRASH_PURGE_STALE))
+    row = cursor.fetchone()
+    conn.commit()
+    if row is None:
+        return 0
+    files = freed = 0
+    start = time.monotonic()
+    for size in purge_tree(trash_item_path(row)):
+        files += 1
+        freed += size
+        if files % TRASH_PURGE_BATCH == 0:
+            if row['usage_user_id'] is not None:
+                cursor.execute("UPDATE user_usage SET used_bytes = MAX(used_bytes - ?, 0) WHERE user_id = ?",
+                               (freed, row['usage_user_id']))
+            cursor.execute("UPDATE trash_items SET purge_started_at = ? WHERE id = ?", (time.time(), item_id))
+            conn.commit()
+            freed = 0
+            if rate:
+                delay = files / rate - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+    if row['usage_user_id'] is not None:
+        cursor.execute("UPDATE user_usage SET used_bytes = MAX(used_bytes - ?, 0) WHERE user_id = ?",
+                       (freed, row['usage_user_id']))
+    cursor.execute("DELETE FROM trash_items WHERE id = ?", (item_id,))
+    conn.commit()
+    return files
+
+def purge_expired_trash():
+    """按删除时间顺序清理超过保留期的项目，离开 trash_purge_hours 时段时停止"""
+    retention = trash_retention_seconds()
+    if retention <= 0:
+        return 0
+    rate = app.config['GRACEDISK_CONFIG'].get('trash_purge_rate', 500)
+    cursor = get_db().cursor()
+    cursor.execute("SELECT id FROM trash_items WHERE deleted_at < ? ORDER BY deleted_at",
+                   (time.time() - retention,))
+    purged = 0
+    for (item_id,) in cursor.fetchall():
+        if not in_trash_purge_window():
+            break
+        purged += purge_trash_item(item_id, rate)
+    if purged:
+        print(f'Trash purger: removed {purged} expired files')
+        dedup_store.schedule_collect()
+    return purged
+
+def start_trash_purger():
+    """启动回收站清理线程：计算新删除文件夹的大小，定期清理过期项目"""
+    def purge_task():
+        # Linux 上 nice 值按线程设置；BFQ 等 I/O 调度器也据此降低它的 I/O 优先级。
+        # 协程模式下所有协程共用一个系统线程，不能降低
+        if get_server_settings()['async_mode'] == 'threading' and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+        while True:
+            try:
+                trash_wakeup.wait(TRASH_PURGE_INTERVAL)
+                trash_wakeup.clear()
+                measure_trash_sizes()
+                purge_expired_trash()
+            except Exception as e:
+                print(f'Trash purger error: {e}')
+
+    purge_thread = threading.Thread(target=purge_task, name='trash-purger')
+    purge_thread.daemon = True
+    purge_thread.start()
+
+def _trash_base_path():
+    """当前用户回收站所在的存储根目录，访客返回 None"""
+    if session.get('is_visitor'):
+        return None
+    if session.get('is_admin'):
+        return app.config['GRACEDISK_CONFIG'].get('storage_path')
+    return os.path.join('userfiles', session['username'])
+
+@app.route('/trash')
+@password_change_required
+def trash():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    base_path = _trash_base_path()
+    if base_path is None:
+        flash('访客无法使用回收站', 'error')
+        return redirect(url_for('root'))
+    retention = trash_retention_seconds()
+    items = [dict(row, deleted_time=datetime.fromtimestamp(row['deleted_at']),
+                  expires_at=datetime.fromtimestamp(row['deleted_at'] + retention))
+             for row in list_trash(base_path)]
+    return render_template('trash.html', items=items, trash_enabled=retention > 0,
+                           retention_days=app.config['GRACEDISK_CONFIG'].get('trash_retention_days', 30),
+                           total_bytes=sum(item['size'] or 0 for item in items))
+
+def _trash_request_ids():
+    data = request.get_json(silent=True) or {}
+    try:
+        return [int(item_id) for item_id in data.get('ids', [])]
+    except (TypeError, ValueError):
+        return None
+
+@app.route('/trash/restore', methods=['POST'])
+@password_change_required
+def trash_restore():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    base_path = _trash_base_path()
+    if base_path is None:
+        return jsonify({'error': '访客无法使用回收站'}), 403
+    item_ids = _trash_request_ids()
+    if not item_ids:
+        return jsonify({'error': '没有选择要恢复的项目'}), 400
+    restored, errors = restore_trash_items(base_path, item_ids)
+    if not restored and not errors:
+        return jsonify({'error': '回收站中没有这些项目'}), 404
+    if errors:
+        return jsonify({'success': False, 'errors': errors, 'restored': restored}), 207
+    return jsonify({'success': True, 'restored': restored})
+
+@app.route('/trash/delete', methods=['POST'])
 @password_change_required
-def create_folder():
+def trash_delete():
+    """彻底删除选中的项目，由后台任务立即删除（不受清理限速影响），账本在删除时扣减"""
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 403
-    
-    if session.get('is_visitor'):
-        return jsonify({'error': '访客无法创建文件夹'}), 403
-    
-    data = request.get_json()
-    folder_name = data.get('name', '').strip()
-    subpath = data.get('subpath', '')
-    
-    if not folder_name:
-        return jsonify({'error': '文件夹名称不能为空'}), 400
-    
-    # 安全检查文件夹名称
-    if any(char in folder_name for char in ['/', '\\', ':', '*', '?', '"', '<', '>', '|']):
-        return jsonify({'error': '文件夹名称包含非法字符'}), 400
-    
-    # 确定基础路径
-    if session.get('is_admin'):
-        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
-    else:
-        base_path = os.path.join('userfiles', session['username'])
-    
-    # 构建安全路径
-    safe_subpath = os.path.normpath(subpath).lstrip('.\\/')
-    current_path = os.path.join(base_path, safe_subpath)
-    
-    if not os.path.abspath(current_path).startswith(os.path.abspath(base_path)):
-        return jsonify({'error': '无效路径'}), 400
-    
-    folder_path = os.path.join(current_path, folder_name)
-    
-    if os.path.exists(folder_path):
-        return jsonify({'error': '文件夹已存在'}), 400
-    
-    try:
-        os.makedirs(folder_path)
-        return jsonify({'success': True})
-    except OSError as e:
-        return jsonify({'error': f'创建失败: {e}'}), 500
+    base_path = _trash_base_path()
+    if base_path is None:
+        return jsonify({'error': '访客无法使用回收站'}), 403
+    item_ids = _trash_request_ids()
+    if not item_ids:
+        return jsonify({'error': '没有选择要删除的项目'}), 400
+    deleted, job_id = purge_trash_items(session['user_id'], base_path, item_ids)
+    if not deleted:
+        return jsonify({'error': '回收站中没有这些项目'}), 404
+    return jsonify({'success': True, 'deleted': deleted, 'job_id': job_id})
 
-@app.route('/rename', methods=['POST'])
+@app.route('/trash/empty', methods=['POST'])
 @password_change_required
-def rename_item():
+def trash_empty():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 403
-    
-    if session.get('is_visitor'):
-        return jsonify({'error': '访客无法重命名文件'}), 403
-    
-    data = request.get_json()
-    old_path = data.get('old_path', '')
-    new_name = data.get('new_name', '').strip()
-    
-    if not old_path or not new_name:
-        return jsonify({'error': '参数不完整'}), 400
-    
-    # 安全检查新名称
-    if any(char in new_name for char in ['/', '\\', ':', '*', '?', '"', '<', '>', '|']):
-        return jsonify({'error': '名称包含非法字符'}), 400
-    
-    # 确定基础路径
-    if session.get('is_admin'):
-        base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
-    else:
-        base_path = os.path.join('userfiles', session['username'])
-    
-    # 构建安全路径
-    safe_old_path = os.path.normpath(old_path).lstrip('.\\/')
-    old_full_path = os.path.join(base_path, safe_old_path)
-    
-    if not os.path.abspath(old_full_path).startswith(os.path.abspath(base_path)):
-        return jsonify({'error': '无效路径'}), 400
-    
-    if not os.path.exists(old_full_path):
-        return jsonify({'error': '文件不存在'}), 404
-    
-    # 构建新路径
-    new_full_path = os.path.join(os.path.dirname(old_full_path), new_name)
-    
-    if os.path.exists(new_full_path):
-        return jsonify({'error': '目标名称已存在'}), 400
-    
+    base_path = _trash_base_path()
+    if base_path is None:
+        return jsonify({'error': '访客无法使用回收站'}), 403
+    item_ids = [row['id'] for row in list_trash(base_path)]
+    deleted, job_id = purge_trash_items(session['user_id'], base_path, item_ids)
+    return jsonify({'success': True, 'deleted': deleted, 'job_id': job_id})
+
+# --- 服务器端移动和复制 ---
+# /move 和 /copy 在同一个存储根目录内批量移动、复制文件和文件夹，不再需要下载后重新上传。
+# 同一文件系统内的移动就是一次 rename，与文件大小无关；跨文件系统（EXDEV）时先复制再删除源文件。
+# 复制文件时依次尝试：
+#   FICLONE          btrfs、XFS 等支持 reflink 的文件系统只共享数据块，不复制数据
+#   copy_file_range  由内核在两个文件之间直接复制，数据不经过用户态（NFS 等可以在服务器端完成）
+#   分块读写          以上都不支持时
+# 需要复制的数据超过 FILE_JOB_INLINE_BYTES 时登记为后台任务（见 job_manager），请求立即返回 202 和 job_id，
+# 可以取消，服务重启后从中断的项目继续。
+# 配额：复制开始前用一条 UPDATE 检查并预占全部大小（见 reserve_user_usage），结束后退回失败项目的部分，
+# 并发的复制和上传不会一起超出配额。符号链接不会被复制（可能指向存储目录之外）。
+FILE_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+FILE_JOB_INLINE_BYTES = 64 * 1024 * 1024
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def _clone_file(src_fd, dst_fd):
+    """尝试用 reflink 让 dst 共享 src 的数据块，成功返回 True"""
     try:
-        os.rename(old_full_path, new_full_path)
-        return jsonify({'success': True})
-    except OSError as e:
-        return jsonify({'error': f'重命名失败: {e}'}), 500
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (ImportError, OSError):
+        return False
 
-@app.route('/batch_delete', methods=['POST'])
-@password_change_required
-def batch_delete():
+def copy_file_data(src_path, dst_path, progress=None):
+    """把 src_path 的内容复制到新建的 dst_path，返回使用的方式：reflink / copy_file_range / stream
+
+    progress(n) 在每复制 n 个字节后调用。
+    """
+    with open(src_path, 'rb', buffering=0) as fsrc, open(dst_path, 'xb', buffering=0) as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        if size and _clone_file(src_fd, dst_fd):
+            if progress:
+                progress(size)
+            return 'reflink'
+        method = 'stream'
+        if hasattr(os, 'copy_file_range'):
+            copied = 0
+            try:
+                while True:
+                    n = os.copy_file_range(src_fd, dst_fd, FILE_COPY_CHUNK_SIZE)
+                    if not n:
+                        break
+                    copied += n
+                    if progress:
+                        progress(n)
+            except OSError as e:
+                # 内核或文件系统不支持（旧内核跨文件系统时为 EXDEV）：从头改为分块读写
+                if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+            if copied:
+                method = 'copy_file_range'
+        # copy_file_range 不可用或提前返回 0 时（部分虚拟文件系统），从当前位置继续分块复制
+        while True:
+            block = os.read(src_fd, FILE_COPY_CHUNK_SIZE)
+            if not block:
+                break
+            view = memoryview(block)
+            while view:
+                view = view[os.write(dst_fd, view):]
+            if progress:
+                progress(len(block))
+        return method
+
+class FileJob:
+    """一次 /move 或 /copy 请求：按 payload 逐项执行，数据量大时作为后台任务（job 不为 None）运行
+
+    payload 中的 index 是下一个要处理的项目，current 记录正在处理的项目的目标路径和阶段，
+    任务中断后重新执行时据此清理只复制了一半的临时文件，或者跳过已经完成的项目。
+    """
+
+    def __init__(self, payload, job=None):
+        self.p = payload
+        self.job = job
+
+    def run(self):
+        p = self.p
+        try:
+            if self.job:
+                self.job.checkpoint()  # 排队时已被取消：在这里收到 JobCancelled，退回预占的配额
+            self._resume()
+            while p['index'] < len(p['items']):
+                item_path, full_path, size = p['items'][p['index']]
+                try:
+                    if p['op'] == 'move':
+                        self._move(full_path)
+                    else:
+                        self._copy(full_path)
+                        p['committed_bytes'] += size
+                    p['done_items'] += 1
+                except (OSError, ValueError) as e:
+                    p['errors'].append(f'{item_path}: {e}')
+                p['current'] = None
+                p['index'] += 1
+                self._report()
+        except JobCancelled:
+            self._release_quota()
+            raise
+        self._release_quota()
+        return {'done': p['done_items'], 'errors': p['errors'], 'methods': p['methods']}
+
+    def _release_quota(self):
+        """退回预占但没有用到的配额（失败、取消或未执行的项目）"""
+        p = self.p
+        if p.get('usage_user_id') is None:
+            return
+        delta_bytes = p['committed_bytes'] - p['reserved_bytes']
+        p['reserved_bytes'] = p['committed_bytes']
+        if self.job:
+            self.job.add_usage(p['usage_user_id'], delta_bytes)
+        else:
+            adjust_user_usage(p['usage_user_id'], delta_bytes)
+
+    def _report(self, force=False):
+        if self.job is None:
+            return
+        p = self.p
+        self.job.report(done_items=p['done_items'], total_items=len(p['items']), done_bytes=p['done_bytes'],
+                        total_bytes=p['total_bytes'],
+                        percent=p['done_bytes'] / p['total_bytes'] * 100 if p['total_bytes'] else 100)
+        if force:
+            self.job.checkpoint()
+
+    def _progress(self, n):
+        self.p['done_bytes'] += n
+        self._report()
+
+    def _begin(self, target, phase):
+        """记录当前项目的目标路径和阶段，后台任务中立即保存"""
+        self.p['current'] = {'target': target, 'phase': phase}
+        self._report(force=True)
+
+    def _resume(self):
+        """上次中断时正在处理的项目：清理临时文件或确认已经完成"""
+        p = self.p
+        current = p.get('current')
+        if not current:
+            return
+        _, full_path, size = p['items'][p['index']]
+        target = current['target']
+        temp_path = target + '.copy.tmp'
+        done = False
+        if current['phase'] == 'remove_source':
+            # 跨文件系统移动已复制完成，继续删除源文件
+            self._remove(full_path)
+            done = True
+        elif os.path.lexists(temp_path):
+            self._remove(temp_path)
+        elif os.path.lexists(target) and (p['op'] == 'copy' or not os.path.lexists(full_path)):
+            done = True
+        if done:
+            if p['op'] == 'copy':
+                p['committed_bytes'] += size
+            p['done_items'] += 1
+            p['index'] += 1
+        p['current'] = None
+
+    def _remove(self, path):
+        """逐个删除文件或文件夹中的文件，后台任务中保持心跳（大文件夹可能需要很久），不响应取消"""
+        for _ in purge_tree(path):
+            if self.job:
+                self.job.keepalive()
+
+    def _count_method(self, method):
+        self.p['methods'][method] = self.p['methods'].get(method, 0) + 1
+
+    def _move(self, src):
+        target = os.path.join(self.p['dest_dir'], os.path.basename(src))
+        if os.path.lexists(target):
+            raise ValueError('目标文件夹中已存在同名项目')
+        try:
+            os.rename(src, target)
+            self._count_method('rename')
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._begin(target, 'copy')
+            self._copy_to(src, target)
+            self._begin(target, 'remove_source')
+            self._remove(src)
+        paths_changed(src, target)
+
+    def _copy(self, src):
+        target = unique_path(os.path.join(self.p['dest_dir'], os.path.basename(src)), os.path.isdir(src))
+        if target is None:
+            raise ValueError('文件名冲突过多，请重命名文件')
+        self._begin(target, 'copy')
+        self._copy_to(src, target)
+        paths_changed(target)
+
+    def _copy_to(self, src, target):
+        """复制文件或整个文件夹到 target.copy.tmp，完成后改名为 target；失败或取消时删除临时文件"""
+        temp_path = target + '.copy.tmp'
+        try:
+            if os.path.isdir(src):
+                os.mkdir(temp_path)
+                for dirpath, dirnames, filenames in os.walk(src):
+                    # 只有空文件夹或空文件时也要保持心跳
+                    self._report()
+                    target_dir = os.path.join(temp_path, os.path.relpath(dirpath, src))
+                    for dirname in dirnames:
+                        if not os.path.islink(os.path.join(dirpath, dirname)):
+                            os.mkdir(os.path.join(target_dir, dirname))
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        if not os.path.islink(path):
+                            self._copy_file(path, os.path.join(target_dir, filename))
+            else:
+                self._copy_file(src, temp_path)
+            os.rename(temp_path, target)
+        except (OSError, JobCancelled):
+            self._remove(temp_path)
+            raise
+
+    def _copy_file(self, src, dst):
+        self._count_method(copy_file_data(src, dst, self._progress))
+        # 保留修改时间，不复制权限（去重存储中的 blob 是只读的）
+        stat = os.stat(src)
+        os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def run_file_job(job):
+    return FileJob(job.payload, job).run()
+
+job_manager.register('copy', run_file_job, cancellable=True)
+job_manager.register('move', run_file_job, cancellable=True)
+
+def _start_file_job(op):
+    """/move 和 /copy 共用：校验参数、预占配额，小任务直接执行，大任务登记为后台任务"""
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 403
-    
+
     if session.get('is_visitor'):
-        return jsonify({'error': '访客无法删除文件'}), 403
-    
-    data = request.get_json()
+        return jsonify({'error': '访客无法移动或复制文件'}), 403
+
+    data = request.get_json(silent=True) or {}
     items = data.get('items', [])
-    
+    destination = data.get('destination', '')
+
     if not items:
-        return jsonify({'error': '没有选择要删除的项目'}), 400
-    
+        return jsonify({'error': '没有选择项目'}), 400
+
     # 确定基础路径
     if session.get('is_admin'):
         base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
     else:
         base_path = os.path.join('userfiles', session['username'])
-    
-    deleted_count = 0
+
+    safe_destination = os.path.normpath(destination).lstrip('.\\/')
+    dest_dir = os.path.join(base_path, safe_destination)
+    if not os.path.abspath(dest_dir).startswith(os.path.abspath(base_path)):
+        return jsonify({'error': '无效的目标路径'}), 400
+    if not os.path.isdir(dest_dir):
+        return jsonify({'error': '目标文件夹不存在'}), 404
+
+    dest_abs = os.path.abspath(dest_dir)
+    dest_dev = os.stat(dest_dir).st_dev
+    usage_user_id = session_usage_user_id()
+    plan = []
     errors = []
-    
     for item_path in items:
-        try:
-            safe_path = os.path.normpath(item_path).lstrip('.\\/')
-            full_path = os.path.join(base_path, safe_path)
-            
-            if not os.path.abspath(full_path).startswith(os.path.abspath(base_path)):
-                errors.append(f'{item_path}: 无效路径')
-                continue
-            
-            if not os.path.exists(full_path):
-                errors.append(f'{item_path}: 文件不存在')
+        safe_path = os.path.normpath(item_path).lstrip('.\\/')
+        full_path = os.path.join(base_path, safe_path)
+        src_abs = os.path.abspath(full_path)
+
+        if not src_abs.startswith(os.path.abspath(base_path)) or src_abs == os.path.abspath(base_path):
+            errors.append(f'{item_path}: 无效路径')
+            continue
+        if not os.path.lexists(full_path):
+            errors.append(f'{item_path}: 文件不存在')
+            continue
+        if op == 'copy' and os.path.islink(full_path):
+            errors.append(f'{item_path}: 不能复制符号链接')
+            continue
+        if os.path.isdir(full_path) and (dest_abs == src_abs or dest_abs.startswith(src_abs + os.sep)):
+            errors.append(f'{item_path}: 不能放到自身或其子文件夹中')
+            continue
+        if op == 'move':
+            if os.path.dirname(src_abs) == dest_abs:
+                errors.append(f'{item_path}: 已在目标文件夹中')
                 continue
-            
-            if os.path.isdir(full_path):
-                shutil.rmtree(full_path)
-            else:
-                os.remove(full_path)
-            
-            deleted_count += 1
-        except OSError as e:
-            errors.append(f'{item_path}: {e}')
-    
-    if errors:
-        return jsonify({'success': False, 'errors': errors, 'deleted': deleted_count}), 207
-    
-    return jsonify({'success': True, 'deleted': deleted_count})
+            # 同一文件系统内只需 rename，不需要复制数据
+            needs_copy = os.lstat(full_path).st_dev != dest_dev
+        else:
+            needs_copy = True
+        plan.append((item_path, full_path, get_path_size(full_path) if needs_copy else 0))
+
+    reserved_bytes = 0
+    if op == 'copy' and usage_user_id is not None and plan:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (usage_user_id,))
+        quota_bytes = cursor.fetchone()['quota_gb'] * (1024**3)
+        reserved_bytes = sum(size for _, _, size in plan)
+        if not reserve_user_usage(usage_user_id, session['username'], reserved_bytes, quota_bytes):
+            return jsonify({'error': '空间不足'}), 413
+
+    payload = {
+        'op': op,
+        'dest_dir': os.path.abspath(dest_dir),
+        'items': [(item_path, os.path.abspath(full_path), size) for item_path, full_path, size in plan],
+        'errors': errors,
+        'usage_user_id': usage_user_id if op == 'copy' else None,
+        'reserved_bytes': reserved_bytes,
+        'committed_bytes': 0,
+        'total_bytes': sum(size for _, _, size in plan),
+        'done_bytes': 0,
+        'done_items': 0,
+        'methods': {},
+        'index': 0,
+        'current': None,
+    }
+    if payload['total_bytes'] > FILE_JOB_INLINE_BYTES:
+        job_id = job_manager.submit(op, session['user_id'], payload)
+        return jsonify({'success': True, 'job_id': job_id, 'background': True}), 202
+
+    result = FileJob(payload).run()
+    if result['errors']:
+        return jsonify({'success': False, 'errors': result['errors'], 'done': result['done']}), 207
+    return jsonify({'success': True, 'done': result['done']})
+
+@app.route('/move', methods=['POST'])
+@password_change_required
+def move_items():
+    return _start_file_job('move')
+
+@app.route('/copy', methods=['POST'])
+@password_change_required
+def copy_items():
+    return _start_file_job('copy')
+
+@app.route('/jobs')
+@password_change_required
+def list_jobs():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'jobs': [job_to_dict(row) for row in job_manager.list(session['user_id'])]})
+
+@app.route('/jobs/<job_id>')
+@password_change_required
+def job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    row = job_manager.get(job_id, session['user_id'])
+    if row is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job_to_dict(row))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@password_change_required
+def cancel_job(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    error = job_manager.cancel(job_id, session['user_id'])
+    if error:
+        return jsonify({'error': error[0]}), error[1]
+    return jsonify({'success': True})
 
 @app.route('/create_share', methods=['POST'])
 @password_change_required
@@ -1610,24 +5809,20 @@ def create_share():
         password_hash = generate_password_hash(password)
     
     # 保存到数据库
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO shares (token, file_path, user_id, password_hash, expires_at) 
         VALUES (?, ?, ?, ?, ?)
     """, (token, path, session['user_id'], password_hash, expires_at))
     conn.commit()
-    conn.close()
     
     share_link = url_for('shared_file', token=token, _external=True)
     return jsonify({'success': True, 'link': share_link})
 
 @app.route('/share/<token>')
 def shared_file(token):
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -1637,7 +5832,6 @@ def shared_file(token):
         WHERE s.token = ?
     """, (token,))
     share_data = cursor.fetchone()
-    conn.close()
 
     if not share_data:
         return render_template('share_error.html', 
@@ -1666,12 +5860,12 @@ def shared_file(token):
         
     file_path = os.path.join(base_path, os.path.normpath(share_data['file_path']).lstrip('.\\/'))
     
-    if not os.path.exists(file_path):
+    if not os.path.exists(file_path) or os.path.isdir(file_path):
         return render_template('share_error.html',
                              error_type='not_found', 
                              message='文件已不存在')
         
-    return send_file(file_path, as_attachment=True)
+    return serve_file(file_path, as_attachment=True)
 
 @app.route('/manage_shares')
 @password_change_required
@@ -1679,9 +5873,7 @@ def manage_shares():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     if session.get('is_admin'):
@@ -1703,7 +5895,6 @@ def manage_shares():
         """, (session['user_id'],))
     
     shares = cursor.fetchall()
-    conn.close()
     
     return render_template('manage_shares.html', shares=shares)
 
@@ -1715,8 +5906,7 @@ def delete_share(share_id):
             return jsonify({'error': 'Unauthorized'}), 403
         return redirect(url_for('login'))
     
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -1745,8 +5935,6 @@ def delete_share(share_id):
             flash(message, 'error')
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'error': message}), 500
-    finally:
-        conn.close()
 
     # 如果是Ajax请求，返回JSON响应
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -1755,21 +5943,206 @@ def delete_share(share_id):
     # 否则重定向到管理页面
     return redirect(url_for('manage_shares'))
 
+# --- 流式 ZIP 打包 ---
+# 批量下载时边读取文件边生成 ZIP64 数据直接写入响应：文件内容不在磁盘或内存中暂存，
+# 中央目录记录追加到 SpooledTemporaryFile（超过 1MB 才落盘），无论选中多少文件内存占用都保持不变。
+# 每个条目使用数据描述符（通用标志位 3）在数据之后写入 CRC 和大小，因此不需要回写或预先计算。
+
+ZIP_READ_SIZE = 1024 * 1024
+ZIP_VERSION = 45  # 需要 ZIP64 支持
+ZIP_FLAGS = 0x0008 | 0x0800  # 数据描述符 + UTF-8 文件名
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+def _zip_dos_datetime(timestamp):
+    """转换为 ZIP 使用的 DOS 日期和时间，早于 1980 年的时间按 1980-01-01 处理"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def iter_archive_entries(base_path, items):
+    """
+    把选中的文件和文件夹展开为 (压缩包内路径, 完整路径, 是否文件夹)，
+    文件夹使用 os.walk 逐级遍历，不会一次性列出全部文件。
+    """
+    for item in items:
+        safe_path = os.path.normpath(item).lstrip('.\\/')
+        full_path = os.path.join(base_path, safe_path)
+        if not os.path.abspath(full_path).startswith(os.path.abspath(base_path)):
+            continue
+        if not os.path.exists(full_path):
+            continue
+        
+        parent = os.path.dirname(full_path)
+        if os.path.isfile(full_path):
+            yield os.path.basename(full_path), full_path, False
+            continue
+        
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            dirnames.sort()
+            yield os.path.relpath(dirpath, parent).replace(os.sep, '/') + '/', dirpath, True
+            for name in sorted(filenames):
+                file_path = os.path.join(dirpath, name)
+                # 跳过符号链接，避免链接到用户目录之外的文件
+                if os.path.islink(file_path):
+                    continue
+                yield os.path.relpath(file_path, parent).replace(os.sep, '/'), file_path, False
+
+def iter_zip_stream(entries, compression=ZIP_STORED, stats=None):
+    """
+    根据 iter_archive_entries() 的条目生成 ZIP64 字节流。
+    stats 为字典时，结束后写入 files 和 bytes 统计。
+    """
+    offset = 0
+    entry_count = 0
+    total_bytes = 0
+    central_directory = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        for arcname, full_path, is_dir in entries:
+            try:
+                mtime = os.path.getmtime(full_path)
+                f = None if is_dir else open(full_path, 'rb')
+            except OSError:
+                # 打包过程中文件被删除或无法读取，跳过该条目
+                continue
+            
+            method = ZIP_DEFLATED if compression == ZIP_DEFLATED and not is_dir else ZIP_STORED
+            name = arcname.encode('utf-8')
+            dos_time, dos_date = _zip_dos_datetime(mtime)
+            local_offset = offset
+            
+            # 本地文件头：大小写在 ZIP64 扩展字段和数据描述符中
+            local_extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, ZIP_FLAGS, method,
+                                 dos_time, dos_date, 0, 0xFFFFFFFF, 0xFFFFFFFF,
+                                 len(name), len(local_extra)) + name + local_extra
+            yield header
+            offset += len(header)
+            
+            crc = 0
+            size = 0
+            compressed_size = 0
+            if f is not None:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+                try:
+                    while True:
+                        data = f.read(ZIP_READ_SIZE)
+                        if not data:
+                            break
+                        crc = zlib.crc32(data, crc)
+                        size += len(data)
+                        if compressor:
+                            data = compressor.compress(data)
+                        if data:
+                            compressed_size += len(data)
+                            yield data
+                    if compressor:
+                        data = compressor.flush()
+                        compressed_size += len(data)
+                        if data:
+                            yield data
+                finally:
+                    f.close()
+            offset += compressed_size
+            total_bytes += size
+            
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+            yield descriptor
+            offset += len(descriptor)
+            
+            # 中央目录记录：Unix 权限写入外部属性，文件夹额外带上 MS-DOS 目录标志
+            external_attr = ((0o40755 if is_dir else 0o100644) << 16) | (0x10 if is_dir else 0)
+            central_extra = struct.pack('<HHQQQ', 0x0001, 24, size, compressed_size, local_offset)
+            central_directory.write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS,
+                method, dos_time, dos_date, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(name),
+                len(central_extra), 0, 0, 0, external_attr, 0xFFFFFFFF) + name + central_extra)
+            entry_count += 1
+        
+        # 输出中央目录
+        central_offset = offset
+        central_size = central_directory.tell()
+        central_directory.seek(0)
+        while True:
+            data = central_directory.read(ZIP_READ_SIZE)
+            if not data:
+                break
+            yield data
+        offset += central_size
+        
+        # ZIP64 中央目录结束记录、定位器和传统结束记录
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | ZIP_VERSION, ZIP_VERSION,
+                          0, 0, entry_count, entry_count, central_size, central_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF,
+                          0xFFFFFFFF, 0xFFFFFFFF, 0)
+        
+        if stats is not None:
+            stats['files'] = entry_count
+            stats['bytes'] = total_bytes
+    finally:
+        central_directory.close()
+
+def _stream_batch_archive(base_path, items, compression):
+    """以 ZIP 流的形式返回选中的文件和文件夹，客户端断开时停止读取"""
+    user_id = session['user_id']
+    names = ', '.join(os.path.basename(os.path.normpath(item)) for item in items[:10])
+    if len(items) > 10:
+        names += f' 等 {len(items)} 项'
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, 'download', f"批量下载: {names}", 0, 'in_progress'))
+    operation_id = cursor.lastrowid
+    conn.commit()
+    
+    def generate():
+        stats = {}
+        status = 'interrupted'
+        try:
+            yield from iter_zip_stream(iter_archive_entries(base_path, items), compression, stats)
+            status = 'completed'
+        finally:
+            # 正常结束或客户端断开（WSGI 服务器关闭生成器）时都会执行
+            audit_writer.write("UPDATE file_operations SET status = ?, file_size = ? WHERE id = ?",
+                               (status, stats.get('bytes', 0), operation_id))
+    
+    if len(items) == 1:
+        archive_name = os.path.basename(os.path.normpath(items[0])) + '.zip'
+    else:
+        archive_name = f"GraceDisk_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    headers = {
+        'Content-Disposition': _content_disposition(archive_name),
+        'Cache-Control': 'no-store'
+    }
+    return Response(generate(), mimetype='application/zip', headers=headers, direct_passthrough=True)
+
 @app.route('/batch_download', methods=['POST'])
 @password_change_required
 def batch_download():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    data = request.get_json()
-    items = data.get('items', [])
+    # 打包模式可以由 JSON 或普通表单提交（表单提交时浏览器直接把响应流保存为文件）
+    if request.is_json:
+        data = request.get_json()
+        items = data.get('items', [])
+        mode = data.get('mode', 'links')
+        compression = data.get('compression', 'store')
+    else:
+        items = request.form.getlist('items')
+        mode = request.form.get('mode', 'links')
+        compression = request.form.get('compression', 'store')
     
     if not items:
         return jsonify({'error': '没有选择要下载的项目'}), 400
     
-    if len(items) > 5:
-        return jsonify({'error': '最多只能选择5个项目'}), 400
-    
     # 确定基础路径
     if session.get('is_admin'):
         base_path = app.config['GRACEDISK_CONFIG'].get('storage_path')
@@ -1778,6 +6151,13 @@ def batch_download():
     else:
         base_path = os.path.join('userfiles', session['username'])
     
+    if mode == 'archive':
+        return _stream_batch_archive(base_path, items,
+                                     ZIP_DEFLATED if compression == 'deflate' else ZIP_STORED)
+    
+    if len(items) > 5:
+        return jsonify({'error': '最多只能选择5个项目'}), 400
+    
     valid_files = []
     total_size = 0
 
@@ -1811,15 +6191,10 @@ def batch_download():
         return jsonify({'error':'没有可下载的文件'}),400
     
     # 记录批量下载操作
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
+    audit_writer.write("""
         INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
         VALUES (?, ?, ?, ?, ?)
     """, (session['user_id'], 'download', f"批量下载: {', '.join([f['filename'] for f in valid_files])}", total_size, 'completed'))
-    conn.commit()
-    conn.close()
         
     download_links = []
     for file_data in valid_files:
@@ -1860,9 +6235,7 @@ def file_history():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # 获取用户的文件操作历史
@@ -1874,7 +6247,6 @@ def file_history():
     """, (session['user_id'],))
     
     operations = cursor.fetchall()
-    conn.close()
     
     return render_template('file_history.html', operations=operations)
 
@@ -1893,15 +6265,10 @@ def record_download():
         return jsonify({'error': '文件路径不能为空'}), 400
     
     # 记录下载操作
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
+    audit_writer.write("""
         INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status) 
         VALUES (?, ?, ?, ?, ?)
     """, (session['user_id'], 'download', os.path.basename(file_path), file_size, 'completed'))
-    conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
@@ -1936,24 +6303,22 @@ def get_user_quota():
         if not os.path.exists(base_path):
             os.makedirs(base_path)
         
-        config = app.config['GRACEDISK_CONFIG']
-        db_path = config.get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT quota_gb FROM users WHERE id = ?", (session['user_id'],))
         user_db_info = cursor.fetchone()
-        conn.close()
 
         quota_bytes = user_db_info['quota_gb'] * (1024**3)
-        used_bytes = get_folder_size(base_path)
+        used_bytes = get_user_used_bytes(session['user_id'], session['username'])
         available_bytes = max(0, quota_bytes - used_bytes)
         
         return jsonify({
             'success': True,
             'quota_bytes': quota_bytes,
             'used_bytes': used_bytes,
-            'available_bytes': available_bytes
+            'available_bytes': available_bytes,
+            # used_bytes 中回收站占用的部分，清空回收站可以释放
+            'trash_bytes': get_trash_bytes(base_path)
         })
         
     except Exception as e:
@@ -1965,14 +6330,14 @@ def clear_history():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
 
     try:
-        conn = sqlite3.connect(db_path)
+        # 先写入队列中尚未落盘的记录，再清空
+        audit_writer.flush()
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM file_operations")
         conn.commit()
-        conn.close()
 
         return jsonify({'success': True})
     except Exception as e:
@@ -1989,6 +6354,12 @@ def cleanup_temp_files():
         flash(f'清理失败: {str(e)}', 'error')
     return redirect(url_for('dashboard'))
 
+@app.route('/upload_stats')
+@admin_required
+def upload_stats():
+    """上传队列的实时状态（当前进程），用于调整 upload_max_concurrent 等限制"""
+    return jsonify(dict(upload_scheduler.stats(), pending_cleanups=delayed_tasks.pending()))
+
 @app.route('/dashboard')
 @admin_required
 def dashboard():
@@ -1998,9 +6369,7 @@ def dashboard():
         import time
         from datetime import datetime, timedelta
         
-        db_path = app.config['GRACEDISK_CONFIG'].get('users_db_path', 'users.db')
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         cursor = conn.cursor()
         
         # 获取统计数据
@@ -2028,12 +6397,14 @@ def dashboard():
             
             # 今日登录统计
             today = datetime.now().strftime('%Y-%m-%d')
+            tomorrow = (datetime.strptime(today, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            # 使用时间范围而不是 DATE(created_at) = ?，才能用上 created_at 索引
             cursor.execute("""
                 SELECT login_type, COUNT(*) as count
                 FROM login_logs 
-                WHERE DATE(created_at) = ?
+                WHERE created_at >= ? AND created_at < ?
                 GROUP BY login_type
-            """, (today,))
+            """, (f'{today} 00:00:00', f'{tomorrow} 00:00:00'))
             
             today_logins = {row['login_type']: row['count'] for row in cursor.fetchall()}
             
@@ -2092,7 +6463,6 @@ def dashboard():
         """)
         active_shares = cursor.fetchone()['active_shares']
         
-        conn.close()
         
         # 简化的系统资源统计 - 只获取CPU和内存
         try:
@@ -2127,6 +6497,9 @@ def dashboard():
             'file_operations': file_operations,
             'users': {'total': total_users, 'active': active_users},
             'shares': {'total': total_shares, 'active': active_shares},
+            'uploads': upload_scheduler.stats(),
+            'dedup': dedup_store.stats(),
+            'jobs': job_manager.counts(),
             'system': {
                 'cpu_percent': cpu_percent,
                 'memory': {
@@ -2149,26 +6522,82 @@ def dashboard():
         return redirect(url_for('root'))
 
 
+def start_background_tasks():
+    """启动定期清理、账本对账和文件系统监视；gunicorn 下每个 worker 进程各启动一份"""
+    # 清理上次运行中途退出时遗留的上传临时文件
+    recovered = temp_files.recover()
+    if recovered:
+        print(f'Removed {recovered} temp files left by exited processes')
+    start_cleanup_scheduler()
+    start_usage_reconciler()
+    start_trash_purger()
+    job_manager.start()
+    return start_fs_watcher()
+
+def run_gunicorn(server):
+    """在当前进程中启动 gunicorn 主进程（仅 Linux/macOS）"""
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(arbiter, worker):
+        # Socket.IO 消息队列管理器在主进程中创建，每个 worker 需要自己的 host_id，
+        # 否则会把其他 worker 发布的消息当作自己发出的而忽略
+        manager = socketio.server.manager
+        if isinstance(manager, python_socketio.PubSubManager):
+            manager.host_id = uuid.uuid4().hex
+        start_background_tasks()
+
+    options = {
+        'bind': f"{server['host']}:{server['port']}",
+        'workers': server['workers'],
+        'worker_class': {'threading': 'gthread', 'eventlet': 'eventlet', 'gevent': 'gevent'}[server['async_mode']],
+        'threads': server['threads'],
+        'worker_connections': server['worker_connections'],
+        # 大文件上传/下载可能持续很久，gthread worker 在请求期间也需要按时发送心跳
+        'timeout': server['timeout'],
+        'post_fork': post_fork,
+    }
+
+    class GraceDiskApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    GraceDiskApplication().run()
+
 if __name__ == '__main__':
-    config = app.config['GRACEDISK_CONFIG']
-    server_config = config.get('server', {})
-    
-    host = server_config.get('host', '127.0.0.1')
-    port = server_config.get('port', 5000)
-    debug = server_config.get('debug', True)
+    server = get_server_settings()
+    host = server['host']
+    port = server['port']
+    debug = server['debug']
     
     print(f"🚀 GraceDisk 启动中...")
     print(f"📡 服务器地址: http://{host}:{port}")
     if host == '0.0.0.0':
         print("🌍 服务器已向公网开放，请确保防火墙和安全设置正确！")
+    if server['gunicorn']:
+        print(f"⚙️ 运行方式: gunicorn ({server['async_mode']}), {server['workers']} 个进程 × "
+              f"{server['threads'] if server['async_mode'] == 'threading' else server['worker_connections']} 并发")
+        if server['workers'] > 1 and not server['message_queue']:
+            print("⚠️ 多个 worker 进程但未配置 server.message_queue，上传进度推送可能无法送达")
+        if server['workers'] > 1 and isinstance(upload_sessions, MemoryUploadSessions):
+            print("⚠️ 多个 worker 进程但 upload_state_backend 为 memory，关闭页面时可能无法取消其他进程中的上传")
+    else:
+        print(f"⚙️ 运行方式: 内置服务器 ({server['async_mode']})")
     print(f"🔧 调试模式: {'开启' if debug else '关闭'}")
     print(f"🔌 WebSocket 支持: 已启用")
     print("🧹 自动清理任务: 已启用")
-    print("=" * 50)
+    print("📏 空间账本对账: 已启用")
     
-    # 启动定期清理任务
-    start_cleanup_scheduler()
-    
-    # 使用 SocketIO 启动应用
-    socketio.run(app, host=host, port=port, debug=debug)
-
+    if server['gunicorn']:
+        # 后台任务在每个 worker 进程 fork 之后启动
+        print("=" * 50)
+        run_gunicorn(server)
+    else:
+        watcher = start_background_tasks()
+        print(f"👀 文件系统监视: {watcher.mode if watcher else '关闭'}")
+        print("=" * 50)
+        # threading 模式使用 Werkzeug 开发服务器，正式部署请改用 gunicorn 或 eventlet/gevent
+        socketio.run(app, host=host, port=port, debug=debug, allow_unsafe_werkzeug=True)
@@ -0,0 +1,109 @@
+"""
+审计日志写入延迟基准测试
+
+多个线程模拟请求线程写入登录日志，比较调用方感受到的单次写入延迟：
+  sync     旧实现：在请求线程中 INSERT 并 commit
+  async    audit_writer.write()：放入队列，由后台线程批量提交
+
+用法:
+    python benchmarks/bench_audit_writer.py [--threads 8] [--writes 2000] [--synchronous FULL]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+INSERT_SQL = """
+    INSERT INTO login_logs (user_id, username, login_type, ip_address, user_agent)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def setup_app(workdir):
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app as gracedisk
+    return gracedisk
+
+
+def run(write, threads, writes):
+    """返回 (每秒写入数, 调用延迟列表)"""
+    latencies = [[] for _ in range(threads)]
+
+    def worker(n):
+        for i in range(writes):
+            start = time.perf_counter()
+            write((1, 'admin', 'admin', '127.0.0.1', f'bench-{n}-{i}'))
+            latencies[n].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * writes / elapsed, sorted(sum(latencies, []))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help='并发线程数')
+    parser.add_argument('--writes', type=int, default=2000, help='每个线程的写入次数')
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'],
+                        help='SQLite synchronous 设置（FULL 时每次提交都会 fsync）')
+    args = parser.parse_args()
+
+    gracedisk = setup_app(tempfile.mkdtemp(prefix='gracedisk-bench-'))
+    get_db = gracedisk.get_db
+
+    def configured_db():
+        conn = get_db()
+        conn.execute(f'PRAGMA synchronous={args.synchronous}')
+        return conn
+
+    def sync_write(params):
+        conn = configured_db()
+        conn.execute(INSERT_SQL, params)
+        conn.commit()
+
+    # 写线程也使用相同的 synchronous 设置
+    gracedisk.get_db = configured_db
+
+    print(f'threads={args.threads} writes/thread={args.writes} synchronous={args.synchronous}')
+    print(f"{'mode':<8} {'writes/s':>10} {'p50 (us)':>10} {'p99 (us)':>10} {'max (us)':>10}")
+    print('-' * 52)
+    for mode, write in (('sync', sync_write), ('async', lambda params: gracedisk.audit_writer.write(INSERT_SQL, params))):
+        rate, latencies = run(write, args.threads, args.writes)
+        if mode == 'async':
+            gracedisk.audit_writer.flush()
+        print(f'{mode:<8} {rate:>10.0f} {percentile(latencies, 0.5) * 1e6:>10.1f} '
+              f'{percentile(latencies, 0.99) * 1e6:>10.1f} {latencies[-1] * 1e6:>10.1f}')
+
+    total = get_db().execute('SELECT COUNT(*) FROM login_logs').fetchone()[0]
+    print(f'rows written: {total} (expected {2 * args.threads * args.writes})')
+
+
+if __name__ == '__main__':
+    main()
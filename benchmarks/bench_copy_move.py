@@ -0,0 +1,120 @@
+"""
+服务器端复制和移动基准测试
+
+在存储目录中生成若干测试文件，比较复制同样的数据时各方式的耗时和进程 CPU 时间：
+  stream           分块读写（旧的“下载后重新上传”至少需要这些读写，还要加上两次网络传输）
+  copy_file_range  内核在文件之间直接复制
+  reflink          FICLONE，只在 btrfs、XFS 等文件系统上可用，否则跳过
+  /copy            通过接口复制（copy_file_data 自动选择的方式）
+  /move            通过接口移动（同一文件系统内为 rename）
+--dir 可以指定测试目录所在的文件系统。
+
+用法:
+    python benchmarks/bench_copy_move.py [--files 8] [--size-mb 128] [--dir /mnt/btrfs]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+fs_watch: false
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=8, help='文件数')
+    parser.add_argument('--size-mb', type=int, default=128, help='每个文件的大小（MB）')
+    parser.add_argument('--dir', default=None, help='测试目录的父目录（默认系统临时目录）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-', dir=args.dir)
+    storage = os.path.join(workdir, 'storage')
+    source = os.path.join(storage, 'source')
+    os.makedirs(source)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    block = os.urandom(1024 * 1024)
+    names = [f'file{n:03d}.bin' for n in range(args.files)]
+    for name in names:
+        with open(os.path.join(source, name), 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+    total_mb = args.files * args.size_mb
+
+    def run_direct(mode):
+        target = os.path.join(storage, mode)
+        os.makedirs(target)
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        clone = gracedisk._clone_file
+        if mode != 'reflink':
+            gracedisk._clone_file = lambda src_fd, dst_fd: False
+        if mode == 'stream' and copy_file_range:
+            del os.copy_file_range
+        try:
+            methods = set()
+            for name in names:
+                methods.add(gracedisk.copy_file_data(os.path.join(source, name), os.path.join(target, name)))
+            return methods
+        finally:
+            gracedisk._clone_file = clone
+            if copy_file_range:
+                os.copy_file_range = copy_file_range
+
+    conn = gracedisk.get_db()
+    conn.execute("UPDATE users SET must_change_password = 0")
+    conn.commit()
+    client = gracedisk.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+    os.makedirs(os.path.join(storage, 'api-copy'))
+    os.makedirs(os.path.join(storage, 'api-move'))
+
+    def run_api(op):
+        destination = 'api-copy' if op == 'copy' else 'api-move'
+        response = client.post(f'/{op}', json={'items': [f'source/{name}' for name in names],
+                                                'destination': destination})
+        if response.status_code == 202:
+            job_id = response.get_json()['job_id']
+            while True:
+                status = client.get(f'/jobs/{job_id}').get_json()
+                if status['status'] in gracedisk.JOB_FINISHED_STATUSES:
+                    break
+                time.sleep(0.01)
+            status = status['result'] or {}
+        else:
+            status = response.get_json()
+        return set(status.get('methods', {'rename': 0})) or {'-'}
+
+    print(f'files={args.files} size={args.size_mb}MB dir={workdir}')
+    print(f"{'mode':<16} {'seconds':>8} {'MB/s':>9} {'cpu s':>7}  method")
+    print('-' * 56)
+    for mode in ('stream', 'copy_file_range', 'reflink', '/copy', '/move'):
+        if mode == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            print(f'{mode:<16} skipped (not available)')
+            continue
+        cpu = time.process_time()
+        start = time.perf_counter()
+        methods = run_api(mode[1:]) if mode.startswith('/') else run_direct(mode)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        if mode == 'reflink' and methods != {'reflink'}:
+            print(f'{mode:<16} skipped (filesystem does not support reflink)')
+            continue
+        print(f"{mode:<16} {elapsed:>8.2f} {total_mb / elapsed:>9.0f} {cpu:>7.2f}  {','.join(sorted(methods))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+数据库并发访问基准测试
+
+多个线程同时执行与应用相同的典型操作：写入登录日志、写入文件操作记录、查询用户配额。
+比较两种访问方式：
+  legacy   旧实现：每次操作重新 sqlite3.connect()，默认回滚日志模式，操作后关闭
+  pooled   get_db()：每线程复用连接，WAL 模式，synchronous=NORMAL，busy_timeout
+
+另外通过真实 HTTP 服务器并发请求 /get_user_quota，给出路由级别的 req/s。
+
+用法:
+    python benchmarks/bench_db_concurrency.py [--threads 8] [--ops 500] [--requests 2000]
+"""
+import argparse
+import http.client
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "{db}"
+allow_visiter: false
+"""
+
+
+def setup_app(workdir, db_name):
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage, exist_ok=True)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage, db=db_name))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app as gracedisk
+    cursor = gracedisk.get_db().cursor()
+    cursor.execute("INSERT OR IGNORE INTO users (username, password, is_admin, quota_gb) VALUES (?, ?, 0, 5)",
+                   ('bench', gracedisk.generate_password_hash('bench-password')))
+    gracedisk.get_db().commit()
+    # 关闭主线程的连接，以便切换日志模式
+    gracedisk.get_db().close()
+    gracedisk._db_local.conn = None
+    return gracedisk
+
+
+def legacy_connect(db_path):
+    # 旧实现的连接方式：默认超时、默认回滚日志模式
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+
+
+def run_workload(get_conn, release_conn, threads, ops):
+    """每个线程依次执行 登录日志写入 / 文件操作写入 / 配额查询，返回 (ops/s, 锁错误数)"""
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        for i in range(ops):
+            try:
+                conn = get_conn()
+                cursor = conn.cursor()
+                kind = i % 3
+                if kind == 0:
+                    cursor.execute("""
+                        INSERT INTO login_logs (user_id, username, login_type, ip_address, user_agent)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (2, 'bench', 'user', '127.0.0.1', f'bench-{worker_id}'))
+                    conn.commit()
+                elif kind == 1:
+                    cursor.execute("""
+                        INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (2, 'upload', 'a.bin', 1024, 'completed'))
+                    conn.commit()
+                else:
+                    cursor.execute("SELECT quota_gb FROM users WHERE username = ?", ('bench',))
+                    cursor.fetchone()
+                release_conn(conn)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                with lock:
+                    errors[0] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * ops / elapsed, errors[0]
+
+
+def run_http(gracedisk, threads, total_requests):
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, gracedisk.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', 'username=bench&password=bench-password',
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+    conn.close()
+
+    per_thread = total_requests // threads
+    failures = [0]
+
+    def worker():
+        for _ in range(per_thread):
+            c = http.client.HTTPConnection('127.0.0.1', port)
+            c.request('GET', '/get_user_quota', headers={'Cookie': cookie})
+            r = c.getresponse()
+            r.read()
+            c.close()
+            if r.status != 200:
+                failures[0] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    return per_thread * threads / elapsed, failures[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help='并发线程数')
+    parser.add_argument('--ops', type=int, default=500, help='每个线程执行的数据库操作数')
+    parser.add_argument('--requests', type=int, default=2000, help='HTTP 请求总数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    gracedisk = setup_app(workdir, 'users.db')
+    db_path = os.path.join(workdir, 'users.db')
+
+    print(f'threads={args.threads} ops/thread={args.ops}')
+    print(f"{'mode':<10} {'ops/s':>10} {'locked errors':>15}")
+    print('-' * 37)
+
+    # 旧方式：切回回滚日志模式后每次操作都新建连接
+    legacy_connect(db_path)
+    ops_per_sec, errors = run_workload(lambda: sqlite3.connect(db_path), lambda conn: conn.close(),
+                                       args.threads, args.ops)
+    print(f"{'legacy':<10} {ops_per_sec:>10.0f} {errors:>15}")
+
+    # 新方式：get_db() 首次连接时会重新启用 WAL
+    ops_per_sec, errors = run_workload(gracedisk.get_db, lambda conn: None, args.threads, args.ops)
+    print(f"{'pooled':<10} {ops_per_sec:>10.0f} {errors:>15}")
+
+    req_per_sec, failures = run_http(gracedisk, args.threads, args.requests)
+    print(f'http       {req_per_sec:>10.0f} req/s on /get_user_quota ({failures} failed)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+批量删除基准测试
+
+生成一个包含大量小文件的文件夹，比较删除它时请求的耗时：
+  inline      旧实现：请求中先 os.walk 统计大小，再 shutil.rmtree
+  background  /batch_delete（trash_retention_days: 0）：移入 .trash 后立即返回，由后台任务删除
+  trash       /batch_delete（开启回收站）：移入回收站并登记，文件到期后才由清理线程删除
+background 另外给出后台任务完成删除所用的时间。
+
+用法:
+    python benchmarks/bench_delete.py [--dirs 100] [--files 1000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+fs_watch: false
+trash_retention_days: 0
+"""
+
+
+def make_tree(path, dirs, files):
+    for d in range(dirs):
+        sub = os.path.join(path, f'dir{d:04d}')
+        os.makedirs(sub)
+        for f in range(files):
+            with open(os.path.join(sub, f'file{f:05d}.txt'), 'wb') as fh:
+                fh.write(b'x' * 128)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dirs', type=int, default=100, help='子文件夹数')
+    parser.add_argument('--files', type=int, default=1000, help='每个子文件夹中的文件数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    conn = gracedisk.get_db()
+    conn.execute("UPDATE users SET must_change_password = 0")
+    conn.commit()
+    client = gracedisk.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+
+    print(f'files={args.dirs * args.files}')
+    print(f"{'mode':<12} {'request ms':>11} {'done s':>8}")
+    print('-' * 33)
+
+    tree = os.path.join(storage, 'tree')
+    make_tree(tree, args.dirs, args.files)
+    start = time.perf_counter()
+    gracedisk.get_path_size(tree)
+    shutil.rmtree(tree)
+    elapsed = time.perf_counter() - start
+    print(f"{'inline':<12} {elapsed * 1000:>11.0f} {elapsed:>8.2f}")
+
+    make_tree(tree, args.dirs, args.files)
+    start = time.perf_counter()
+    response = client.post('/batch_delete', json={'items': ['tree']})
+    request_time = time.perf_counter() - start
+    job_id = response.get_json()['job_id']
+    while client.get(f'/jobs/{job_id}').get_json()['status'] not in gracedisk.JOB_FINISHED_STATUSES:
+        time.sleep(0.05)
+    print(f"{'background':<12} {request_time * 1000:>11.0f} {time.perf_counter() - start:>8.2f}")
+
+    make_tree(tree, args.dirs, args.files)
+    gracedisk.app.config['GRACEDISK_CONFIG']['trash_retention_days'] = 30
+    start = time.perf_counter()
+    client.post('/batch_delete', json={'items': ['tree']})
+    request_time = time.perf_counter() - start
+    print(f"{'trash':<12} {request_time * 1000:>11.0f} {'-':>8}")
+
+
+if __name__ == '__main__':
+    main()
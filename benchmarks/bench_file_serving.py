@@ -0,0 +1,156 @@
+"""
+文件发送吞吐量基准测试
+
+在本地启动真实的 HTTP 服务器，通过 /filedata 下载同一个文件，比较：
+  legacy   旧实现：Python 生成器每次读取 4KB
+  engine   新的文件发送引擎（serve_file）
+
+服务器可选 werkzeug（不提供 wsgi.file_wrapper，走对齐大块读取）
+或 wsgiref（提供 wsgi.file_wrapper）。在 gunicorn 下 file_wrapper 会使用 sendfile 零拷贝。
+
+用法:
+    python benchmarks/bench_file_serving.py [--size-mb 256] [--rounds 3] [--server werkzeug]
+"""
+import argparse
+import http.client
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+
+def setup_app(workdir):
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app as gracedisk
+    from flask import Response, session
+
+    @gracedisk.app.route('/bench_legacy/<path:path>')
+    def bench_legacy(path):
+        """旧版 /filedata 的整文件发送方式，作为对照"""
+        if 'user_id' not in session:
+            return 'Forbidden', 403
+        file_path = os.path.join(storage, path)
+
+        def generate_full():
+            with open(file_path, 'rb') as f:
+                while True:
+                    data = f.read(4096)
+                    if not data:
+                        break
+                    yield data
+
+        return Response(generate_full(), headers={'Content-Length': str(os.path.getsize(file_path))})
+
+    return gracedisk, storage
+
+
+def start_server(app, kind):
+    if kind == 'wsgiref':
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, server.server_port
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    body = 'username=admin&password=bench-password'
+    conn.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+    conn.close()
+    return cookie
+
+
+def fetch(port, path, cookie, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    request_headers = {'Cookie': cookie}
+    request_headers.update(headers or {})
+    conn.request('GET', path, headers=request_headers)
+    response = conn.getresponse()
+    total = 0
+    while True:
+        data = response.read(1024 * 1024)
+        if not data:
+            break
+        total += len(data)
+    conn.close()
+    return response.status, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256, help='测试文件大小（MB）')
+    parser.add_argument('--rounds', type=int, default=3, help='每种方式的下载次数')
+    parser.add_argument('--server', choices=['werkzeug', 'wsgiref'], default='werkzeug')
+    parser.add_argument('--range-requests', type=int, default=200, help='随机 1MB 区间请求次数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    gracedisk, storage = setup_app(workdir)
+    size = args.size_mb * 1024 * 1024
+    with open(os.path.join(storage, 'bench.bin'), 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    server, port = start_server(gracedisk.app, args.server)
+    cookie = login(port)
+
+    print(f'server={args.server} file={args.size_mb} MB rounds={args.rounds}')
+    print(f"{'mode':<10} {'MB/s':>10}")
+    print('-' * 22)
+    for mode, path in (('legacy', '/bench_legacy/bench.bin'), ('engine', '/filedata/bench.bin')):
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            status, total = fetch(port, path, cookie)
+            assert status == 200 and total == size, (mode, status, total)
+        elapsed = time.perf_counter() - start
+        print(f'{mode:<10} {size * args.rounds / elapsed / 1024 / 1024:>10.1f}')
+
+    # 随机区间请求，模拟视频拖动
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for _ in range(args.range_requests):
+        offset = rng.randrange(0, size - 1024 * 1024)
+        status, total = fetch(port, '/filedata/bench.bin', cookie,
+                              {'Range': f'bytes={offset}-{offset + 1024 * 1024 - 1}'})
+        assert status == 206 and total == 1024 * 1024, (status, total)
+    elapsed = time.perf_counter() - start
+    print(f'range      {args.range_requests / elapsed:>10.1f} req/s (1MB random ranges)')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
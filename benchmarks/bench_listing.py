@@ -0,0 +1,119 @@
+"""
+目录列表基准测试
+
+在一个包含大量文件的目录上比较：
+  legacy   旧实现：os.listdir + 每个条目 os.stat + os.path.isdir
+  cold     list_directory() 首次读取（os.scandir）
+  warm     list_directory() 命中缓存
+以及通过 test_client 访问 /browse（只嵌入首屏数据）和 /api/list（读取中间的一页）的时间。
+
+用法:
+    python benchmarks/bench_listing.py [--entries 50000] [--rounds 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+
+def legacy_listing(current_path):
+    items = []
+    for name in os.listdir(current_path):
+        item_path = os.path.join(current_path, name)
+        try:
+            stat = os.stat(item_path)
+            is_dir = os.path.isdir(item_path)
+            items.append({
+                'name': name,
+                'is_dir': is_dir,
+                'size': stat.st_size if not is_dir else '-',
+                'mtime': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+            })
+        except OSError:
+            continue
+    items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    return items
+
+
+def timed(func, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=50000, help='目录中的文件数')
+    parser.add_argument('--rounds', type=int, default=5, help='每种方式的重复次数（取最快一次）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    big_dir = os.path.join(storage, 'big')
+    os.makedirs(big_dir)
+    for n in range(args.entries):
+        if n % 50 == 0:
+            os.mkdir(os.path.join(big_dir, f'dir{n:06d}'))
+        else:
+            with open(os.path.join(big_dir, f'file{n:06d}.txt'), 'w') as f:
+                f.write('x')
+    # 让目录 mtime 落在 LISTING_RACY_WINDOW 之外，缓存才会被复用
+    old = time.time() - 60
+    os.utime(big_dir, (old, old))
+
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    def cold():
+        gracedisk.invalidate_listing(os.path.join(big_dir, 'x'))
+        gracedisk.list_directory(big_dir)
+
+    print(f'entries={args.entries}')
+    print(f"{'mode':<10} {'ms':>10}")
+    print('-' * 22)
+    print(f"{'legacy':<10} {timed(lambda: legacy_listing(big_dir), args.rounds) * 1000:>10.1f}")
+    print(f"{'cold':<10} {timed(cold, args.rounds) * 1000:>10.1f}")
+    gracedisk.list_directory(big_dir)
+    print(f"{'warm':<10} {timed(lambda: gracedisk.list_directory(big_dir), args.rounds) * 1000:>10.3f}")
+
+    conn = gracedisk.get_db()
+    conn.execute("UPDATE users SET must_change_password = 0")
+    conn.commit()
+    client = gracedisk.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+
+    page_size = [0]
+
+    def page():
+        response = client.get('/browse/big')
+        assert response.status_code == 200, response.status_code
+        page_size[0] = len(response.data)
+
+    def api_page():
+        response = client.get(f'/api/list?path=big&offset={args.entries // 2}&sort=mtime&order=desc')
+        assert response.status_code == 200, response.status_code
+
+    print(f"{'page':<10} {timed(page, args.rounds) * 1000:>10.1f}  (/browse/big, {page_size[0] / 1024:.0f} KB HTML)")
+    print(f"{'api':<10} {timed(api_page, args.rounds) * 1000:>10.1f}  (/api/list, one page from the middle, sorted by mtime)")
+
+
+if __name__ == '__main__':
+    main()
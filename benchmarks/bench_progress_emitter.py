@@ -0,0 +1,132 @@
+"""
+上传进度消息基准测试
+
+多个 Socket.IO 测试客户端（每个一个房间）各自同时进行若干上传，请求体按 --read-kb 大小分块到达，比较：
+  legacy   旧实现：每个块计算速度和剩余时间，按“每 4 个块 / 进度增加 5%”的规则逐条发送
+  current  real_time_upload_with_progress()：只记录字节数，由 progress_broadcaster 定时合并发送
+输出发送的消息数、消息中的进度条目数和进程 CPU 时间。
+
+用法:
+    python benchmarks/bench_progress_emitter.py [--clients 8] [--uploads 4] [--size-mb 64] [--read-kb 64]
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+fs_watch: false
+"""
+
+
+class ChunkedStream(io.RawIOBase):
+    """模拟请求体：每次 read 最多返回 read_size 字节"""
+
+    def __init__(self, size, read_size, delay):
+        self.remaining = size
+        self.read_size = read_size
+        self.delay = delay
+        self.block = b'x' * read_size
+
+    def read(self, n=-1):
+        n = min(n, self.read_size, self.remaining)
+        self.remaining -= n
+        if self.delay:
+            time.sleep(self.delay)
+        return self.block[:n]
+
+
+def legacy_upload(gracedisk, stream, file_size, save_path, upload_id, room):
+    """旧实现中与进度相关的部分"""
+    chunk_size = gracedisk.UPLOAD_CHUNK_SIZE
+    start_time = time.time()
+    uploaded_bytes = last_emit_bytes = last_progress = 0
+    with open(save_path, 'wb') as f:
+        while uploaded_bytes < file_size:
+            chunk = stream.read(min(chunk_size, file_size - uploaded_bytes))
+            f.write(chunk)
+            uploaded_bytes += len(chunk)
+            elapsed_time = time.time() - start_time
+            progress = (uploaded_bytes / file_size) * 100
+            speed = uploaded_bytes / elapsed_time if elapsed_time > 0 else 0
+            eta = (file_size - uploaded_bytes) / speed if speed > 0 else 0
+            if (uploaded_bytes - last_emit_bytes >= chunk_size * 4 or uploaded_bytes == file_size or
+                    progress - last_progress >= 5):
+                gracedisk.socketio.emit('upload_progress', {
+                    'upload_id': upload_id, 'filename': os.path.basename(save_path), 'progress': progress,
+                    'uploaded_bytes': uploaded_bytes, 'total_bytes': file_size, 'speed': speed, 'eta': eta
+                }, room=room)
+                last_emit_bytes = uploaded_bytes
+                last_progress = progress
+    os.remove(save_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8, help='Socket.IO 客户端（房间）数')
+    parser.add_argument('--uploads', type=int, default=4, help='每个客户端同时进行的上传数')
+    parser.add_argument('--size-mb', type=int, default=64, help='每个上传的大小（MB）')
+    parser.add_argument('--read-kb', type=int, default=64, help='每次从请求体读到的字节数（KB）')
+    parser.add_argument('--delay-ms', type=float, default=0.5, help='每次读取的模拟网络延迟（毫秒）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    size = args.size_mb * 1024 * 1024
+    read_size = args.read_kb * 1024
+    print(f'clients={args.clients} uploads/client={args.uploads} size={args.size_mb}MB read={args.read_kb}KB')
+    print(f"{'mode':<8} {'seconds':>8} {'messages':>9} {'entries':>8} {'cpu s':>7}")
+    print('-' * 45)
+    for mode in ('legacy', 'current'):
+        clients = [gracedisk.socketio.test_client(gracedisk.app) for _ in range(args.clients)]
+        rooms = [gracedisk.socketio.server.manager.sid_from_eio_sid(c.eio_sid, '/') for c in clients]
+
+        def upload(room, n):
+            stream = ChunkedStream(size, read_size, args.delay_ms / 1000)
+            save_path = os.path.join(storage, f'{mode}-{room}-{n}.bin')
+            upload_id = f'{room}-{n}'
+            if mode == 'legacy':
+                legacy_upload(gracedisk, stream, size, save_path, upload_id, room)
+            else:
+                with gracedisk.app.test_request_context():
+                    assert gracedisk.real_time_upload_with_progress(stream, size, save_path, upload_id, 1, room)
+                os.remove(save_path)
+
+        threads = [threading.Thread(target=upload, args=(room, n)) for room in rooms for n in range(args.uploads)]
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        messages = entries = 0
+        for client in clients:
+            for message in client.get_received():
+                if message['name'] == 'upload_progress':
+                    messages += 1
+                    entries += len(message['args'][0].get('uploads', [None]))
+            client.disconnect()
+        print(f'{mode:<8} {elapsed:>8.2f} {messages:>9} {entries:>8} {cpu:>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+文件名搜索基准测试
+
+向搜索索引写入大量模拟的文件记录（不在磁盘上创建文件），然后测量 search_files()
+在不同查询下的耗时：
+  substring   trigram 全文索引子串搜索（常见 / 罕见关键字）
+  prefix      (root, name) 索引前缀搜索
+  short       少于 3 个字符的子串搜索（LIKE 扫描，找到足够结果即停止）
+
+用法:
+    python benchmarks/bench_search.py [--files 1000000] [--rounds 20]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+WORDS = ['report', 'invoice', 'photo', 'holiday', 'project', 'draft', 'final', 'backup', 'scan', 'notes',
+         'meeting', 'budget', 'design', 'video', 'music', 'archive', 'resume', 'contract', 'summary', 'data']
+EXTENSIONS = ['pdf', 'jpg', 'png', 'docx', 'txt', 'mp4', 'zip', 'xlsx']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=1000000, help='索引中的记录数')
+    parser.add_argument('--rounds', type=int, default=20, help='每个查询的重复次数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    rng = random.Random(0)
+    root = os.path.abspath(storage)
+    conn = gracedisk.get_db()
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    batch = []
+    for n in range(args.files):
+        folder = f'{rng.choice(WORDS)}_{n % 997}'
+        name = f'{rng.choice(WORDS)}_{rng.choice(WORDS)}_{n}.{rng.choice(EXTENSIONS)}'
+        batch.append((root, f'{folder}/{name}', name, False, rng.randrange(1 << 24), time.time()))
+        if len(batch) >= 10000:
+            gracedisk._insert_index_rows(cursor, batch)
+            batch = []
+    gracedisk._insert_index_rows(cursor, batch)
+    # 一条罕见的记录
+    gracedisk._insert_index_rows(cursor, [(root, 'misc/quarterly_zebra_plan.pdf', 'quarterly_zebra_plan.pdf',
+                                           False, 1, time.time())])
+    cursor.execute("INSERT INTO file_index_roots (root, status) VALUES (?, 'ready')", (root,))
+    conn.commit()
+    print(f'indexed {args.files} entries in {time.perf_counter() - start:.1f}s '
+          f'(fts={gracedisk.SEARCH_FTS_AVAILABLE})')
+
+    queries = [
+        ('substring', 'zebra', 'rare'),
+        ('substring', 'voice_hol', 'common'),
+        ('substring', '12345', 'digits'),
+        ('prefix', 'quarterly', 'rare'),
+        ('prefix', 'budget_de', 'common'),
+        ('substring', 'ze', 'short'),
+    ]
+    print(f"{'mode':<10} {'query':<12} {'kind':<8} {'results':>8} {'avg ms':>8}")
+    print('-' * 50)
+    for mode, query, kind in queries:
+        elapsed = 0
+        for _ in range(args.rounds):
+            t0 = time.perf_counter()
+            rows, truncated = gracedisk.search_files(root, query, mode)
+            elapsed += time.perf_counter() - t0
+        count = f"{len(rows)}{'+' if truncated else ''}"
+        print(f'{mode:<10} {query:<12} {kind:<8} {count:>8} {elapsed / args.rounds * 1000:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+缩略图基准测试
+
+生成一个模拟的照片文件夹（渐变背景加随机图形，JPEG），比较浏览该文件夹时每张图片需要传输的字节数：
+  original   /filedata 发送的原图
+  small      文件列表中的缩略图
+  large      预览页面中的缩小图片
+并给出首次生成（cold，线程池并发生成）和命中缓存（warm）时的请求耗时。
+
+用法:
+    python benchmarks/bench_thumbnails.py [--images 40] [--width 4000] [--height 3000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+
+def make_photo(path, width, height, rng):
+    from PIL import Image, ImageDraw, ImageFilter
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(20, width // 6)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    # 加一点细节，避免过于容易压缩
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.effect_noise((width, height), 12).convert('RGB')
+    Image.blend(img, noise, 0.08).save(path, quality=90)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=40, help='图片数量')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--threads', type=int, default=8, help='并发请求数（模拟浏览器同时加载）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    photos = os.path.join(storage, 'photos')
+    os.makedirs(photos)
+    rng = random.Random(0)
+    names = [f'IMG_{n:04d}.jpg' for n in range(args.images)]
+    for name in names:
+        make_photo(os.path.join(photos, name), args.width, args.height, rng)
+
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+
+    conn = gracedisk.get_db()
+    conn.execute("UPDATE users SET must_change_password = 0")
+    conn.commit()
+    client = gracedisk.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+
+    def fetch_all(url_format):
+        """并发请求所有图片，返回 (总字节数, 耗时)"""
+        pending = list(names)
+        lock = threading.Lock()
+        total = [0]
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    name = pending.pop()
+                response = client.get(url_format.format(name=name))
+                assert response.status_code == 200, response.status_code
+                with lock:
+                    total[0] += len(response.data)
+
+        workers = [threading.Thread(target=worker) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return total[0], time.perf_counter() - start
+
+    print(f'images={args.images} {args.width}x{args.height}')
+    print(f"{'variant':<10} {'KB/image':>10} {'cold ms/img':>12} {'warm ms/img':>12}")
+    print('-' * 48)
+    for variant, url_format in (('original', '/filedata/photos/{name}'),
+                                ('small', '/thumbnail/photos/{name}?size=small'),
+                                ('large', '/thumbnail/photos/{name}?size=large')):
+        total, cold = fetch_all(url_format)
+        _, warm = fetch_all(url_format)
+        print(f'{variant:<10} {total / args.images / 1024:>10.1f} {cold / args.images * 1000:>12.1f} '
+              f'{warm / args.images * 1000:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+上传准入控制基准测试
+
+模拟一次上传突发：一个用户同时发起大量上传，另外几个用户各上传少量文件，全部通过 /upload_stream
+（test_client，每个上传一个客户端线程）同时发送。比较两种设置：
+  unbounded   不限制并发（相当于旧实现，每个上传都立即写盘）
+  bounded     使用 --concurrent / --per-user 等限制，排队并按用户轮流放行
+输出总耗时、同时写盘的最大上传数、被拒绝的请求数，以及重度用户和其他用户各自的请求延迟，
+用于选择 upload_max_concurrent 等配置。
+
+用法:
+    python benchmarks/bench_upload_admission.py [--heavy 200] [--light-users 4] [--light 5] [--size-kb 1024]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+fs_watch: false
+"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--heavy', type=int, default=200, help='重度用户同时发起的上传数')
+    parser.add_argument('--light-users', type=int, default=4, help='其他用户数')
+    parser.add_argument('--light', type=int, default=5, help='其他用户每人的上传数')
+    parser.add_argument('--size-kb', type=int, default=1024, help='每个文件的大小（KB）')
+    parser.add_argument('--concurrent', type=int, default=8, help='bounded: upload_max_concurrent')
+    parser.add_argument('--per-user', type=int, default=4, help='bounded: upload_max_per_user')
+    parser.add_argument('--queue', type=int, default=256, help='bounded: upload_queue_size')
+    parser.add_argument('--queue-per-user', type=int, default=256, help='bounded: upload_queue_per_user')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as gracedisk
+    from werkzeug.security import generate_password_hash
+
+    names = ['heavy'] + [f'light{n}' for n in range(args.light_users)]
+    conn = gracedisk.get_db()
+    for name in names:
+        conn.execute("INSERT INTO users (username, password, quota_gb, is_admin, can_login, must_change_password) "
+                     "VALUES (?, ?, ?, 0, 1, 0)", (name, generate_password_hash('bench-password'), 1000))
+    conn.commit()
+    clients = {}
+    for name in names:
+        clients[name] = gracedisk.app.test_client()
+        clients[name].post('/login', data={'username': name, 'password': 'bench-password'})
+
+    body = os.urandom(args.size_kb * 1024)
+    config = gracedisk.app.config['GRACEDISK_CONFIG']
+    settings = {
+        'unbounded': dict(upload_max_concurrent=1 << 20, upload_max_per_user=1 << 20,
+                          upload_queue_size=1 << 20, upload_queue_per_user=1 << 20),
+        'bounded': dict(upload_max_concurrent=args.concurrent, upload_max_per_user=args.per_user,
+                        upload_queue_size=args.queue, upload_queue_per_user=args.queue_per_user),
+    }
+
+    print(f'heavy={args.heavy} light={args.light_users}x{args.light} size={args.size_kb}KB '
+          f'bounded: concurrent={args.concurrent} per_user={args.per_user}')
+    print(f"{'mode':<10} {'total s':>8} {'peak':>5} {'429/503':>8} {'heavy p50':>10} {'heavy p95':>10} "
+          f"{'light p50':>10} {'light p95':>10}")
+    print('-' * 78)
+    for mode, limits in settings.items():
+        config.update(limits)
+        gracedisk.upload_scheduler = gracedisk.UploadScheduler()
+        latencies = {'heavy': [], 'light': []}
+        rejected = [0]
+        lock = threading.Lock()
+        start_event = threading.Event()
+
+        def upload(name, n):
+            start_event.wait()
+            start = time.perf_counter()
+            response = clients[name].post(f'/upload_stream?filename={mode}-{n}.bin&upload_id={mode}-{name}-{n}',
+                                          data=body, headers={'X-Socket-ID': f'bench-{name}'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                if response.status_code in (429, 503):
+                    rejected[0] += 1
+                else:
+                    assert response.status_code == 200, response.status_code
+                    latencies['heavy' if name == 'heavy' else 'light'].append(elapsed)
+
+        jobs = [('heavy', n) for n in range(args.heavy)]
+        jobs += [(name, n) for name in names[1:] for n in range(args.light)]
+        threads = [threading.Thread(target=upload, args=job) for job in jobs]
+        for t in threads:
+            t.start()
+
+        peak = [0]
+        done = threading.Event()
+
+        def sample():
+            while not done.is_set():
+                peak[0] = max(peak[0], gracedisk.upload_scheduler.stats()['running'])
+                time.sleep(0.005)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        start = time.perf_counter()
+        start_event.set()
+        for t in threads:
+            t.join()
+        total = time.perf_counter() - start
+        done.set()
+        sampler.join()
+        print(f"{mode:<10} {total:>8.2f} {peak[0]:>5} {rejected[0]:>8} "
+              f"{percentile(latencies['heavy'], 0.5) * 1000:>10.0f} {percentile(latencies['heavy'], 0.95) * 1000:>10.0f} "
+              f"{percentile(latencies['light'], 0.5) * 1000:>10.0f} {percentile(latencies['light'], 0.95) * 1000:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
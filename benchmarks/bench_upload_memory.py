@@ -0,0 +1,123 @@
+"""
+上传内存占用基准测试
+
+对不同大小的文件分别通过 /upload_stream（原始请求体流式上传）、
+/upload_websocket（multipart 表单）和 /upload（传统表单）上传，
+在独立子进程中测量处理请求期间的峰值 RSS 增量。
+
+用法:
+    python benchmarks/bench_upload_memory.py [--sizes 16,64,256] [--modes stream,multipart,form]
+
+大小单位为 MB。每次测量都在全新的临时工作目录和子进程中进行，互不影响。
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+
+def current_rss_kb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def run_single(mode, size_mb):
+    """在当前进程中执行一次上传，并打印峰值 RSS 增量（KB）"""
+    workdir = tempfile.mkdtemp(prefix='gracedisk-bench-')
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app as gracedisk
+
+    size = size_mb * 1024 * 1024
+    source = os.path.join(workdir, 'source.bin')
+    with open(source, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            f.write(block)
+
+    client = gracedisk.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+
+    # 采样线程记录请求处理期间的最大 RSS
+    baseline = current_rss_kb()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss_kb())
+            time.sleep(0.002)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    with open(source, 'rb') as f:
+        if mode == 'stream':
+            response = client.post(
+                '/upload_stream?filename=bench.bin&upload_id=bench&subpath=',
+                input_stream=f, content_length=size,
+                headers={'X-Socket-ID': 'bench', 'Content-Type': 'application/octet-stream'})
+        elif mode == 'multipart':
+            response = client.post(
+                '/upload_websocket',
+                data={'file': (f, 'bench.bin'), 'upload_id': 'bench', 'subpath': ''},
+                headers={'X-Socket-ID': 'bench'})
+        else:
+            response = client.post('/upload', data={'file': (f, 'bench.bin'), 'subpath': ''})
+    done.set()
+    sampler.join()
+
+    uploaded = os.path.join(storage, 'bench.bin')
+    ok = response.status_code in (200, 302) and os.path.getsize(uploaded) == size
+    print(f"{max(peak[0] - baseline, 0)} {'ok' if ok else 'failed'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='16,64,256', help='文件大小列表（MB，逗号分隔）')
+    parser.add_argument('--modes', default='stream,multipart,form', help='上传方式列表')
+    parser.add_argument('--single', nargs=2, metavar=('MODE', 'SIZE_MB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single[0], int(args.single[1]))
+        return
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    modes = args.modes.split(',')
+
+    print(f"{'mode':<10} {'size (MB)':>10} {'peak RSS delta (MB)':>20}  result")
+    print('-' * 52)
+    for mode in modes:
+        for size_mb in sizes:
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--single', mode, str(size_mb)],
+                capture_output=True, text=True)
+            lines = out.stdout.strip().splitlines()
+            if out.returncode != 0 or not lines:
+                print(f"{mode:<10} {size_mb:>10} {'error':>20}  {out.stderr.strip()[-200:]}")
+                continue
+            delta_kb, result = lines[-1].split()
+            print(f"{mode:<10} {size_mb:>10} {int(delta_kb) / 1024:>20.1f}  {result}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+热点查询执行计划检查
+
+在临时数据库中写入一批历史记录、登录日志和分享，登录后依次访问文件历史、仪表盘、
+分享管理、分享下载等页面，记录这些请求实际执行的 SQL，再对每条语句执行
+EXPLAIN QUERY PLAN。若热点表（file_operations、login_logs、shares）出现不走索引的全表扫描，
+或分享列表需要临时排序，则以非零状态退出，防止修改查询或索引后性能回退。
+
+用法:
+    python benchmarks/check_query_plans.py [--rows 20000] [--verbose]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+"""
+
+HOT_TABLES = ('file_operations', 'login_logs', 'shares')
+
+
+def setup_app(workdir, rows):
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    with open(os.path.join(storage, 'shared.txt'), 'w', encoding='utf-8') as f:
+        f.write('shared')
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app as gracedisk
+    conn = gracedisk.get_db()
+    cursor = conn.cursor()
+    password_hash = gracedisk.generate_password_hash('bench-password')
+    cursor.execute("UPDATE users SET must_change_password = 0")
+    for n in range(20):
+        cursor.execute("INSERT INTO users (username, password, is_admin, quota_gb) VALUES (?, ?, 0, 5)",
+                       (f'user{n}', password_hash))
+
+    # 写入分布在近 90 天内的历史数据
+    rng = random.Random(0)
+    now = datetime.now()
+
+    def timestamp():
+        return (now - timedelta(seconds=rng.randrange(90 * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+    cursor.executemany("""
+        INSERT INTO file_operations (user_id, operation_type, file_path, file_size, status, created_at)
+        VALUES (?, ?, ?, ?, 'completed', ?)
+    """, [(rng.randrange(1, 22), rng.choice(('upload', 'download')), f'f{n}.bin', rng.randrange(1 << 20), timestamp())
+          for n in range(rows)])
+    cursor.executemany("""
+        INSERT INTO login_logs (user_id, username, login_type, ip_address, user_agent, created_at)
+        VALUES (?, ?, ?, '127.0.0.1', 'bench', ?)
+    """, [(rng.randrange(1, 22), 'user', rng.choice(('admin', 'user', 'visitor')), timestamp())
+          for _ in range(rows)])
+    cursor.executemany("""
+        INSERT INTO shares (token, file_path, user_id, expires_at, created_at)
+        VALUES (?, 'shared.txt', 1, ?, ?)
+    """, [(f'token{n}', timestamp(), timestamp()) for n in range(rows // 10)])
+    cursor.execute('ANALYZE')
+    conn.commit()
+    return gracedisk
+
+
+def capture_statements(gracedisk):
+    """访问热点页面并返回执行过的 SQL 语句（已代入参数）"""
+    statements = []
+    conn = gracedisk.get_db()
+    conn.set_trace_callback(statements.append)
+
+    admin = gracedisk.app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'bench-password'})
+    admin.get('/file_history')
+    admin.get('/dashboard')
+    admin.get('/manage_shares')
+    admin.get('/share/token1')
+
+    user = gracedisk.app.test_client()
+    user.post('/login', data={'username': 'user1', 'password': 'bench-password'})
+    user.get('/file_history')
+    user.get('/manage_shares')
+    user.get('/get_user_quota')
+
+    conn.set_trace_callback(None)
+    seen = []
+    for sql in statements:
+        sql = ' '.join(sql.split())
+        if re.match(r'(SELECT|UPDATE|DELETE)\b', sql, re.IGNORECASE) and sql not in seen:
+            seen.append(sql)
+    return seen
+
+
+def table_aliases(sql):
+    """返回语句中 别名 -> 表名 的映射（EXPLAIN 输出使用别名）"""
+    aliases = {}
+    keywords = {'WHERE', 'JOIN', 'ON', 'ORDER', 'GROUP', 'LIMIT', 'SET', 'LEFT', 'INNER'}
+    for table, alias in re.findall(r'(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.upper() not in keywords:
+            aliases[alias] = table
+    return aliases
+
+
+def check_plan(conn, sql):
+    """返回该语句的执行计划以及其中的问题列表"""
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    aliases = table_aliases(sql)
+    hot_query = any(table in HOT_TABLES for table in aliases.values())
+    problems = []
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match and 'USING' not in detail and aliases.get(match.group(1)) in HOT_TABLES:
+            problems.append(f'full table scan: {detail}')
+        if 'USE TEMP B-TREE FOR ORDER BY' in detail and hot_query and 'GROUP BY' not in sql.upper():
+            problems.append(f'sort without index: {detail}')
+    return plan, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='每张日志表写入的行数')
+    parser.add_argument('--verbose', action='store_true', help='打印每条语句的执行计划')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gracedisk-plans-')
+    gracedisk = setup_app(workdir, args.rows)
+    statements = capture_statements(gracedisk)
+    conn = gracedisk.get_db()
+
+    failures = 0
+    for sql in statements:
+        plan, problems = check_plan(conn, sql)
+        if args.verbose or problems:
+            print(sql)
+            for detail in plan:
+                print(f'    {detail}')
+        for problem in problems:
+            print(f'  !! {problem}')
+        failures += bool(problems)
+
+    print(f'{len(statements)} statements checked, {failures} with problems')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
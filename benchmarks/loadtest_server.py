@@ -0,0 +1,231 @@
+"""
+服务器运行方式压力测试
+
+为每种运行方式生成一份 config.yaml（只有 server 块不同），以子进程运行 `python app.py`，
+然后用多个进程 × 多个线程的 keep-alive 客户端在固定时间内循环请求一组典型接口：
+  /browse/bench            文件列表页面（首屏数据嵌入 HTML）
+  /api/list?path=bench     分页列表 JSON
+  /get_user_quota          简单的数据库查询
+  /filedata/sample.bin     发送 64KB 文件
+输出每种方式的 req/s、p50、p99 延迟和错误数。没有安装对应依赖（gunicorn / eventlet / gevent）的方式会被跳过。
+
+运行方式:
+  werkzeug           async_mode=threading，内置 Werkzeug 开发服务器
+  eventlet           async_mode=eventlet，内置 eventlet 服务器
+  gevent             async_mode=gevent，内置 gevent 服务器
+  gunicorn-gthread   gunicorn + gthread worker（--workers 个进程 × --threads 个线程）
+  gunicorn-gevent    gunicorn + gevent worker
+
+用法:
+    python benchmarks/loadtest_server.py [--modes werkzeug,gunicorn-gthread] [--clients 64] [--duration 10]
+"""
+import argparse
+import http.client
+import importlib.util
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """admin:
+  username: admin
+  password: bench-password
+storage_path: "{storage}"
+users_db_path: "users.db"
+allow_visiter: false
+fs_watch: false
+server:
+  host: 127.0.0.1
+  port: {port}
+  debug: false
+  async_mode: {async_mode}
+  gunicorn: {gunicorn}
+  workers: {workers}
+  threads: {threads}
+"""
+
+MODES = {
+    'werkzeug': {'async_mode': 'threading', 'gunicorn': 'false', 'requires': None},
+    'eventlet': {'async_mode': 'eventlet', 'gunicorn': 'false', 'requires': 'eventlet'},
+    'gevent': {'async_mode': 'gevent', 'gunicorn': 'false', 'requires': 'gevent'},
+    'gunicorn-gthread': {'async_mode': 'threading', 'gunicorn': 'true', 'requires': 'gunicorn'},
+    'gunicorn-gevent': {'async_mode': 'gevent', 'gunicorn': 'true', 'requires': 'gunicorn'},
+}
+
+URLS = ['/browse/bench', '/api/list?path=bench&offset=1000', '/get_user_quota', '/filedata/sample.bin']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def prepare_workdir(entries):
+    workdir = tempfile.mkdtemp(prefix='gracedisk-load-')
+    storage = os.path.join(workdir, 'storage')
+    bench_dir = os.path.join(storage, 'bench')
+    os.makedirs(bench_dir)
+    for n in range(entries):
+        with open(os.path.join(bench_dir, f'file{n:05d}.txt'), 'w') as f:
+            f.write('x')
+    old = time.time() - 60
+    os.utime(bench_dir, (old, old))
+    with open(os.path.join(storage, 'sample.bin'), 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+    return workdir, storage
+
+
+def start_server(workdir, storage, mode, workers, threads):
+    port = free_port()
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(storage=storage, port=port, workers=workers, threads=threads,
+                                       async_mode=MODES[mode]['async_mode'], gunicorn=MODES[mode]['gunicorn']))
+    log = open(os.path.join(workdir, f'{mode}.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'app.py')], cwd=workdir,
+                               stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited, see {log.name}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/login')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'server did not start, see {log.name}')
+
+
+def stop_server(process):
+    # gunicorn 主进程收到 SIGTERM 后会结束所有 worker
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', 'username=admin&password=bench-password',
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def client_process(port, cookie, threads, duration, results):
+    """一个压测进程：threads 个线程各自使用一个 keep-alive 连接循环请求"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        n = offset
+        while time.time() < stop_at:
+            url = URLS[n % len(URLS)]
+            n += 1
+            start = time.perf_counter()
+            try:
+                conn.request('GET', url, headers={'Cookie': cookie})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise IOError(response.status)
+                if response.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    results.put((latencies, errors[0]))
+
+
+def run_load(port, clients, processes, duration):
+    cookie = login(port)
+    results = multiprocessing.Queue()
+    per_process = max(1, clients // processes)
+    procs = [multiprocessing.Process(target=client_process, args=(port, cookie, per_process, duration, results))
+             for _ in range(processes)]
+    for p in procs:
+        p.start()
+    latencies, errors = [], 0
+    for _ in procs:
+        part, part_errors = results.get()
+        latencies.extend(part)
+        errors += part_errors
+    for p in procs:
+        p.join()
+    latencies.sort()
+    return latencies, errors
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default=','.join(MODES), help='逗号分隔的运行方式')
+    parser.add_argument('--clients', type=int, default=64, help='并发客户端连接数')
+    parser.add_argument('--processes', type=int, default=4, help='压测客户端进程数')
+    parser.add_argument('--duration', type=float, default=10, help='每种方式的压测时间（秒）')
+    parser.add_argument('--workers', type=int, default=max(2, (os.cpu_count() or 2) // 2),
+                        help='gunicorn worker 进程数')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn gthread 每个进程的线程数')
+    parser.add_argument('--entries', type=int, default=5000, help='测试目录中的文件数')
+    args = parser.parse_args()
+
+    workdir, storage = prepare_workdir(args.entries)
+    print(f'clients={args.clients} duration={args.duration}s gunicorn workers={args.workers} threads={args.threads}')
+    print(f"{'mode':<18} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    print('-' * 53)
+    for mode in args.modes.split(','):
+        requires = MODES[mode]['requires']
+        if requires and importlib.util.find_spec(requires) is None:
+            print(f'{mode:<18} skipped ({requires} not installed)')
+            continue
+        process, port = start_server(workdir, storage, mode, args.workers, args.threads)
+        try:
+            # 第一次登录前关闭强制改密码
+            db = sqlite3.connect(os.path.join(workdir, 'users.db'))
+            db.execute('UPDATE users SET must_change_password = 0')
+            db.commit()
+            db.close()
+            latencies, errors = run_load(port, args.clients, args.processes, args.duration)
+        finally:
+            stop_server(process)
+        print(f'{mode:<18} {len(latencies) / args.duration:>8.0f} {percentile(latencies, 0.5) * 1000:>8.1f} '
+              f'{percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    main()